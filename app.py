@@ -1,3 +1,6 @@
+import time
+STARTUP_T0 = time.perf_counter()  # startup() reports the time from here until the app is ready
+
 from flask import Flask, request, jsonify, send_from_directory, render_template, send_file
 from flask_cors import CORS
 import os
@@ -6,23 +9,289 @@ import jwt
 import datetime
 import pytz
 import sys
-import time
 import threading
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import atexit
+import uuid
+import bisect
+import math
+import collections
+import csv
+import io
+import gzip
+import mimetypes
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from functools import wraps
+from werkzeug.http import parse_accept_header
+from flask.json.provider import DefaultJSONProvider
 
 import sqlite3
 from dotenv import load_dotenv
-import openpyxl
 from io import BytesIO
 
-try:
-    import pymssql
-except ImportError:
-    pymssql = None
+# openpyxl and the SQL Server drivers are imported on first use (reports,
+# imports, first connect attempt) so that booting the app stays fast.
+_pymssql = False  # False = not tried yet; None = not installed
+
+def load_pymssql():
+    """Returns the pymssql module, importing it on first use (None when not installed)."""
+    global _pymssql
+    if _pymssql is False:
+        try:
+            import pymssql
+        except ImportError:
+            pymssql = None
+        _pymssql = pymssql
+    return _pymssql
 
 load_dotenv()
 
-app = Flask(__name__, static_folder='netlify', template_folder='netlify')
+# Structured logging: handlers only enqueue records; a background listener
+# formats them as JSON lines and writes to stdout or a size-rotated file.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE')  # may contain {pid} for one file per worker process
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+LOG_DEBUG_SAMPLE = float(os.getenv('LOG_DEBUG_SAMPLE', '1.0'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for k, v in record.__dict__.items():
+            if k not in _LOG_RECORD_FIELDS and not k.startswith('_'):
+                entry[k] = v
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DebugSampler(logging.Filter):
+    """Keeps a LOG_DEBUG_SAMPLE fraction of DEBUG records; other levels always pass."""
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or LOG_DEBUG_SAMPLE >= 1 or random.random() < LOG_DEBUG_SAMPLE
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: when the queue is full the record is dropped and counted."""
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+_log_pipeline = {}
+
+def _start_log_pipeline(logger):
+    """(Re)builds this process's queue -> listener thread -> target pipeline."""
+    old = _log_pipeline.get('target')
+    if LOG_FILE:
+        target = logging.handlers.RotatingFileHandler(
+            LOG_FILE.format(pid=os.getpid()), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+    q = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = DroppingQueueHandler(q)
+    handler.addFilter(DebugSampler())
+    logger.handlers = [handler]
+    listener = logging.handlers.QueueListener(q, target, respect_handler_level=False)
+    listener.start()
+    _log_pipeline.update(target=target, listener=listener)
+    if old is not None and old is not target and LOG_FILE:
+        old.close()  # the parent's file, inherited through fork
+
+def _stop_log_pipeline():
+    listener = _log_pipeline.get('listener')
+    if listener:
+        listener.stop()
+
+def setup_logging():
+    logger = logging.getLogger('ponto')
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+    _start_log_pipeline(logger)
+    atexit.register(_stop_log_pipeline)
+    # serve.py forks its workers after importing this module (werkzeug prefork,
+    # gunicorn preload_app): the listener thread does not survive fork, and
+    # LOG_FILE's {pid} must name the worker, so each child builds its own
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: _start_log_pipeline(logger))
+    return logger
+
+log = setup_logging()
+
+# In-process metrics, scraped from /metrics in the Prometheus text format.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# Without a token /metrics only answers direct loopback scrapes; set to true to expose it anyway
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', 'false').lower() == 'true'
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_MAX_SHARDS = 256
+
+class Metrics:
+    """
+    Counters, histograms and scrape-time gauges. Every thread records into its
+    own shard, so the hot path never takes a lock; render() folds the shards
+    together. Values are per process: with several workers each one exposes
+    its own numbers and Prometheus aggregates them.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = ({}, {})
+        self._gauges = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def gauge(self, name, fn, text='', kind='gauge'):
+        """fn() -> number or {labels_tuple: number}, evaluated at scrape time."""
+        self._gauges[name] = fn
+        self.describe(name, kind, text)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                if len(self._shards) >= METRICS_MAX_SHARDS:
+                    self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        hists = self._shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        h = hists.get(key)
+        if h is None:
+            # one slot per bucket, one for +Inf, then the sum
+            h = hists[key] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+        h[bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        h[-1] += value
+
+    @staticmethod
+    def _merge(into, shard):
+        counters, hists = shard
+        for key, v in counters.copy().items():
+            into[0][key] = into[0].get(key, 0) + v
+        for key, h in hists.copy().items():
+            acc = into[1].get(key)
+            if acc is None:
+                into[1][key] = list(h)
+            else:
+                for i, v in enumerate(list(h)):
+                    acc[i] += v
+
+    def _retire_dead(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = alive
+
+    def snapshot(self):
+        with self._lock:
+            self._retire_dead()
+            total = ({}, {})
+            self._merge(total, self._retired)
+            for _, shard in self._shards:
+                self._merge(total, shard)
+        return total
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        body = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                        for k, v in items)
+        return '{' + body + '}'
+
+    def render(self):
+        counters, hists = self.snapshot()
+        series = {}
+        for (name, labels), v in counters.items():
+            series.setdefault(name, []).append(f"{name}{self._labels(labels)} {v}")
+        for (name, labels), h in hists.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(METRICS_BUCKETS, h):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            cumulative += h[len(METRICS_BUCKETS)]
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-1]}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, fn in self._gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                series[name] = [f"{name}{self._labels(labels)} {v}" for labels, v in value.items()]
+            else:
+                series[name] = [f"{name} {value}"]
+        out = []
+        for name in sorted(series):
+            kind, text = self._help.get(name, ('untyped', ''))
+            if text:
+                out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(sorted(series[name]) if kind != 'histogram' else series[name])
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics()
+metrics.describe('ponto_http_requests_total', 'counter', 'HTTP requests by endpoint, method and status.')
+metrics.describe('ponto_http_request_duration_seconds', 'histogram', 'HTTP request latency by endpoint.')
+metrics.describe('ponto_db_connect_seconds', 'histogram', 'Time to open a DB connection by backend.')
+metrics.describe('ponto_db_connect_failures_total', 'counter', 'Failed SQL Server connection attempts by backend.')
+metrics.describe('ponto_db_query_seconds', 'histogram', 'Statement execution time by backend.')
+metrics.describe('ponto_db_commit_seconds', 'histogram', 'Commit time by backend.')
+metrics.describe('ponto_db_fallback_total', 'counter', 'Requests served from SQLite instead of SQL Server, by reason.')
+metrics.describe('ponto_punches_total', 'counter', 'Punches stored, by destination.')
+metrics.describe('ponto_sync_rows_total', 'counter', 'OfflineQueue rows sent to SQL Server.')
+metrics.describe('ponto_sync_seconds', 'histogram', 'Duration of a per-user sync.')
+metrics.describe('ponto_report_build_seconds', 'histogram', 'Time to build a report, by report.')
+metrics.describe('ponto_sse_streams_total', 'counter', 'Status event streams opened.')
+metrics.describe('ponto_compressed_responses_total', 'counter', 'JSON responses sent compressed, by encoding.')
+metrics.describe('ponto_compression_input_bytes_total', 'counter', 'JSON bytes before compression, by encoding.')
+metrics.describe('ponto_compression_saved_bytes_total', 'counter', 'Bytes saved by response compression, by encoding.')
+
+app = Flask(__name__, static_folder='static', template_folder='netlify')
+
+class CompactJSONProvider(DefaultJSONProvider):
+    """API JSON without spaces or key sorting, with UTF-8 text instead of \\u escapes."""
+    ensure_ascii = False
+    sort_keys = False
+    compact = True
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault('separators', (',', ':'))
+        return super().dumps(obj, **kwargs)
+
+app.json = CompactJSONProvider(app)
 _secret = os.getenv('SECRET_KEY')
 if not _secret:
     _secret = os.getenv('DB_PASSWORD', 'ponto_sre_carapina')
@@ -36,21 +305,214 @@ try:
 except Exception:
     pass
 
+# Frontend files. build_static.py writes dist/: fingerprinted assets (served
+# as immutable) and the HTML pages pointing at them (strong ETag, revalidated),
+# each with precompressed gzip/br variants picked by Accept-Encoding. Without a
+# build the sources in netlify/ are sent as they are.
+STATIC_DIST_DIR = os.getenv('STATIC_DIST_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dist'))
+STATIC_AUTOBUILD = os.getenv('STATIC_AUTOBUILD', 'true').lower() == 'true'  # rebuild when a source changes
+STATIC_CHECK_INTERVAL = 2.0  # seconds between source/manifest checks
+STATIC_IMMUTABLE = 'public, max-age=31536000, immutable'
+STATIC_ENCODING_SUFFIX = {'br': '.br', 'gzip': '.gz'}
+
+class StaticAssets:
+    def __init__(self, dist):
+        self.dist = dist
+        self.manifest = None
+        self._manifest_mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def _read_manifest(self):
+        path = os.path.join(self.dist, 'manifest.json')
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == self._manifest_mtime:
+                return self.manifest
+            with open(path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._manifest_mtime = mtime
+        return manifest
+
+    def current(self):
+        """The manifest in use, re-read when build_static.py (or the watcher) replaced it."""
+        now = time.monotonic()
+        if now - self._checked < STATIC_CHECK_INTERVAL:
+            return self.manifest
+        with self._lock:
+            if now - self._checked < STATIC_CHECK_INTERVAL:
+                return self.manifest
+            manifest = self._read_manifest()
+            if manifest is not self.manifest:
+                self._data.clear()
+            self.manifest = manifest
+            self._checked = now
+        return self.manifest
+
+    def rebuild_if_changed(self):
+        """Rebuilds dist/ when a source file differs from the manifest. Returns whether it built."""
+        import build_static
+        path = os.path.join(self.dist, 'manifest.json')
+        try:
+            with open(path, encoding='utf-8') as f:
+                built = json.load(f).get('sources')
+        except (OSError, ValueError):
+            built = None
+        sources = {k: [m, s] for k, (_, m, s) in build_static.scan_sources().items()}
+        if built == sources:
+            return False
+        manifest = build_static.build(self.dist)
+        log.info("static assets built", extra={'files': len(manifest['files']), 'duration_ms': manifest['build_ms']})
+        return True
+
+    def watch(self):
+        """STATIC_AUTOBUILD loop: scans the sources off the request path, once per host (see start_supervisor)."""
+        while True:
+            try:
+                self.rebuild_if_changed()
+            except Exception as e:
+                log.warning("static build failed", extra={'error': str(e)})
+            time.sleep(STATIC_CHECK_INTERVAL)
+
+    def _bytes(self, rel):
+        data = self._data.get(rel)
+        if data is None:
+            with open(os.path.join(self.dist, rel), 'rb') as f:
+                data = self._data[rel] = f.read()
+        return data
+
+    def response(self, path):
+        """Response for a built file (or 304), None when `path` is not in the build."""
+        manifest = self.current()
+        if not manifest:
+            return None
+        entry = manifest['files'].get(path) or manifest.get('previous', {}).get(path)
+        if not entry:
+            return None
+        encoding = next((e for e in ('br', 'gzip') if e in entry['encodings'] and request.accept_encodings[e]), None)
+        try:
+            data = self._bytes(entry['file'] + STATIC_ENCODING_SUFFIX.get(encoding, ''))
+        except OSError:
+            return None
+        resp = app.response_class(data, mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+        if entry['encodings']:
+            resp.vary.add('Accept-Encoding')
+        # one strong ETag per representation
+        resp.set_etag(entry['etag'] + (f"-{encoding}" if encoding else ''))
+        resp.headers['Cache-Control'] = STATIC_IMMUTABLE if entry['immutable'] else 'no-cache'
+        return resp.make_conditional(request)
+
+static_assets = StaticAssets(STATIC_DIST_DIR)
+
+def serve_frontend(path):
+    return static_assets.response(path) or send_from_directory('netlify', path)
+
 # Routes to serve frontend files locally
 @app.route('/')
 def serve_index():
-    return send_from_directory('netlify', 'index.html')
+    return serve_frontend('index.html')
 
 @app.route('/<path:path>')
 def serve_static(path):
     if not path.startswith('api/'):
-        return send_from_directory('netlify', path)
+        return serve_frontend(path)
     return jsonify({'message': 'Not Found'}), 404
 
 @app.before_request
 def log_request_info():
-    if request.path.startswith('/api/'):
-        print(f"DEBUG REQ: {request.method} {request.path} | Origin: {request.headers.get('Origin')} | Remote: {request.remote_addr}")
+    request.environ['ponto.start'] = time.perf_counter()
+    start_trace()
+    if request.path.startswith('/api/') and log.isEnabledFor(logging.DEBUG):
+        log.debug("request", extra={'method': request.method, 'path': request.path,
+                                    'origin': request.headers.get('Origin'), 'remote': request.remote_addr})
+
+def record_request(endpoint, method, status, elapsed):
+    metrics.inc('ponto_http_requests_total', endpoint=endpoint, method=method, status=status)
+    metrics.observe('ponto_http_request_duration_seconds', elapsed, endpoint=endpoint)
+
+@app.after_request
+def record_request_metrics(response):
+    start = request.environ.get('ponto.start')
+    if start is not None:
+        # Label by route pattern so /api/admin/users/<int:user_id> stays one series
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        record_request(endpoint, request.method, response.status_code, time.perf_counter() - start)
+    timing = report_trace(finish_trace(), request.method, request.path, response.status_code)
+    if timing:
+        response.headers['Server-Timing'] = timing
+        response.headers['Timing-Allow-Origin'] = '*'
+    return response
+
+@app.teardown_request
+def clear_trace(exc):
+    # after_request is skipped on unhandled errors; do not leak the trace to the next request
+    _request_ctx.trace = None
+
+# JSON responses of at least COMPRESS_MIN_BYTES are compressed (brotli when the
+# package is installed and the client accepts it, else gzip). Streamed responses
+# and file downloads (send_file) pass through untouched.
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BR_QUALITY = 4  # dynamic content: much faster than 11 for a few % more bytes
+COMPRESS_MIMETYPES = ('application/json',)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def choose_encoding(accept_encoding):
+    """'br', 'gzip' or None for an Accept-Encoding header value."""
+    if not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    br = accepted['br'] if brotli else 0
+    gz = accepted['gzip']
+    if not br and not gz:
+        return None
+    return 'br' if br >= gz else 'gzip'
+
+def compress_payload(payload, accept_encoding):
+    """Returns (body, encoding); encoding is None when the payload is sent as is."""
+    if len(payload) < COMPRESS_MIN_BYTES:
+        return payload, None
+    encoding = choose_encoding(accept_encoding)
+    if not encoding:
+        return payload, None
+    if encoding == 'br':
+        data = brotli.compress(payload, quality=COMPRESS_BR_QUALITY)
+    else:
+        data = gzip.compress(payload, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0)
+    if len(data) >= len(payload):
+        return payload, None
+    metrics.inc('ponto_compressed_responses_total', encoding=encoding)
+    metrics.inc('ponto_compression_input_bytes_total', len(payload), encoding=encoding)
+    metrics.inc('ponto_compression_saved_bytes_total', len(payload) - len(data), encoding=encoding)
+    return data, encoding
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or request.method == 'HEAD'
+            or response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 304)):
+        return response
+    payload = response.get_data()
+    if len(payload) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    data, encoding = compress_payload(payload, request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(f"{etag}-{encoding}")
+    return response
 
 # Database Configuration
 server = os.getenv('DB_SERVER')
@@ -72,6 +534,42 @@ if os.getenv('INIT_DB_ON_START', 'false').lower() == 'true':
 # Global DB Status
 DB_ONLINE = False
 
+# Multi-process mode (serve.py): only the supervisor process probes the DB and
+# publishes the result to DB_STATE_FILE; worker processes read it from there.
+DB_STATE_FILE = os.getenv('DB_STATE_FILE')
+DB_STATE_MAX_AGE = 60  # seconds before a silent supervisor counts as offline
+DB_HEALTH_INTERVAL = float(os.getenv('DB_HEALTH_INTERVAL', '10'))  # seconds between SQL Server probes
+_supervisor_pid = None
+_db_state_cache = {'read_at': 0.0, 'online': False}
+
+def publish_db_state(online):
+    """Atomically writes the DB health state for the worker processes."""
+    if not DB_STATE_FILE:
+        return
+    try:
+        tmp = f"{DB_STATE_FILE}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'db_online': online, 'checked_at': time.time(), 'pid': os.getpid()}, f)
+        os.replace(tmp, DB_STATE_FILE)
+    except Exception as e:
+        log.warning("could not publish DB state", extra={'error': str(e)})
+
+def _read_db_state():
+    now = time.time()
+    if now - _db_state_cache['read_at'] < 1:
+        return _db_state_cache['online']
+    try:
+        with open(DB_STATE_FILE) as f:
+            state = json.load(f)
+        online = bool(state.get('db_online')) and now - state.get('checked_at', 0) < DB_STATE_MAX_AGE
+    except Exception:
+        online = False
+    if online != _db_state_cache['online']:
+        user_index.invalidate(shared=False)
+        presence.invalidate()
+    _db_state_cache.update(read_at=now, online=online)
+    return online
+
 def check_db_status():
     global DB_ONLINE
     while True:
@@ -80,6 +578,7 @@ def check_db_status():
             success = False
             
             # Try pymssql first
+            pymssql = load_pymssql()
             if pymssql:
                 try:
                     conn = pymssql.connect(
@@ -109,23 +608,153 @@ def check_db_status():
                 
                 # Check for transition from Offline -> Online
                 if not DB_ONLINE:
-                    print("DEBUG: SQL Server connection restored. Triggering auto-sync.")
+                    log.info("SQL Server connection restored, triggering auto-sync")
+                    ensure_sqlserver_indexes()
+                    user_index.invalidate(shared=False)
+                    presence.invalidate()
+                    DB_ONLINE = True
+                    publish_db_state(True)
+                    status_broadcaster.notify()
                     threading.Thread(target=auto_sync_all, daemon=True).start()
+                    request_publish_sites()
                 
                 DB_ONLINE = True
             else:
+                was_online = DB_ONLINE
                 DB_ONLINE = False
+                if was_online:
+                    user_index.invalidate(shared=False)
+                    presence.invalidate()
+                    status_broadcaster.notify()
         except Exception:
             DB_ONLINE = False
+        publish_db_state(DB_ONLINE)
             
-        time.sleep(10)
+        time.sleep(DB_HEALTH_INTERVAL)
 
 def start_health_check():
     t = threading.Thread(target=check_db_status)
     t.daemon = True
     t.start()
+
+def start_supervisor():
+    """
+    Starts the work that must run once per host: DB health checks (and the
+    auto-sync they trigger), the archiver, the rollup rebuild and the static
+    rebuild watcher. In multi-process mode this runs in the master process only.
+    """
+    global _supervisor_pid
+    _supervisor_pid = os.getpid()
+    if STATIC_AUTOBUILD:
+        threading.Thread(target=static_assets.watch, daemon=True).start()
+    start_health_check()
+    start_archiver()
+    start_rollup_rebuilder()
     
+# Location of a punch and its geofence check, stored on the record:
+# (column, SQLite type, SQL Server type)
+GEO_COLUMNS = [
+    ('lat', 'REAL', 'FLOAT'),
+    ('lon', 'REAL', 'FLOAT'),
+    ('accuracy', 'REAL', 'FLOAT'),
+    ('geofence', 'TEXT', 'NVARCHAR(16)'),  # inside / outside / unassigned / unknown
+    ('geofence_m', 'INTEGER', 'INT'),  # meters to the nearest assigned site
+]
+GEO_COLUMN_NAMES = [c for c, _, _ in GEO_COLUMNS]
+GEO_INSERT_COLUMNS = ', '.join(GEO_COLUMN_NAMES)
+
+def geo_values(row):
+    """GEO_COLUMNS values of a dict or row, in column order."""
+    return tuple(rf(row, c) for c in GEO_COLUMN_NAMES)
+
+# The local punch tables (TimeRecords, OfflineQueue and the SQLite archive)
+# store (neighborhood, city) as an id into Locations; the text columns stay for
+# rows written before LOCAL_MIGRATIONS 3 and for SQL Server, which keeps the
+# shared text schema. user_name is kept as written: it is the name at the time
+# of the punch, which a later rename must not change.
+def punch_text_columns(conn, alias='t', name_as='user_name'):
+    """(select list, joins) giving user_name/neighborhood/city of the punch table aliased `alias`."""
+    if not isinstance(conn, sqlite3.Connection):
+        return f"{alias}.user_name AS {name_as}, {alias}.neighborhood, {alias}.city", ""
+    return (f"{alias}.user_name AS {name_as}, "
+            f"COALESCE(NULLIF(loc.neighborhood, ''), {alias}.neighborhood) AS neighborhood, "
+            f"COALESCE(NULLIF(loc.city, ''), {alias}.city) AS city",
+            f"LEFT JOIN Locations loc ON loc.id = {alias}.location_id")
+
+def rekey_local_punches(conn, old_matricula, new_matricula):
+    """
+    Moves a user's local rows (punches, including archived months, rollups and
+    site assignments) to a new matricula (caller commits). Returns the rows moved.
+    """
+    moved = 0
+    for table in ['TimeRecords', 'OfflineQueue', 'PresenceFeed'] + archive_tables(conn):
+        moved += max(conn.execute(f"UPDATE {table} SET matricula = ? WHERE matricula = ?",
+                                  (new_matricula, old_matricula)).rowcount, 0)
+    # DailyFirstIn and UserSites are keyed by matricula: rows the new matricula
+    # already has are merged, not overwritten. A day with a first arrival under
+    # both keeps the earlier one, and the later is taken out of DailyRollup.
+    for day, ts, location_id, new_ts, new_location_id in conn.execute("""
+        SELECT o.day, o.timestamp, o.location_id, n.timestamp, n.location_id
+        FROM DailyFirstIn o JOIN DailyFirstIn n ON n.day = o.day AND n.matricula = ?
+        WHERE o.matricula = ?
+    """, (new_matricula, old_matricula)).fetchall():
+        later_ts, later_location = (ts, location_id) if new_ts <= ts else (new_ts, new_location_id)
+        _rollup_add(conn, day, later_location, ARRIVAL_RECORD_TYPE, arrivals=-1, late=-int(is_late(later_ts)))
+        if ts < new_ts:
+            conn.execute("UPDATE DailyFirstIn SET timestamp = ?, location_id = ? WHERE day = ? AND matricula = ?",
+                         (ts, location_id, day, new_matricula))
+        moved += conn.execute("DELETE FROM DailyFirstIn WHERE day = ? AND matricula = ?", (day, old_matricula)).rowcount
+    moved += max(conn.execute("UPDATE DailyFirstIn SET matricula = ? WHERE matricula = ?",
+                              (new_matricula, old_matricula)).rowcount, 0)
+    conn.execute("INSERT OR IGNORE INTO UserSites (matricula, site_id) SELECT ?, site_id FROM UserSites WHERE matricula = ?",
+                 (new_matricula, old_matricula))
+    moved += max(conn.execute("DELETE FROM UserSites WHERE matricula = ?", (old_matricula,)).rowcount, 0)
+    return moved
+
+class LocationDictionary:
+    """Interns (neighborhood, city) pairs as Locations ids, cached in process.
+
+    Ids are never reused or deleted, so every process can keep its own cache.
+    A miss inserts the pair; it is cached only once committed, i.e. when the
+    caller's connection had no open transaction (otherwise a rollback could
+    leave the cache pointing at a row that does not exist).
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def id_for(self, conn, neighborhood, city):
+        if not neighborhood and not city:
+            return None
+        key = (neighborhood or '', city or '')
+        with self._lock:
+            lid = self._ids.get(key)
+            if lid is not None:
+                self._ids.move_to_end(key)
+                metrics.inc('ponto_location_intern_total', result='hit')
+                return lid
+        metrics.inc('ponto_location_intern_total', result='miss')
+        own_tx = not conn.in_transaction
+        conn.execute("INSERT OR IGNORE INTO Locations (neighborhood, city) VALUES (?, ?)", key)
+        lid = conn.execute("SELECT id FROM Locations WHERE neighborhood = ? AND city = ?", key).fetchone()[0]
+        if own_tx:
+            conn.commit()
+            with self._lock:
+                self._ids[key] = lid
+                while len(self._ids) > self.max_entries:
+                    self._ids.popitem(last=False)
+        return lid
+
+locations = LocationDictionary()
+metrics.describe('ponto_location_intern_total', 'counter', 'Location dictionary lookups on the punch path (hit, miss).')
+
 def ensure_sqlite_schema(conn):
+    with trace_span('sqlite_schema'):
+        _create_sqlite_schema(conn)
+
+def _create_sqlite_schema(conn):
     c = conn.cursor()
     c.execute("""
         CREATE TABLE IF NOT EXISTS Users (
@@ -145,7 +774,9 @@ def ensure_sqlite_schema(conn):
             record_type TEXT NOT NULL,
             timestamp DATETIME,
             neighborhood TEXT,
-            city TEXT
+            city TEXT,
+            ts_epoch INTEGER,
+            tz TEXT
         )
     """)
     c.execute("""
@@ -157,6 +788,37 @@ def ensure_sqlite_schema(conn):
             record_type TEXT NOT NULL,
             timestamp DATETIME,
             neighborhood TEXT,
+            city TEXT,
+            ts_epoch INTEGER,
+            tz TEXT
+        )
+    """)
+    # Distinct (neighborhood, city) pairs referenced by the punch tables' location_id
+    # ('' instead of NULL so the UNIQUE constraint dedupes missing parts)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS Locations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            neighborhood TEXT NOT NULL DEFAULT '',
+            city TEXT NOT NULL DEFAULT '',
+            UNIQUE (neighborhood, city)
+        )
+    """)
+    # Presence stream tickets already redeemed (see redeem_stream_ticket)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS StreamTickets (
+            jti TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        )
+    """)
+    # Today's punches for the presence boards of the other processes (see PresenceIndex)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS PresenceFeed (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            matricula TEXT,
+            user_name TEXT,
+            record_type TEXT,
+            timestamp DATETIME,
+            neighborhood TEXT,
             city TEXT
         )
     """)
@@ -173,51 +835,598 @@ def ensure_sqlite_schema(conn):
     try:
         c.execute("ALTER TABLE OfflineQueue ADD COLUMN user_name TEXT")
     except: pass
+    # Canonical integer epoch seconds (filled for old rows by LOCAL_MIGRATIONS 2)
+    for table in ('TimeRecords', 'OfflineQueue'):
+        for col, typ in [('ts_epoch', 'INTEGER'), ('tz', 'TEXT'), ('location_id', 'INTEGER')] + [(c, t) for c, t, _ in GEO_COLUMNS]:
+            try:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {typ}")
+            except: pass
+    # Attendance rollups (see rollup_punch); location_id 0 = no location
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS DailyRollup (
+            day TEXT NOT NULL,
+            location_id INTEGER NOT NULL DEFAULT 0,
+            record_type TEXT NOT NULL,
+            punches INTEGER NOT NULL DEFAULT 0,
+            arrivals INTEGER NOT NULL DEFAULT 0,
+            late INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, location_id, record_type)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS DailyFirstIn (
+            day TEXT NOT NULL,
+            matricula TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            location_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, matricula)
+        ) WITHOUT ROWID
+    """)
+    # Geofence sites (schools) and their assignment to users; SitesIndex is the
+    # R-tree over each site's box (radius + GEOFENCE_ACCURACY_CAP), see save_site
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS Sites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            radius_m REAL NOT NULL
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS UserSites (
+            matricula TEXT NOT NULL,
+            site_id INTEGER NOT NULL,
+            PRIMARY KEY (matricula, site_id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_usersites_site ON UserSites (site_id)")
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS SitesIndex USING rtree(id, min_lat, max_lat, min_lon, max_lon)")
+    except sqlite3.OperationalError as e:
+        log.warning("sqlite rtree unavailable, geofence checks disabled", extra={'error': str(e)})
+    # Indexes backing the admin user search (prefix LIKE uses the NOCASE indexes)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_matricula_nocase ON Users (matricula COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_name_nocase ON Users (name COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON Users (role, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_timerecords_matricula_epoch ON TimeRecords (matricula, ts_epoch)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_offlinequeue_matricula_epoch ON OfflineQueue (matricula, ts_epoch)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_timerecords_timestamp ON TimeRecords (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_timerecords_user_id ON TimeRecords (user_id)")
+    # Bulk jobs, shared by the worker processes for progress polling (see start_job)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS BackgroundJobs (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            finished_at REAL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    # Shared generation counters of the in-process caches (see bump_generation)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS CacheGenerations (
+            name TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL
+        )
+    """)
     conn.commit()
 
-def migrate_local_data():
-    """Populates matricula and user_name in existing TimeRecords and OfflineQueue entries."""
-    print("DEBUG: Starting local data migration...")
+# (table, index name, column list) created on SQL Server when it becomes reachable
+SQLSERVER_INDEXES = [
+    ('Users', 'IX_Users_name', 'name, id'),
+    ('Users', 'IX_Users_role', 'role, id'),
+    ('TimeRecords', 'IX_TimeRecords_matricula_timestamp', 'matricula, timestamp'),
+    ('TimeRecords', 'IX_TimeRecords_timestamp', 'timestamp'),
+    ('TimeRecords', 'IX_TimeRecords_user_id', 'user_id'),  # bulk delete by user id
+]
+
+# Statements run before the indexes: geofence columns on TimeRecords, and the
+# replica of the local geofence sites (see publish_sites) with a spatial index
+SQLSERVER_SCHEMA = [
+    f"IF COL_LENGTH('TimeRecords', '{col}') IS NULL ALTER TABLE TimeRecords ADD {col} {typ} NULL"
+    for col, _, typ in GEO_COLUMNS
+] + [
+    """
+    IF OBJECT_ID('Sites') IS NULL
+        CREATE TABLE Sites (
+            id INT PRIMARY KEY,
+            name NVARCHAR(200) NOT NULL,
+            lat FLOAT NOT NULL,
+            lon FLOAT NOT NULL,
+            radius_m FLOAT NOT NULL,
+            geo GEOGRAPHY NULL
+        )
+    """,
+    """
+    IF OBJECT_ID('UserSites') IS NULL
+        CREATE TABLE UserSites (
+            matricula NVARCHAR(50) NOT NULL,
+            site_id INT NOT NULL,
+            PRIMARY KEY (matricula, site_id)
+        )
+    """,
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'SIX_Sites_geo' AND object_id = OBJECT_ID('Sites'))
+        CREATE SPATIAL INDEX SIX_Sites_geo ON Sites (geo)
+    """,
+]
+
+def ensure_sqlserver_indexes():
+    """Creates missing SQL Server columns, tables and indexes. Safe to call repeatedly."""
+    pymssql = load_pymssql()
+    if not pymssql:
+        return
+    try:
+        conn = pymssql.connect(
+            server=server, user=username, password=password, database=database,
+            login_timeout=3, autocommit=True
+        )
+    except Exception:
+        return
     try:
-        conn = sqlite3.connect(sqlite_path)
-        conn.row_factory = sqlite3.Row
         cur = conn.cursor()
-        
-        # Build mapping
-        cur.execute("SELECT id, matricula, name FROM Users")
-        user_map = {r['id']: (r['matricula'], r['name']) for r in cur.fetchall()}
-        
-        # Update TimeRecords
-        cur.execute("SELECT id, user_id FROM TimeRecords WHERE matricula IS NULL")
-        to_update = cur.fetchall()
-        for r in to_update:
-            if r['user_id'] in user_map:
-                m, n = user_map[r['user_id']]
-                cur.execute("UPDATE TimeRecords SET matricula = ?, user_name = ? WHERE id = ?", (m, n, r['id']))
-        
-        # Update OfflineQueue
-        cur.execute("SELECT id, user_id FROM OfflineQueue WHERE matricula IS NULL")
-        to_update_q = cur.fetchall()
-        for r in to_update_q:
-            if r['user_id'] in user_map:
-                m, n = user_map[r['user_id']]
-                cur.execute("UPDATE OfflineQueue SET matricula = ?, user_name = ? WHERE id = ?", (m, n, r['id']))
-        
+        for sql in SQLSERVER_SCHEMA:
+            try:
+                cur.execute(sql)
+            except Exception as e:
+                log.warning("could not update schema", extra={'error': str(e)})
+        for table, name, cols in SQLSERVER_INDEXES:
+            try:
+                cur.execute(f"""
+                    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{name}' AND object_id = OBJECT_ID('{table}'))
+                        CREATE INDEX {name} ON {table} ({cols})
+                """)
+            except Exception as e:
+                log.warning("could not create index", extra={'index': name, 'error': str(e)})
+    finally:
+        try: conn.close()
+        except: pass
+
+# Timestamps: the local tables keep the legacy text column for compatibility and
+# an indexed integer epoch (seconds, UTC) that is used for ranges, sorting and
+# sync comparisons. These helpers are the only place where the two meet.
+LOCAL_TZ_NAME = os.getenv('APP_TIMEZONE', 'America/Sao_Paulo')
+LOCAL_TZ = pytz.timezone(LOCAL_TZ_NAME)
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def now_local():
+    """Current wall-clock time in LOCAL_TZ as a naive datetime (what SQL Server stores)."""
+    return datetime.datetime.now(LOCAL_TZ).replace(tzinfo=None, microsecond=0)
+
+def parse_ts(value):
+    """Parses a DB/JS timestamp (with or without microseconds) into a naive datetime."""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+
+def to_epoch(value):
+    """Epoch seconds for a datetime/str; naive values are local wall-clock time."""
+    dt = parse_ts(value)
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = LOCAL_TZ.localize(dt)
+    return int(dt.timestamp())
+
+def from_epoch(epoch):
+    """Naive local datetime for epoch seconds."""
+    return datetime.datetime.fromtimestamp(int(epoch), LOCAL_TZ).replace(tzinfo=None)
+
+def format_ts(value):
+    """Canonical 'YYYY-MM-DD HH:MM:SS' text for an epoch, datetime or str."""
+    dt = from_epoch(value) if isinstance(value, int) else parse_ts(value)
+    return dt.strftime(TS_FORMAT) if dt else value
+
+def row_epoch(row):
+    """Epoch of a local row, falling back to its text timestamp before migration."""
+    epoch = rf(row, 'ts_epoch')
+    return epoch if epoch is not None else to_epoch(rf(row, 'timestamp'))
+
+def month_bounds_epoch(dt=None):
+    """(start, end) epoch seconds of the month containing dt (default: now)."""
+    dt = dt or now_local()
+    start = datetime.datetime(dt.year, dt.month, 1)
+    return to_epoch(start), to_epoch(_add_months(start, 1))
+
+def day_start_epoch(date_str, days=0):
+    """Epoch of local midnight of 'YYYY-MM-DD' plus `days` days (None if unparsable)."""
+    try:
+        day = datetime.datetime.strptime(str(date_str)[:10], '%Y-%m-%d')
+    except ValueError:
+        return None
+    return to_epoch(day + datetime.timedelta(days=days))
+
+EPOCH_MIGRATION_BATCH = 5000
+
+def backfill_epoch_timestamps(conn):
+    """
+    Fills ts_epoch/tz for local rows written before the columns existed
+    (LOCAL_MIGRATIONS 2). The conversion depends on LOCAL_TZ, so it runs in
+    Python, in batches, inside the migration's transaction. Returns the rows updated.
+    """
+    tables = ['TimeRecords', 'OfflineQueue'] + archive_tables(conn, refresh=True)
+    total = 0
+    for table in tables:
+        if table.startswith('arch.'):
+            for col, typ in (('ts_epoch', 'INTEGER'), ('tz', 'TEXT')):
+                try:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {typ}")
+                except sqlite3.OperationalError:
+                    pass
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT id, timestamp FROM {table} WHERE ts_epoch IS NULL AND timestamp IS NOT NULL AND id > ? ORDER BY id LIMIT {EPOCH_MIGRATION_BATCH}",
+                (last_id,)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = [(e, LOCAL_TZ_NAME, rid) for rid, e in ((r[0], to_epoch(r[1])) for r in rows) if e is not None]
+            conn.executemany(f"UPDATE {table} SET ts_epoch = ?, tz = ? WHERE id = ?", updates)
+            total += len(updates)
+    return total
+
+# TimeRecords archival: closed months older than the hot window are moved to
+# per-month tables (TimeRecords_YYYYMM). Locally they live in a separate SQLite
+# file attached as `arch`; on SQL Server they sit next to TimeRecords.
+ARCHIVE_KEEP_MONTHS = max(1, int(os.getenv('ARCHIVE_KEEP_MONTHS', '3')))
+ARCHIVE_INTERVAL_HOURS = float(os.getenv('ARCHIVE_INTERVAL_HOURS', '24'))
+ARCHIVE_CHUNK_ROWS = int(os.getenv('ARCHIVE_CHUNK_ROWS', '2000'))
+sqlite_archive_path = os.getenv('SQLITE_ARCHIVE_PATH', os.path.splitext(sqlite_path)[0] + '_archive.db')
+ARCHIVE_COLUMNS = ['id', 'user_id', 'matricula', 'user_name', 'record_type', 'timestamp', 'neighborhood', 'city'] + GEO_COLUMN_NAMES
+# Local-only columns carried into the SQLite archive
+LOCAL_ARCHIVE_COLUMNS = ARCHIVE_COLUMNS + ['ts_epoch', 'tz', 'location_id']
+_archive_months_cache = {}
+_archive_columns_ready = set()
+
+def ensure_archive_columns(conn, tables):
+    """Adds columns created after a month was archived (GEO_COLUMNS, location_id) to its archive table, once per process."""
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    for table in tables:
+        key = ('sqlite' if is_sqlite else 'sqlserver', table)
+        if key in _archive_columns_ready:
+            continue
+        try:
+            cur = conn.cursor()
+            for col, lite, mssql in GEO_COLUMNS + ([('location_id', 'INTEGER', None)] if is_sqlite else []):
+                if is_sqlite:
+                    try:
+                        cur.execute(f"ALTER TABLE {table} ADD COLUMN {col} {lite}")
+                    except sqlite3.OperationalError:
+                        pass  # already there
+                else:
+                    bare = table.split('.')[-1]
+                    cur.execute(f"IF COL_LENGTH('{bare}', '{col}') IS NULL ALTER TABLE {bare} ADD {col} {mssql} NULL")
+            if not is_sqlite and get_ph(conn) == '?':
+                conn.commit()
+            _archive_columns_ready.add(key)
+        except Exception as e:
+            log.warning("could not update archive table", extra={'table': table, 'error': str(e)})
+
+def archive_table(month):
+    return f"TimeRecords_{month}"
+
+def _add_months(dt, n):
+    y, m = divmod(dt.year * 12 + dt.month - 1 + n, 12)
+    return datetime.datetime(y, m + 1, 1)
+
+def archive_cutoff():
+    """First instant that stays in the hot table (start of the oldest kept month)."""
+    now = now_local()
+    return _add_months(datetime.datetime(now.year, now.month, 1), -(ARCHIVE_KEEP_MONTHS - 1))
+
+def attach_archive(conn):
+    """Attaches the local archive file to a SQLite connection as `arch`."""
+    try:
+        conn.execute("ATTACH DATABASE ? AS arch", (sqlite_archive_path,))
+    except sqlite3.OperationalError:
+        pass  # already attached
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS arch.ArchivedMonths (
+            month TEXT PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            row_count INTEGER DEFAULT 0,
+            archived_at DATETIME
+        )
+    """)
+
+def list_archived_months(conn, refresh=False):
+    """Returns the archived months ('YYYYMM', ascending) for the backend of `conn`."""
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    key = 'sqlite' if is_sqlite else 'sqlserver'
+    cached = _archive_months_cache.get(key)
+    if cached and not refresh and time.time() - cached[0] < 60:
+        if is_sqlite and cached[1]:
+            attach_archive(conn)
+        return cached[1]
+    months = []
+    try:
+        cur = conn.cursor()
+        if is_sqlite:
+            if os.path.exists(sqlite_archive_path):
+                attach_archive(conn)
+                cur.execute("SELECT month FROM arch.ArchivedMonths ORDER BY month")
+                months = [rf(r, 'month') if isinstance(r, sqlite3.Row) else r[0] for r in cur.fetchall()]
+        else:
+            cur.execute("IF OBJECT_ID('ArchivedMonths') IS NOT NULL SELECT month FROM ArchivedMonths WITH (NOLOCK) ORDER BY month")
+            try:
+                months = [str(rf(r, 'month') if isinstance(r, dict) else r[0]).strip() for r in cur.fetchall()]
+            except Exception:
+                months = []  # no result set when the registry does not exist yet
+    except Exception as e:
+        log.warning("could not list archived months", extra={'error': str(e)})
+    ensure_archive_columns(conn, [("arch." if is_sqlite else "") + archive_table(m) for m in months])
+    _archive_months_cache[key] = (time.time(), months)
+    return months
+
+def archive_tables(conn, refresh=False):
+    """Qualified names of every archive table for the backend of `conn`."""
+    prefix = "arch." if isinstance(conn, sqlite3.Connection) else ""
+    return [prefix + archive_table(m) for m in list_archived_months(conn, refresh)]
+
+def _month_key(date_str):
+    try:
+        d = datetime.datetime.strptime(str(date_str)[:10], '%Y-%m-%d')
+        return f"{d.year:04d}{d.month:02d}"
+    except Exception:
+        return None
+
+def time_records_from(conn, start_date=None, end_date=None, alias='t'):
+    """
+    FROM clause for TimeRecords over [start_date, end_date] ('YYYY-MM-DD',
+    either may be None). Archive tables are UNIONed in only when the range
+    reaches archived months; otherwise this is just the hot table.
+    """
+    lo, hi = _month_key(start_date) if start_date else None, _month_key(end_date) if end_date else None
+    needed = [m for m in list_archived_months(conn) if (not lo or m >= lo) and (not hi or m <= hi)]
+    if not needed:
+        return f"TimeRecords {alias}"
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    prefix = "arch." if is_sqlite else ""
+    cols = ', '.join(LOCAL_ARCHIVE_COLUMNS if is_sqlite else ARCHIVE_COLUMNS)
+    parts = [f"SELECT {cols} FROM TimeRecords"] + [f"SELECT {cols} FROM {prefix}{archive_table(m)}" for m in needed]
+    return f"({' UNION ALL '.join(parts)}) {alias}"
+
+def _archive_month_sqlite(conn, month, start, end):
+    table = archive_table(month)
+    cols = ', '.join(LOCAL_ARCHIVE_COLUMNS)
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS arch.{table} (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            matricula TEXT,
+            user_name TEXT,
+            record_type TEXT NOT NULL,
+            timestamp DATETIME,
+            neighborhood TEXT,
+            city TEXT,
+            ts_epoch INTEGER,
+            tz TEXT
+        )
+    """)
+    ensure_archive_columns(conn, [f"arch.{table}"])
+    conn.execute(f"CREATE INDEX IF NOT EXISTS arch.idx_{table}_matricula ON {table} (matricula, ts_epoch)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS arch.idx_{table}_user_id ON {table} (user_id)")
+    chunk = f"SELECT id FROM TimeRecords WHERE timestamp >= ? AND timestamp < ? ORDER BY id LIMIT {ARCHIVE_CHUNK_ROWS}"
+    moved = 0
+    while True:
+        # Copy and delete the same chunk in one transaction (spans both files).
+        # Rows already archived by an interrupted run are ignored by the copy,
+        # so progress is counted on the DELETE.
+        conn.execute(f"INSERT OR IGNORE INTO arch.{table} ({cols}) SELECT {cols} FROM TimeRecords WHERE id IN ({chunk})", (start, end))
+        n = conn.execute(f"DELETE FROM TimeRecords WHERE id IN ({chunk})", (start, end)).rowcount or 0
         conn.commit()
-        conn.close()
-        print("DEBUG: Local data migration complete.")
+        moved += n
+        if n < ARCHIVE_CHUNK_ROWS:
+            break
+        time.sleep(DELETE_CHUNK_PAUSE)
+    conn.execute(f"""
+        INSERT INTO arch.ArchivedMonths (month, table_name, row_count, archived_at)
+        VALUES (?, ?, (SELECT COUNT(*) FROM arch.{table}), ?)
+        ON CONFLICT(month) DO UPDATE SET row_count = excluded.row_count, archived_at = excluded.archived_at
+    """, (month, table, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    conn.commit()
+    return moved
+
+def _archive_month_sqlserver(conn, month, start, end):
+    table = archive_table(month)
+    cols = ', '.join(ARCHIVE_COLUMNS)
+    ph = get_ph(conn)
+    cur = conn.cursor()
+    # CAST strips the IDENTITY property so archived ids are kept as they are
+    select_cols = ', '.join('CAST(id AS INT) AS id' if c == 'id' else c for c in ARCHIVE_COLUMNS)
+    cur.execute(f"""
+        IF OBJECT_ID('{table}') IS NULL
+        BEGIN
+            SELECT TOP 0 {select_cols} INTO {table} FROM TimeRecords;
+            CREATE INDEX IX_{table}_matricula ON {table} (matricula, timestamp);
+            CREATE INDEX IX_{table}_user_id ON {table} (user_id);
+        END
+    """)
+    ensure_archive_columns(conn, [table])
+    cur.execute("""
+        IF OBJECT_ID('ArchivedMonths') IS NULL
+            CREATE TABLE ArchivedMonths (
+                month CHAR(6) PRIMARY KEY,
+                table_name NVARCHAR(64) NOT NULL,
+                row_count INT DEFAULT 0,
+                archived_at DATETIME
+            )
+    """)
+    moved = 0
+    while True:
+        # Each DELETE ... OUTPUT INTO is atomic and short (autocommit)
+        cur.execute(f"""
+            DELETE TOP ({ARCHIVE_CHUNK_ROWS}) FROM TimeRecords
+            OUTPUT {', '.join('DELETED.' + c for c in ARCHIVE_COLUMNS)} INTO {table} ({cols})
+            WHERE timestamp >= {ph} AND timestamp < {ph}
+        """, (start, end))
+        if ph == '?':
+            conn.commit()
+        n = cur.rowcount or 0
+        moved += n
+        if n < ARCHIVE_CHUNK_ROWS:
+            break
+        time.sleep(DELETE_CHUNK_PAUSE)
+    cur.execute(f"""
+        IF EXISTS (SELECT 1 FROM ArchivedMonths WHERE month = {ph})
+            UPDATE ArchivedMonths SET row_count = row_count + {ph}, archived_at = GETDATE() WHERE month = {ph}
+        ELSE
+            INSERT INTO ArchivedMonths (month, table_name, row_count, archived_at) VALUES ({ph}, {ph}, {ph}, GETDATE())
+    """, (month, moved, month, month, table, moved))
+    if ph == '?':
+        conn.commit()
+    return moved
+
+def _archive_backend(conn, progress, label):
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    cutoff = archive_cutoff().strftime('%Y-%m-%d %H:%M:%S')
+    cur = conn.cursor()
+    if is_sqlite:
+        attach_archive(conn)
+        cur.execute("SELECT DISTINCT substr(timestamp, 1, 7) FROM TimeRecords WHERE timestamp < ?", (cutoff,))
+        months = sorted(str(r[0]).replace('-', '') for r in cur.fetchall() if r[0])
+    else:
+        ph = get_ph(conn)
+        cur.execute(f"SELECT DISTINCT YEAR(timestamp) * 100 + MONTH(timestamp) AS ym FROM TimeRecords WITH (NOLOCK) WHERE timestamp < {ph}", (cutoff,))
+        months = sorted(str(rf(r, 'ym') if isinstance(r, dict) else r[0]) for r in cur.fetchall())
+    for month in months:
+        if not _month_key(f"{month[:4]}-{month[4:]}-01"):
+            continue
+        start = f"{month[:4]}-{month[4:]}-01 00:00:00"
+        end = _add_months(datetime.datetime(int(month[:4]), int(month[4:]), 1), 1).strftime('%Y-%m-%d %H:%M:%S')
+        if is_sqlite:
+            moved = _archive_month_sqlite(conn, month, start, end)
+        else:
+            moved = _archive_month_sqlserver(conn, month, start, end)
+        progress[f"{label}_{month}"] = moved
+        log.info("archived month", extra={'backend': label, 'month': month, 'rows': moved})
+    list_archived_months(conn, refresh=True)
+
+def archive_closed_months(job=None):
+    """Moves closed months out of the hot TimeRecords table on both backends."""
+    progress = job['progress'] if job else {}
+    sconn = connect_local()
+    try:
+        ensure_sqlite_schema(sconn)
+        _archive_backend(sconn, progress, 'local')
+    finally:
+        sconn.close()
+    if sql_online():
+        conn = get_db_connection()
+        try:
+            if not isinstance(conn, sqlite3.Connection):
+                _archive_backend(conn, progress, 'sqlserver')
+        finally:
+            try: conn.close()
+            except: pass
+    return progress
+
+def start_archiver():
+    """Runs archive_closed_months periodically (ARCHIVE_INTERVAL_HOURS=0 disables)."""
+    if ARCHIVE_INTERVAL_HOURS <= 0:
+        return
+    def loop():
+        time.sleep(60)  # let the health check settle first
+        while True:
+            try:
+                archive_closed_months()
+            except Exception as e:
+                log.error("archive error", extra={'error': str(e)})
+            time.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
+    threading.Thread(target=loop, daemon=True).start()
+
+# Versioned local migrations: each runs once, as set-based statements inside
+# one transaction, and is recorded in SchemaVersion. A step may also be a
+# callable taking the connection (for conversions SQL cannot express); it
+# returns the number of rows it changed. Append new entries with
+# the next version number; never edit or renumber applied ones.
+LOCAL_MIGRATIONS = [
+    (1, 'denormalize matricula/user_name on TimeRecords and OfflineQueue', [
+        f"""
+        UPDATE {table} SET
+            matricula = (SELECT u.matricula FROM Users u WHERE u.id = {table}.user_id),
+            user_name = (SELECT u.name FROM Users u WHERE u.id = {table}.user_id)
+        WHERE matricula IS NULL AND user_id IN (SELECT id FROM Users)
+        """ for table in ('TimeRecords', 'OfflineQueue')
+    ]),
+    (2, 'backfill ts_epoch/tz on TimeRecords, OfflineQueue and the archive tables', [
+        backfill_epoch_timestamps,
+    ]),
+    (3, 'dictionary-encode neighborhood/city (Locations) on TimeRecords and OfflineQueue', [
+        f"""
+        INSERT OR IGNORE INTO Locations (neighborhood, city)
+        SELECT DISTINCT COALESCE(neighborhood, ''), COALESCE(city, '') FROM {table}
+        WHERE location_id IS NULL AND (neighborhood IS NOT NULL OR city IS NOT NULL)
+        """ for table in ('TimeRecords', 'OfflineQueue')
+    ] + [
+        f"""
+        UPDATE {table} SET
+            location_id = (SELECT l.id FROM Locations l
+                           WHERE l.neighborhood = COALESCE({table}.neighborhood, '') AND l.city = COALESCE({table}.city, '')),
+            neighborhood = NULL, city = NULL
+        WHERE location_id IS NULL AND (neighborhood IS NOT NULL OR city IS NOT NULL)
+        """ for table in ('TimeRecords', 'OfflineQueue')
+    ]),
+]
+
+def applied_migrations(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS SchemaVersion (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL,
+            duration_ms REAL
+        )
+    """)
+    return {r[0] for r in conn.execute("SELECT version FROM SchemaVersion")}
+
+def migrate_local_data():
+    """Applies the pending LOCAL_MIGRATIONS to local.db. Returns the versions applied."""
+    done = []
+    try:
+        conn = connect_local()
+        try:
+            ensure_sqlite_schema(conn)
+            if all(v in applied_migrations(conn) for v, _, _ in LOCAL_MIGRATIONS):
+                conn.commit()
+                return done
+            if os.path.exists(sqlite_archive_path):
+                attach_archive(conn)  # ATTACH is not allowed inside the transaction
+                conn.commit()
+            for version, name, statements in LOCAL_MIGRATIONS:
+                t0 = time.perf_counter()
+                # IMMEDIATE: a second process starting at the same time waits here, then skips
+                conn.execute("BEGIN IMMEDIATE")
+                if version in applied_migrations(conn):
+                    conn.rollback()
+                    continue
+                rows = 0
+                for sql in statements:
+                    rows += sql(conn) if callable(sql) else max(conn.execute(sql).rowcount, 0)
+                elapsed = (time.perf_counter() - t0) * 1000
+                conn.execute("INSERT INTO SchemaVersion (version, name, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                             (version, name, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), round(elapsed, 2)))
+                conn.commit()
+                done.append(version)
+                log.info("local migration applied", extra={'version': version, 'migration': name, 'rows': rows,
+                                                           'duration_ms': round(elapsed, 2)})
+        finally:
+            conn.close()
     except Exception as e:
-        print(f"DEBUG: Migration error: {e}")
-    # The original instruction had conn.commit() here, but it should be inside the try block before conn.close()
-    # or removed if the previous commit covers it. Given the structure, it's likely a copy-paste error.
-    # I'll remove the redundant conn.commit() here as it's already done inside the try block.
+        log.error("migration error", extra={'error': str(e)})
+    return done
 
 def ensure_default_admin():
     try:
         admin_mat = os.getenv('ADMIN_MATRICULA', 'admin')
         admin_pass = os.getenv('ADMIN_PASSWORD', 'admin')
         admin_name = os.getenv('ADMIN_NAME', 'Administrador')
-        sconn = sqlite3.connect(sqlite_path)
+        sconn = connect_local()
         sconn.row_factory = sqlite3.Row
         ensure_sqlite_schema(sconn)
         scur = sconn.cursor()
@@ -234,14 +1443,223 @@ def ensure_default_admin():
     except Exception:
         pass
 
-def get_db_connection():
-    if DB_ONLINE:
+# Optional per-request deadline (set by the ASGI handlers). DB helpers check it
+# so a request that is out of time skips slow SQL Server connects and falls
+# back to SQLite instead of piling up behind a flapping server.
+SQL_CONNECT_TIMEOUT = 3
+_request_ctx = threading.local()
+
+class DeadlineExceeded(Exception):
+    pass
+
+def set_request_deadline(deadline):
+    """Sets (or clears, with None) the absolute time.monotonic() deadline for this thread."""
+    _request_ctx.deadline = deadline
+
+def deadline_remaining():
+    """Seconds left for the current request, or None when there is no deadline."""
+    deadline = getattr(_request_ctx, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+# Per-request phase tracing. When TRACE_REQUESTS is on, every DB connect,
+# query and commit (plus schema checks and user lookups) made by a request is
+# summed per phase; requests slower than TRACE_SLOW_MS are logged with the full
+# breakdown, and TRACE_SERVER_TIMING adds it as a Server-Timing header.
+TRACE_REQUESTS = os.getenv('TRACE_REQUESTS', 'false').lower() == 'true'
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '1000'))
+TRACE_SERVER_TIMING = os.getenv('TRACE_SERVER_TIMING', 'false').lower() == 'true'
+
+def start_trace():
+    _request_ctx.trace = {} if TRACE_REQUESTS else None
+    _request_ctx.trace_start = time.perf_counter()
+
+def finish_trace():
+    """Stops tracing on this thread. Returns (total_ms, {phase: (ms, count)}) or None."""
+    trace = getattr(_request_ctx, 'trace', None)
+    _request_ctx.trace = None
+    if trace is None:
+        return None
+    total = (time.perf_counter() - _request_ctx.trace_start) * 1000
+    return total, {name: (round(v[0] * 1000, 2), v[1]) for name, v in trace.items()}
+
+def add_span(name, elapsed):
+    trace = getattr(_request_ctx, 'trace', None)
+    if trace is not None:
+        acc = trace.get(name)
+        if acc is None:
+            trace[name] = [elapsed, 1]
+        else:
+            acc[0] += elapsed
+            acc[1] += 1
+
+class trace_span:
+    """with trace_span('phase'): ... adds the block's duration to the current request trace."""
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_span(self.name, time.perf_counter() - self.t0)
+        return False
+
+def report_trace(result, method, path, status):
+    """Logs a finished trace when it is slow; returns the Server-Timing value (or None)."""
+    if result is None:
+        return None
+    total, phases = result
+    if total >= TRACE_SLOW_MS:
+        log.warning("slow request", extra={'method': method, 'path': path, 'status': status,
+                                           'duration_ms': round(total, 2), 'phases': phases})
+    if not TRACE_SERVER_TIMING:
+        return None
+    parts = [f"{name.replace(':', '-')};dur={ms}" for name, (ms, _) in phases.items()]
+    parts.append(f"total;dur={total:.2f}")
+    return ', '.join(parts)
+
+def sql_connect_allowed():
+    """True when SQL Server is up and the request can afford a connect timeout."""
+    remaining = deadline_remaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded()
+    return sql_online() and (remaining is None or remaining > SQL_CONNECT_TIMEOUT)
+
+DB_TIMING_METRICS = {
+    'connect': 'ponto_db_connect_seconds',
+    'query': 'ponto_db_query_seconds',
+    'commit': 'ponto_db_commit_seconds',
+}
+
+def db_timing(kind, backend, elapsed):
+    metrics.observe(DB_TIMING_METRICS[kind], elapsed, backend=backend)
+    add_span(f"db_{kind}:{backend}", elapsed)
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            db_timing('query', 'sqlite', time.perf_counter() - t0)
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            db_timing('query', 'sqlite', time.perf_counter() - t0)
+
+class TimedSQLiteConnection(sqlite3.Connection):
+    """sqlite3 connection whose statements are timed; still an sqlite3.Connection."""
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            db_timing('commit', 'sqlite', time.perf_counter() - t0)
+
+def connect_local(path=None):
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(path or sqlite_path, factory=TimedSQLiteConnection)
+    db_timing('connect', 'sqlite', time.perf_counter() - t0)
+    return conn
+
+class InstrumentedCursor:
+    def __init__(self, cursor, backend):
+        self._cursor = cursor
+        self._backend = backend
+
+    def execute(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        finally:
+            db_timing('query', self._backend, time.perf_counter() - t0)
+
+    def executemany(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return self._cursor.executemany(*args, **kwargs)
+        finally:
+            db_timing('query', self._backend, time.perf_counter() - t0)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+        return False
+
+class InstrumentedConnection:
+    """Wraps a pymssql/pyodbc connection to time statements; `backend` names the driver."""
+    def __init__(self, conn, backend):
+        self._conn = conn
+        self.backend = backend
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self.backend)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try:
+            return self._conn.commit()
+        finally:
+            db_timing('commit', self.backend, time.perf_counter() - t0)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._conn.close()
+        return False
+
+def timed_connect(backend, connect, *args, **kwargs):
+    """Opens a SQL Server connection through `connect`, recording its latency or failure."""
+    t0 = time.perf_counter()
+    try:
+        conn = connect(*args, **kwargs)
+    except Exception:
+        metrics.inc('ponto_db_connect_failures_total', backend=backend)
+        add_span(f"db_connect_failed:{backend}", time.perf_counter() - t0)
+        raise
+    db_timing('connect', backend, time.perf_counter() - t0)
+    return InstrumentedConnection(conn, backend)
+
+def get_db_connection():
+    if not sql_connect_allowed():
+        metrics.inc('ponto_db_fallback_total', reason='offline' if not sql_online() else 'deadline')
+    else:
         # Attempt SQL Server (pymssql)
         try:
+            pymssql = load_pymssql()
             if pymssql:
-                conn = pymssql.connect(
+                conn = timed_connect('pymssql', pymssql.connect,
                     server=server, user=username, password=password, database=database, 
-                    as_dict=True, autocommit=True, login_timeout=3
+                    as_dict=True, autocommit=True, login_timeout=SQL_CONNECT_TIMEOUT
                 )
                 try:
                     with conn.cursor() as cur:
@@ -258,7 +1676,7 @@ def get_db_connection():
             drivers = [d for d in pyodbc.drivers() if 'SQL Server' in d]
             driver = drivers[0] if drivers else 'ODBC Driver 17 for SQL Server'
             conn_str = f'DRIVER={{{driver}}};SERVER={server};DATABASE={database};UID={username};PWD={password};TrustServerCertificate=yes;Connection Timeout=3'
-            conn = pyodbc.connect(conn_str, autocommit=True)
+            conn = timed_connect('pyodbc', pyodbc.connect, conn_str, autocommit=True)
             try:
                 cur = conn.cursor()
                 cur.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
@@ -267,22 +1685,25 @@ def get_db_connection():
             return conn
         except Exception:
             pass
+        metrics.inc('ponto_db_fallback_total', reason='connect_failed')
 
     # Fallback to SQLite
-    conn = sqlite3.connect(sqlite_path)
+    conn = connect_local()
     conn.row_factory = sqlite3.Row
     ensure_sqlite_schema(conn)
     return conn
 
 
 def sql_online():
+    if DB_STATE_FILE and os.getpid() != _supervisor_pid:
+        return _read_db_state()
     return DB_ONLINE
 
 def get_ph(conn):
     """Returns the correct SQL placeholder based on the connection type."""
     if isinstance(conn, sqlite3.Connection):
         return '?'
-    if 'pymssql' in str(type(conn)):
+    if getattr(conn, 'backend', None) == 'pymssql' or 'pymssql' in str(type(conn)):
         return '%s'
     return '?'
 
@@ -290,30 +1711,32 @@ def get_user_info_by_id(user_id, conn):
     """Returns (matricula, name) for a given user_id using the provided connection."""
     ph = get_ph(conn)
     is_sqlite = isinstance(conn, sqlite3.Connection)
-    try:
-        cur = conn.cursor()
-        nolock = "" if is_sqlite else "WITH (NOLOCK)"
-        cur.execute(f"SELECT matricula, name FROM Users {nolock} WHERE id = {ph}", (user_id,))
-        row = cur.fetchone()
-        if row:
-            return rf(row, 'matricula'), rf(row, 'name')
-    except:
-        pass
+    with trace_span('user_lookup'):
+        try:
+            cur = conn.cursor()
+            nolock = "" if is_sqlite else "WITH (NOLOCK)"
+            cur.execute(f"SELECT matricula, name FROM Users {nolock} WHERE id = {ph}", (user_id,))
+            row = cur.fetchone()
+            if row:
+                return rf(row, 'matricula'), rf(row, 'name')
+        except:
+            pass
     return None, None
 
 def get_user_info_by_matricula(matricula, conn):
     """Returns (id, name) for a given matricula using the provided connection."""
     ph = get_ph(conn)
     is_sqlite = isinstance(conn, sqlite3.Connection)
-    try:
-        cur = conn.cursor()
-        nolock = "" if is_sqlite else "WITH (NOLOCK)"
-        cur.execute(f"SELECT id, name FROM Users {nolock} WHERE matricula = {ph}", (matricula,))
-        row = cur.fetchone()
-        if row:
-            return rf(row, 'id'), rf(row, 'name')
-    except:
-        pass
+    with trace_span('user_lookup'):
+        try:
+            cur = conn.cursor()
+            nolock = "" if is_sqlite else "WITH (NOLOCK)"
+            cur.execute(f"SELECT id, name FROM Users {nolock} WHERE matricula = {ph}", (matricula,))
+            row = cur.fetchone()
+            if row:
+                return rf(row, 'id'), rf(row, 'name')
+        except:
+            pass
     return None, None
 
 
@@ -328,28 +1751,642 @@ def rf(row, name):
         except AttributeError:
             return None
 
+# Generation counters of the in-process caches, shared through local.db in
+# multi-process mode (DB_STATE_FILE): a process that changes users bumps the
+# counter and the other workers rebuild on their next lookup.
+SHARED_GENERATION_CHECK = 1.0  # seconds between reads of a shared counter
+
+def bump_generation(name):
+    if not DB_STATE_FILE:
+        return
+    try:
+        conn = connect_local()
+        try:
+            conn.execute("INSERT OR IGNORE INTO CacheGenerations (name, generation) VALUES (?, 0)", (name,))
+            conn.execute("UPDATE CacheGenerations SET generation = generation + 1 WHERE name = ?", (name,))
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        log.warning("could not bump cache generation", extra={'cache': name, 'error': str(e)})
+
+def read_generation(name):
+    if not DB_STATE_FILE:
+        return 0
+    try:
+        conn = connect_local()
+        try:
+            row = conn.execute("SELECT generation FROM CacheGenerations WHERE name = ?", (name,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else 0
+    except Exception:
+        return None  # unreadable: keep the current build
+
+class UserPrefixIndex:
+    """In-memory sorted index of users for admin autocomplete.
+
+    Keeps two sorted lists of (lowercased key, id) for matricula and name so a
+    prefix lookup is a bisect instead of a table scan. Searches never wait for
+    the database: once built, a stale index (invalidate() here, older than
+    `ttl`, or a refresh check due) answers from its current lists and starts
+    at most one background refresh. The refresh reads the shared 'users'
+    generation (bumped by other workers) and rebuilds when anything changed;
+    only the very first search builds inline.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.users = {}
+        self.by_matricula = []
+        self.by_name = []
+        self.built_at = 0
+        self.version = 1
+        self.built_version = 0
+        self.shared = 0
+        self.shared_checked = 0
+        self.refreshing = False
+
+    def invalidate(self, shared=True):
+        """Marks the index stale; shared=False for process-local causes (DB state changes)."""
+        self.version += 1
+        if shared:
+            bump_generation('users')
+
+    def _due(self):
+        # in-memory checks only: this runs on every keystroke
+        now = time.time()
+        return (self.built_version != (self.version, self.shared) or now - self.built_at > self.ttl
+                or now - self.shared_checked >= SHARED_GENERATION_CHECK)
+
+    def _refresh(self):
+        with self.build_lock:
+            generation = read_generation('users')
+            if generation is not None:
+                self.shared = generation
+            self.shared_checked = time.time()
+            if self.built_version != (self.version, self.shared) or time.time() - self.built_at > self.ttl:
+                self._build()
+
+    def _refresh_in_background(self):
+        try:
+            self._refresh()
+        except Exception as e:
+            log.warning("user index refresh failed", extra={'error': str(e)})
+        finally:
+            self.refreshing = False
+
+    def refresh_async(self):
+        """Starts a background refresh unless one is already running."""
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._refresh_in_background, name='user-index', daemon=True).start()
+
+    def _build(self):
+        version = (self.version, self.shared)
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            nolock = "" if isinstance(conn, sqlite3.Connection) else "WITH (NOLOCK)"
+            cur.execute(f"SELECT id, matricula, name, role FROM Users {nolock}")
+            rows = cur.fetchall()
+        finally:
+            try: conn.close()
+            except: pass
+        users = {}
+        by_mat = []
+        by_name = []
+        for r in rows:
+            uid = rf(r, 'id')
+            mat = rf(r, 'matricula') or ''
+            name = rf(r, 'name') or ''
+            users[uid] = {'id': uid, 'matricula': mat, 'name': name, 'role': rf(r, 'role')}
+            by_mat.append((mat.lower(), uid))
+            by_name.append((name.lower(), uid))
+        by_mat.sort()
+        by_name.sort()
+        with self.lock:
+            self.users, self.by_matricula, self.by_name = users, by_mat, by_name
+            self.built_at = time.time()
+            self.built_version = version
+
+    def _scan(self, keys, prefix, limit, out):
+        i = bisect.bisect_left(keys, (prefix,))
+        while i < len(keys) and len(out) < limit and keys[i][0].startswith(prefix):
+            out.setdefault(keys[i][1], None)
+            i += 1
+
+    def search(self, prefix, limit=10, role_filter=None):
+        if not self.built_at:
+            self._refresh()  # nothing to answer from yet
+        elif self._due():
+            self.refresh_async()
+        with self.lock:
+            prefix = (prefix or '').strip().lower()
+            # Over-fetch when filtering by role, matches are discarded afterwards
+            cap = limit if not role_filter else limit * 5
+            found = {}
+            self._scan(self.by_matricula, prefix, cap, found)
+            self._scan(self.by_name, prefix, cap * 2, found)
+            results = []
+            for uid in found:
+                u = self.users.get(uid)
+                if not u or (role_filter and u['role'] != role_filter):
+                    continue
+                results.append(u)
+                if len(results) >= limit:
+                    break
+            return results
+
+user_index = UserPrefixIndex()
+
+# Presence board: the last punch of the day per matricula, kept in memory and
+# updated on every punch instead of re-querying the day's records. In
+# multi-process mode (DB_STATE_FILE) punches are also appended to the local
+# PresenceFeed table, which every process tails by id, so each index sees the
+# punches handled by the others.
+PRESENCE_FEED = bool(DB_STATE_FILE)
+PRESENCE_EVENT_BUFFER = 1000  # recent punch events kept for stream catch-up (?since=)
+# EventSource cannot send an Authorization header, so the stream URL carries a
+# ticket instead: scoped to the stream, valid for a few seconds and redeemable
+# once, so a copy left in an access or ngrok log is useless.
+PRESENCE_STREAM_TOKEN_TTL = 30  # seconds
+
+def redeem_stream_ticket(jti, expires_at):
+    """Marks a stream ticket as used (in local.db, shared by the workers). False if it was used before."""
+    conn = connect_local()
+    try:
+        conn.execute("DELETE FROM StreamTickets WHERE expires_at < ?", (time.time(),))
+        conn.execute("INSERT INTO StreamTickets (jti, expires_at) VALUES (?, ?)", (jti, expires_at))
+        conn.commit()
+        return True
+    except sqlite3.IntegrityError:
+        return False
+    finally:
+        conn.close()
+
+RECORD_TYPES = ('Entrada', 'Saída Almoço', 'Volta Almoço', 'Saída')
+
+def presence_status(record_type):
+    """'in', 'break' or 'out' for a record_type (one of RECORD_TYPES)."""
+    kind = (record_type or '').strip().lower().replace('í', 'i').replace('ç', 'c')
+    if kind.startswith('saida'):
+        return 'break' if 'almoco' in kind else 'out'
+    return 'in'
+
+class PresenceIndex:
+    """Who is in now: the day's last punch per matricula.
+
+    Built lazily from today's records (SQL Server or SQLite, plus the
+    OfflineQueue) after invalidate(), at midnight or once older than `ttl`;
+    between builds it only applies new punches. The build queries run outside
+    `lock` and the result is swapped in; punches recorded meanwhile are
+    re-applied on top. Subscribers (SSE streams) are woken on every applied punch.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()  # one build at a time; held without `lock`
+        self.entries = {}
+        self.events = collections.deque(maxlen=PRESENCE_EVENT_BUFFER)
+        self.seq = 0
+        self.day = None
+        self.built_at = 0
+        self.dirty = True
+        self.generation = 0  # bumped by invalidate(), so one during a build is not lost
+        self.building = False
+        self.pending = []  # punches recorded while a build is running
+        self._listeners = set()
+        self._kick = threading.Event()
+        self._tailing = False
+
+    def invalidate(self):
+        self.generation += 1
+        self.dirty = True
+
+    def _today_start(self):
+        return now_local().replace(hour=0, minute=0, second=0)
+
+    def _apply(self, entry, entries=None):
+        entries = self.entries if entries is None else entries
+        current = entries.get(entry['matricula'])
+        if current and current['timestamp'] > entry['timestamp']:
+            return False
+        entries[entry['matricula']] = entry
+        return True
+
+    def _load(self, start):
+        """Today's last punch per matricula, read from the tables. Returns (entries, feed seq)."""
+        start_ts = format_ts(start)
+        rows = []
+        feed_seq = self._feed_max_id() if PRESENCE_FEED else None
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            is_sqlite = isinstance(conn, sqlite3.Connection)
+            nolock = "" if is_sqlite else "WITH (NOLOCK)"
+            text_cols, joins = punch_text_columns(conn)
+            cur.execute(f"""
+                SELECT t.matricula, t.record_type, t.timestamp, {text_cols}
+                FROM TimeRecords t {nolock} {joins} WHERE t.timestamp >= {get_ph(conn)}
+            """, (start_ts if is_sqlite else start,))
+            rows.extend(cur.fetchall())
+        finally:
+            try: conn.close()
+            except: pass
+        lconn = connect_local()
+        lconn.row_factory = sqlite3.Row
+        try:
+            ensure_sqlite_schema(lconn)
+            text_cols, joins = punch_text_columns(lconn)
+            rows.extend(lconn.execute(f"""
+                SELECT t.matricula, t.record_type, t.timestamp, {text_cols}
+                FROM OfflineQueue t {joins} WHERE t.ts_epoch >= ?
+            """, (to_epoch(start),)).fetchall())
+            if PRESENCE_FEED:
+                lconn.execute("DELETE FROM PresenceFeed WHERE timestamp < ?", (start_ts,))
+                lconn.commit()
+        finally:
+            lconn.close()
+        entries = {}
+        for r in rows:
+            mat = rf(r, 'matricula')
+            if mat:
+                self._apply(self._entry(mat, rf(r, 'user_name'), rf(r, 'record_type'), rf(r, 'timestamp'),
+                                        rf(r, 'neighborhood'), rf(r, 'city')), entries)
+        return entries, feed_seq
+
+    def _stale(self):
+        return self.dirty or self.day != now_local().date() or time.time() - self.built_at > self.ttl
+
+    def _ensure(self):
+        """Rebuilds the board when stale (call without `lock`). Returns True if it rebuilt."""
+        if not self._stale():
+            return False
+        with self.build_lock:
+            if not self._stale():
+                return False
+            start = self._today_start()
+            with self.lock:
+                self.building = True
+                self.pending = []
+                generation = self.generation
+            try:
+                entries, feed_seq = self._load(start)
+            except Exception:
+                with self.lock:
+                    self.building = False
+                    self.pending = []
+                raise
+            with self.lock:
+                for entry in self.pending:
+                    self._apply(entry, entries)
+                self.entries = entries
+                self.pending = []
+                self.building = False
+                # a new seq with an empty buffer sends every open stream a reset
+                self.seq = feed_seq if PRESENCE_FEED else self.seq + 1
+                self.events.clear()
+                self.day = start.date()
+                self.built_at = time.time()
+                self.dirty = self.generation != generation
+        return True
+
+    def _entry(self, matricula, name, record_type, timestamp, neighborhood, city):
+        return {'matricula': matricula, 'name': name, 'record_type': record_type,
+                'timestamp': format_ts(timestamp), 'neighborhood': neighborhood, 'city': city,
+                'status': presence_status(record_type)}
+
+    def _publish(self, entry, seq):
+        """Applies a punch and queues it for the streams (lock held). Returns True if it changed the board."""
+        self.seq = max(self.seq, seq)
+        if entry['timestamp'] < format_ts(self._today_start()) or not self._apply(entry):
+            return False
+        self.events.append(dict(entry, seq=seq))
+        return True
+
+    def _wake(self):
+        for callback in list(self._listeners):
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def _feed_max_id(self):
+        conn = connect_local()
+        try:
+            ensure_sqlite_schema(conn)
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM PresenceFeed").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _catch_up(self):
+        """Applies PresenceFeed rows written since the last look (lock held). Returns True on changes."""
+        conn = connect_local()
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute("""
+                SELECT id, matricula, user_name, record_type, timestamp, neighborhood, city
+                FROM PresenceFeed WHERE id > ? ORDER BY id
+            """, (self.seq,)).fetchall()
+        finally:
+            conn.close()
+        changed = False
+        for r in rows:
+            entry = self._entry(r['matricula'], r['user_name'], r['record_type'], r['timestamp'],
+                                r['neighborhood'], r['city'])
+            changed = self._publish(entry, r['id']) or changed
+        return changed
+
+    def record(self, matricula, name, record_type, timestamp, neighborhood, city):
+        """Called for every stored punch."""
+        if PRESENCE_FEED:
+            conn = connect_local()
+            try:
+                conn.execute("""
+                    INSERT INTO PresenceFeed (matricula, user_name, record_type, timestamp, neighborhood, city)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (matricula, name, record_type, format_ts(timestamp), neighborhood, city))
+                conn.commit()
+            finally:
+                conn.close()
+            self._kick.set()
+            return
+        entry = self._entry(matricula, name, record_type, timestamp, neighborhood, city)
+        with self.lock:
+            if self.building:
+                self.pending.append(entry)  # the running build may have read the tables before it
+                return
+            if self.dirty:
+                return  # the next build reads it from the tables
+            changed = self._publish(entry, self.seq + 1)
+        if changed:
+            self._wake()
+
+    def snapshot(self, status=None):
+        self._ensure()
+        with self.lock:
+            if PRESENCE_FEED:
+                self._catch_up()
+            people = sorted((e for e in self.entries.values() if not status or e['status'] == status),
+                            key=lambda e: ((e['name'] or e['matricula']).lower(), e['matricula']))
+            counts = {'in': 0, 'break': 0, 'out': 0}
+            for e in self.entries.values():
+                counts[e['status']] += 1
+            return {'day': self.day.isoformat(), 'seq': self.seq, 'counts': counts, 'people': people}
+
+    def events_since(self, seq):
+        """(events after seq, current seq), or (None, current seq) when seq is too old or from another day."""
+        rebuilt = self._ensure()
+        with self.lock:
+            if rebuilt or seq > self.seq or (self.events and seq < self.events[0]['seq'] - 1) \
+                    or (not self.events and seq < self.seq):
+                return None, self.seq
+            return [e for e in self.events if e['seq'] > seq], self.seq
+
+    def subscribe(self, callback):
+        with self.lock:
+            self._listeners.add(callback)
+            if PRESENCE_FEED and not self._tailing:
+                self._tailing = True
+                threading.Thread(target=self._tail, daemon=True).start()
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self._listeners.discard(callback)
+
+    def subscribers(self):
+        return len(self._listeners)
+
+    def _tail(self):
+        while True:
+            self._kick.wait(SSE_POLL_INTERVAL)
+            self._kick.clear()
+            try:
+                changed = self._ensure()
+            except Exception as e:
+                log.warning("presence feed error", extra={'error': str(e)})
+                changed = False
+            with self.lock:
+                if not self._listeners:
+                    self._tailing = False
+                    return
+                try:
+                    changed = self._catch_up() or changed
+                except Exception as e:
+                    log.warning("presence feed error", extra={'error': str(e)})
+            if changed:
+                self._wake()
+
+presence = PresenceIndex()
+
 # Auth Decorator
+def decode_token(auth):
+    """
+    Returns (matricula, role, error) for an Authorization header value;
+    error is None when the bearer token is valid.
+    """
+    parts = (auth or "").split()
+    token = parts[1] if len(parts) == 2 and parts[0].lower() == "bearer" else None
+    if not token:
+        return None, None, "Token is missing!"
+    try:
+        data = jwt.decode(token, app.config["SECRET_KEY"], algorithms=["HS256"])
+        # Favor matricula for cross-system stability
+        curr_user_mat = data.get("matricula")
+        if not curr_user_mat:
+            # Fallback for old tokens if any
+            curr_user_mat = str(data.get("user_id"))
+        return curr_user_mat, data["role"], None
+    except Exception:
+        return None, None, "Token is invalid!"
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.headers.get("Authorization", "") or ""
-        parts = auth.split()
-        token = parts[1] if len(parts) == 2 and parts[0].lower() == "bearer" else None
-        if not token:
-            return jsonify({"message": "Token is missing!"}), 401
-        try:
-            data = jwt.decode(token, app.config["SECRET_KEY"], algorithms=["HS256"])
-            # Favor matricula for cross-system stability
-            curr_user_mat = data.get("matricula")
-            if not curr_user_mat:
-                # Fallback for old tokens if any
-                curr_user_mat = str(data.get("user_id"))
-            role = data["role"]
-        except Exception:
-            return jsonify({"message": "Token is invalid!"}), 401
+        curr_user_mat, role, error = decode_token(request.headers.get("Authorization", ""))
+        if error:
+            return jsonify({"message": error}), 401
         return f(curr_user_mat, role, *args, **kwargs)
     return decorated
 
+# Admission control. At shift change everyone logs in and punches at once;
+# each login is a bcrypt check plus DB work. Token buckets per matricula and
+# per client IP reject bursts early, and a global limit on concurrent
+# bcrypt/DB-heavy requests makes the rest wait in a short FIFO queue. Requests
+# that cannot be admitted get a fast 429 with Retry-After instead of piling up
+# threads and SQL Server connections.
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+RATE_USER_BURST = float(os.getenv('RATE_USER_BURST', '10'))  # offline sync posts a user's queued punches in a row
+RATE_USER_PER_MIN = float(os.getenv('RATE_USER_PER_MIN', '6'))
+RATE_IP_BURST = float(os.getenv('RATE_IP_BURST', '60'))  # one office NAT can hold a whole shift
+RATE_IP_PER_MIN = float(os.getenv('RATE_IP_PER_MIN', '300'))
+ADMIT_MAX_ACTIVE = int(os.getenv('ADMIT_MAX_ACTIVE', str((os.cpu_count() or 2) * 2)))
+ADMIT_QUEUE = int(os.getenv('ADMIT_QUEUE', str(ADMIT_MAX_ACTIVE * 4)))
+ADMIT_MAX_WAIT = float(os.getenv('ADMIT_MAX_WAIT', '2'))  # seconds a request may wait for a slot
+ADMIT_RETRY_AFTER = 2
+# Behind ngrok/a reverse proxy every request comes from the proxy address: the
+# X-Forwarded-For of requests from TRUSTED_PROXIES (by default loopback, where
+# the ngrok agent runs) gives each client its own IP bucket. TRUST_PROXY_HEADERS
+# trusts it from any address.
+TRUSTED_PROXIES = {a.strip() for a in os.getenv('TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if a.strip()}
+TRUST_PROXY_HEADERS = os.getenv('TRUST_PROXY_HEADERS', 'false').lower() == 'true'
+
+def client_ip(remote_addr, forwarded_for=None):
+    """
+    The client address: the nearest X-Forwarded-For hop that is not a trusted
+    proxy (proxies append, so hops on the left can be forged by the client).
+    """
+    if not forwarded_for or not (TRUST_PROXY_HEADERS or remote_addr in TRUSTED_PROXIES):
+        return remote_addr
+    hops = [h.strip() for h in forwarded_for.split(',') if h.strip()]
+    for hop in reversed(hops):
+        if hop not in TRUSTED_PROXIES:
+            return hop
+    return hops[0] if hops else remote_addr
+
+class TokenBuckets:
+    """Token bucket per key: `burst` tokens, refilled at `per_min` tokens per minute."""
+
+    def __init__(self, burst, per_min, max_keys=50000):
+        self.burst = burst
+        self.rate = per_min / 60.0
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, key):
+        """Takes one token. Returns 0 when allowed, else the seconds until a token is available."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate if self.rate > 0 else 60.0
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > self.max_keys:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        # a bucket that has refilled completely is the same as a missing one
+        full = [k for k, (t, last) in self.buckets.items() if t + (now - last) * self.rate >= self.burst]
+        for k in full:
+            del self.buckets[k]
+
+class AdmissionGate:
+    """At most `limit` requests at a time; up to `queue` more wait in arrival order."""
+
+    def __init__(self, limit, queue):
+        self.limit = limit
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiters = collections.deque()
+
+    def acquire(self, timeout):
+        """Seconds waited for the slot, or None when the queue is full or the wait timed out."""
+        t0 = time.perf_counter()
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                return 0.0
+            if len(self.waiters) >= self.queue:
+                return None
+            turn = threading.Event()
+            self.waiters.append(turn)
+        if not turn.wait(timeout):
+            with self.lock:
+                if not turn.is_set():
+                    self.waiters.remove(turn)
+                    return None
+        return time.perf_counter() - t0
+
+    def release(self):
+        with self.lock:
+            if self.waiters:
+                self.waiters.popleft().set()  # hand the slot over to the next in line
+            else:
+                self.active -= 1
+
+    def depth(self):
+        return len(self.waiters)
+
+user_buckets = TokenBuckets(RATE_USER_BURST, RATE_USER_PER_MIN)
+ip_buckets = TokenBuckets(RATE_IP_BURST, RATE_IP_PER_MIN)
+admission_gate = AdmissionGate(ADMIT_MAX_ACTIVE, ADMIT_QUEUE)
+
+metrics.describe('ponto_admission_rejected_total', 'counter', 'Requests answered 429 by admission control, by reason.')
+metrics.describe('ponto_admission_wait_seconds', 'histogram', 'Time admitted requests waited for a slot.')
+metrics.gauge('ponto_admission_active', lambda: admission_gate.active, 'Requests holding an admission slot.')
+metrics.gauge('ponto_admission_queue_depth', admission_gate.depth, 'Requests waiting for an admission slot.')
+
+def rate_limited(endpoint, matricula, ip, per_ip_user=False):
+    """
+    Seconds to wait when the matricula or the IP is over its rate for `endpoint`,
+    else 0. With per_ip_user (matricula taken from the request body, as on login)
+    the matricula bucket is per (IP, matricula), so nobody can lock another
+    employee out by failing logins under their matricula.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return 0
+    checks = []
+    if ip:
+        checks.append(('ip', ip_buckets, (endpoint, ip)))
+    if matricula:
+        checks.append(('user', user_buckets, (endpoint, str(matricula), ip) if per_ip_user else (endpoint, str(matricula))))
+    for reason, buckets, key in checks:
+        wait = buckets.take(key)
+        if wait:
+            metrics.inc('ponto_admission_rejected_total', endpoint=endpoint, reason=reason)
+            return wait
+    return 0
+
+RATE_LIMITED_MESSAGE = 'Muitas requisições; tente novamente em instantes'
+
+def retry_after_seconds(wait):
+    return max(1, int(wait + 0.999))
+
+def too_many_requests(wait):
+    return jsonify({'message': RATE_LIMITED_MESSAGE}), 429, {'Retry-After': str(retry_after_seconds(wait))}
+
+def admission(user_key=None, per_ip_user=False):
+    """
+    Rate limits (per IP and per matricula from user_key(*args); see
+    rate_limited for per_ip_user) and admission slots for the decorated route.
+    Goes below token_required when the matricula comes from the token.
+    """
+    def wrap(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if not RATE_LIMIT_ENABLED:
+                return f(*args, **kwargs)
+            endpoint = request.url_rule.rule
+            wait = rate_limited(endpoint, user_key(*args) if user_key else None,
+                                client_ip(request.remote_addr, request.headers.get('X-Forwarded-For')), per_ip_user)
+            if wait:
+                return too_many_requests(wait)
+            waited = admission_gate.acquire(ADMIT_MAX_WAIT)
+            if waited is None:
+                metrics.inc('ponto_admission_rejected_total', endpoint=endpoint, reason='overload')
+                return too_many_requests(ADMIT_RETRY_AFTER)
+            metrics.observe('ponto_admission_wait_seconds', waited, endpoint=endpoint)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                admission_gate.release()
+        return decorated
+    return wrap
+
+def _login_matricula(*args):
+    return (request.get_json(silent=True) or {}).get('matricula')
+
 # Routes
 @app.route('/')
 def index():
@@ -361,18 +2398,19 @@ def health():
 
 @app.route('/register')
 def register_page():
-    return render_template('register.html')
+    return serve_frontend('register.html')
 
 @app.route('/dashboard')
 def dashboard():
-    return render_template('dashboard.html')
+    return serve_frontend('dashboard.html')
 
 @app.route('/admin')
 def admin_page():
-    return render_template('admin.html')
+    return serve_frontend('admin.html')
 
 # API Endpoints
 @app.route('/api/register', methods=['POST'])
+@admission(_login_matricula, per_ip_user=True)
 def register():
     data = request.get_json()
     hashed_password = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
@@ -390,7 +2428,7 @@ def register():
             conn.commit()
         # mirror to local sqlite for offline login
         try:
-            sconn = sqlite3.connect(sqlite_path)
+            sconn = connect_local()
             sconn.row_factory = sqlite3.Row
             ensure_sqlite_schema(sconn)
             scur = sconn.cursor()
@@ -400,6 +2438,7 @@ def register():
             sconn.close()
         except Exception:
             pass
+        user_index.invalidate()
         return jsonify({'message': 'User registered successfully!'}), 201
     except Exception as e:
         msg = str(e)
@@ -409,7 +2448,29 @@ def register():
     finally:
         conn.close()
 
+_login_syncs = set()
+_login_syncs_lock = threading.Lock()
+
+def start_login_sync(matricula):
+    """Background sync after a login; repeated logins do not stack threads for the same user."""
+    with _login_syncs_lock:
+        if matricula in _login_syncs:
+            return
+        _login_syncs.add(matricula)
+
+    def run():
+        try:
+            perform_sync_for_user(matricula)
+        except Exception as e:
+            log.warning("login sync failed", extra={'matricula': matricula, 'error': str(e)})
+        finally:
+            with _login_syncs_lock:
+                _login_syncs.discard(matricula)
+
+    threading.Thread(target=run, daemon=True).start()
+
 @app.route('/api/login', methods=['POST'])
+@admission(_login_matricula, per_ip_user=True)
 def login():
     data = request.get_json()
     conn = get_db_connection()
@@ -425,11 +2486,11 @@ def login():
         cursor.execute(query, (data['matricula'],))
         user = cursor.fetchone()
         if user:
-            print(f"DEBUG: Login - Matrícula {data['matricula']} encontrada no backend principal ({'SQLite' if is_sqlite else 'SQL Server'})")
+            log.debug("login lookup", extra={'matricula': data['matricula'], 'backend': 'sqlite' if is_sqlite else 'sqlserver', 'found': True})
         else:
-            print(f"DEBUG: Login - Matrícula {data['matricula']} NÃO encontrada no backend principal ({'SQLite' if is_sqlite else 'SQL Server'})")
+            log.debug("login lookup", extra={'matricula': data['matricula'], 'backend': 'sqlite' if is_sqlite else 'sqlserver', 'found': False})
     except Exception as e:
-        print(f"DEBUG: Login - Erro ao buscar usuario no backend principal: {e}")
+        log.warning("login lookup error", extra={'matricula': data['matricula'], 'error': str(e)})
         user = None
     finally:
         try:
@@ -440,8 +2501,8 @@ def login():
     # Fallback to local sqlite if not found on primary connection (if primary was SQL)
     if not user and not is_sqlite:
         try:
-            print(f"DEBUG: Login - Tentando fallback local para matrícula {data['matricula']}")
-            sconn = sqlite3.connect(sqlite_path)
+            log.debug("login local fallback", extra={'matricula': data['matricula']})
+            sconn = connect_local()
             sconn.row_factory = sqlite3.Row
             ensure_sqlite_schema(sconn)
             scur = sconn.cursor()
@@ -449,11 +2510,11 @@ def login():
             user = scur.fetchone()
             sconn.close()
             if user:
-                print(f"DEBUG: Login - Matrícula {data['matricula']} encontrada no fallback local.")
+                log.debug("login lookup", extra={'matricula': data['matricula'], 'backend': 'local', 'found': True})
             else:
-                print(f"DEBUG: Login - Matrícula {data['matricula']} NÃO encontrada no fallback local.")
+                log.debug("login lookup", extra={'matricula': data['matricula'], 'backend': 'local', 'found': False})
         except Exception as e:
-            print(f"DEBUG: Login - Erro no fallback local: {e}")
+            log.warning("login local fallback error", extra={'matricula': data['matricula'], 'error': str(e)})
             user = None
     
     if user:
@@ -461,12 +2522,12 @@ def login():
             input_pass = data['password'].encode('utf-8')
             hashed_pass = rf(user, 'password').encode('utf-8')
             if bcrypt.checkpw(input_pass, hashed_pass):
-                print(f"DEBUG: Login - Sucesso para matrícula {data['matricula']}")
+                log.info("login ok", extra={'matricula': data['matricula']})
             else:
-                print(f"DEBUG: Login - FALHA na senha para matrícula {data['matricula']}")
+                log.info("login bad password", extra={'matricula': data['matricula']})
                 return jsonify({'message': 'Invalid credentials!'}), 401
         except Exception as e:
-            print(f"DEBUG: Login - Erro na verificação de senha: {e}")
+            log.error("login password check error", extra={'matricula': data['matricula'], 'error': str(e)})
             return jsonify({'message': 'Internal auth error'}), 500
     else:
         return jsonify({'message': 'User not found!'}), 401
@@ -474,17 +2535,19 @@ def login():
     if user: # redundant check but safe for logic flow
         # Mirror user to local sqlite for future offline login
         try:
-            sconn = sqlite3.connect(sqlite_path)
+            sconn = connect_local()
             sconn.row_factory = sqlite3.Row
             ensure_sqlite_schema(sconn)
             scur = sconn.cursor()
             current_hash = rf(user, 'password')
             
-            scur.execute("SELECT 1 FROM Users WHERE matricula = ?", (data['matricula'],))
+            scur.execute("SELECT password, name, role FROM Users WHERE matricula = ?", (data['matricula'],))
             exists = scur.fetchone()
             if exists:
-                 scur.execute("UPDATE Users SET password = ?, name = ?, role = ? WHERE matricula = ?", 
-                              (current_hash, rf(user, 'name'), rf(user, 'role'), data['matricula']))
+                # skip the write (and the SQLite write lock) when the mirror is already current
+                if tuple(exists) != (current_hash, rf(user, 'name'), rf(user, 'role')):
+                    scur.execute("UPDATE Users SET password = ?, name = ?, role = ? WHERE matricula = ?",
+                                 (current_hash, rf(user, 'name'), rf(user, 'role'), data['matricula']))
             else:
                 scur.execute("INSERT INTO Users (matricula, password, name, role) VALUES (?, ?, ?, ?)",
                              (data['matricula'], current_hash, rf(user, 'name'), rf(user, 'role')))
@@ -502,7 +2565,7 @@ def login():
             }, app.config['SECRET_KEY'], algorithm="HS256")
             
             # Trigger background sync for this user immediately
-            threading.Thread(target=perform_sync_for_user, args=(rf(user, 'matricula'),), daemon=True).start()
+            start_login_sync(rf(user, 'matricula'))
             
             return jsonify({'token': token, 'role': rf(user, 'role'), 'name': rf(user, 'name')})
         except Exception as e:
@@ -510,12 +2573,653 @@ def login():
     
     return jsonify({'message': 'Invalid credentials!'}), 401
 
+# Reverse geocoding without network: neighborhood/municipality polygons of the
+# state (GeoJSON, e.g. the IBGE neighborhood mesh exported with ogr2ogr) are
+# indexed in a grid of GAZETTEER_CELL degrees by bounding box; a lookup tests
+# only the polygons of one cell, and recent points (rounded to ~10 m) are kept
+# in an LRU cache.
+GAZETTEER_PATH = os.getenv('GAZETTEER_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.geojson'))
+GAZETTEER_CELL = 0.01  # degrees (~1.1 km)
+GAZETTEER_CACHE_SIZE = 4096
+GAZETTEER_CACHE_PRECISION = 4  # decimal places of the cache key (~11 m)
+GAZETTEER_NEIGHBORHOOD_KEYS = ('neighborhood', 'bairro', 'NM_BAIRRO', 'name')
+GAZETTEER_CITY_KEYS = ('city', 'municipio', 'NM_MUN', 'NM_MUNICIP')
+
+def _ring_contains(ring, x, y):
+    inside = False
+    j = len(ring) - 1
+    for i in range(len(ring)):
+        xi, yi = ring[i][0], ring[i][1]
+        xj, yj = ring[j][0], ring[j][1]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def _first_property(props, keys):
+    for k in keys:
+        v = props.get(k)
+        if v:
+            return str(v).strip()
+    return None
+
+class Gazetteer:
+    """Point-in-polygon lookup of (neighborhood, city) over a GeoJSON file, loaded on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.features = []  # (bbox, polygons, neighborhood, city), smallest first
+        self.grid = {}
+        self.cache = collections.OrderedDict()
+
+    def _load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            t0 = time.perf_counter()
+            features = []
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    collection = json.load(f)
+            except FileNotFoundError:
+                collection = {'features': []}
+            except Exception as e:
+                log.warning("gazetteer load failed", extra={'path': self.path, 'error': str(e)})
+                collection = {'features': []}
+            for feat in collection.get('features', []):
+                geom = feat.get('geometry') or {}
+                props = feat.get('properties') or {}
+                if geom.get('type') == 'Polygon':
+                    polygons = [geom['coordinates']]
+                elif geom.get('type') == 'MultiPolygon':
+                    polygons = geom['coordinates']
+                else:
+                    continue
+                xs = [pt[0] for poly in polygons for pt in poly[0]]
+                ys = [pt[1] for poly in polygons for pt in poly[0]]
+                if not xs:
+                    continue
+                features.append(((min(xs), min(ys), max(xs), max(ys)), polygons,
+                                 _first_property(props, GAZETTEER_NEIGHBORHOOD_KEYS),
+                                 _first_property(props, GAZETTEER_CITY_KEYS)))
+            # a neighborhood inside a municipality polygon must be found first
+            features.sort(key=lambda f: (f[0][2] - f[0][0]) * (f[0][3] - f[0][1]))
+            grid = {}
+            for idx, (bbox, _, _, _) in enumerate(features):
+                for cx in range(int(bbox[0] // GAZETTEER_CELL), int(bbox[2] // GAZETTEER_CELL) + 1):
+                    for cy in range(int(bbox[1] // GAZETTEER_CELL), int(bbox[3] // GAZETTEER_CELL) + 1):
+                        grid.setdefault((cx, cy), []).append(idx)
+            self.features, self.grid = features, grid
+            self.cache.clear()
+            self.loaded = True
+            if features:
+                log.info("gazetteer loaded", extra={'path': self.path, 'features': len(features), 'cells': len(grid),
+                                                    'load_ms': round((time.perf_counter() - t0) * 1000, 1)})
+
+    def _resolve(self, lon, lat):
+        neighborhood = city = None
+        for idx in self.grid.get((int(lon // GAZETTEER_CELL), int(lat // GAZETTEER_CELL)), ()):
+            bbox, polygons, n, c = self.features[idx]
+            if not (bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]):
+                continue
+            for poly in polygons:
+                if _ring_contains(poly[0], lon, lat) and not any(_ring_contains(h, lon, lat) for h in poly[1:]):
+                    neighborhood = neighborhood or n
+                    city = city or c
+                    break
+            if neighborhood and city:
+                break
+        return neighborhood, city
+
+    def lookup(self, lat, lon):
+        """(neighborhood, city) of a point; (None, None) when outside every polygon or without a gazetteer."""
+        if not self.loaded:
+            self._load()
+        key = (round(lat, GAZETTEER_CACHE_PRECISION), round(lon, GAZETTEER_CACHE_PRECISION))
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit is not None:
+                self.cache.move_to_end(key)
+                metrics.inc('ponto_geocode_total', result='cache')
+                return hit
+        result = self._resolve(key[1], key[0])
+        metrics.inc('ponto_geocode_total', result='found' if result[0] or result[1] else 'miss')
+        with self.lock:
+            self.cache[key] = result
+            if len(self.cache) > GAZETTEER_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return result
+
+    def reload(self):
+        with self.lock:
+            self.loaded = False
+        self._load()
+
+gazetteer = Gazetteer(GAZETTEER_PATH)
+metrics.describe('ponto_geocode_total', 'counter', 'Reverse geocoding lookups by result (cache, found, miss).')
+
+def parse_coords(data):
+    """(lat, lon) floats from a request body/args, or None when missing or out of range."""
+    try:
+        lat, lon = float(data.get('lat')), float(data.get('lon'))
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+def punch_location(data):
+    """
+    (neighborhood, city) of a punch. Text sent by the client wins (manual edits,
+    older clients); missing parts are resolved from lat/lon.
+    """
+    neighborhood, city = (v if isinstance(v, str) else None for v in (data.get('neighborhood'), data.get('city')))
+    coords = parse_coords(data)
+    if coords and not (neighborhood and city):
+        try:
+            n, c = gazetteer.lookup(*coords)
+        except Exception as e:
+            log.warning("geocode failed", extra={'error': str(e)})
+            n = c = None
+        neighborhood, city = neighborhood or n, city or c
+    return neighborhood, city
+
+# Geofence: punches are checked against the sites (schools) assigned to the
+# user. Sites live in local.db, where SitesIndex (SQLite R-tree) finds the
+# boxes containing a point in O(log n), so the check needs no network; they
+# are replicated to SQL Server (geography column + spatial index) for reports.
+GEOFENCE_DEFAULT_RADIUS = float(os.getenv('GEOFENCE_DEFAULT_RADIUS', '150'))  # meters
+GEOFENCE_ACCURACY_CAP = float(os.getenv('GEOFENCE_ACCURACY_CAP', '100'))  # max GPS error credited, meters
+GEOFENCE_STATUSES = ('inside', 'outside', 'unassigned', 'unknown')
+GEOFENCE_LABELS = {'inside': 'Dentro', 'outside': 'Fora', 'unassigned': 'Sem local', 'unknown': 'Sem GPS'}
+EARTH_RADIUS_M = 6371000.0
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Great-circle (haversine) distance in meters."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+def site_box(lat, lon, radius_m):
+    """(min_lat, max_lat, min_lon, max_lon) covering the site plus the GPS error credited to a punch."""
+    reach = radius_m + GEOFENCE_ACCURACY_CAP
+    dlat = reach / 111320.0
+    dlon = reach / (111320.0 * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+def check_geofence(conn, matricula, lat, lon, accuracy):
+    """
+    (status, meters to the nearest assigned site) of a point for a user, on a
+    local SQLite connection. A punch counts as inside when the fence is within
+    its reported accuracy (up to GEOFENCE_ACCURACY_CAP).
+    """
+    slack = min(max(accuracy or 0.0, 0.0), GEOFENCE_ACCURACY_CAP)
+    # R-tree: only the user's sites whose box contains the point
+    rows = conn.execute("""
+        SELECT s.lat, s.lon, s.radius_m
+        FROM SitesIndex i
+        JOIN Sites s ON s.id = i.id
+        JOIN UserSites u ON u.site_id = s.id AND u.matricula = ?
+        WHERE i.min_lat <= ? AND i.max_lat >= ? AND i.min_lon <= ? AND i.max_lon >= ?
+    """, (matricula, lat, lat, lon, lon)).fetchall()
+    best = None
+    for r in rows:
+        d = distance_m(lat, lon, r[0], r[1])
+        if d - slack <= r[2]:
+            return 'inside', int(round(d))
+        best = d if best is None else min(best, d)
+    if best is None:
+        # outside every box: measure to the user's sites (a handful) for the report
+        for r in conn.execute("""
+            SELECT s.lat, s.lon FROM UserSites u JOIN Sites s ON s.id = u.site_id WHERE u.matricula = ?
+        """, (matricula,)):
+            d = distance_m(lat, lon, r[0], r[1])
+            best = d if best is None else min(best, d)
+        if best is None:
+            return 'unassigned', None
+    return 'outside', int(round(best))
+
+def punch_geofence(conn, matricula, data):
+    """GEO_COLUMNS values of a punch: coordinates as sent plus the geofence result."""
+    coords = parse_coords(data)
+    try:
+        accuracy = float(data.get('accuracy')) if data.get('accuracy') is not None else None
+    except (TypeError, ValueError):
+        accuracy = None
+    if not coords:
+        metrics.inc('ponto_geofence_checks_total', result='unknown')
+        return {'lat': None, 'lon': None, 'accuracy': accuracy, 'geofence': 'unknown', 'geofence_m': None}
+    try:
+        status, meters = check_geofence(conn, matricula, coords[0], coords[1], accuracy)
+    except Exception as e:
+        log.warning("geofence check failed", extra={'matricula': matricula, 'error': str(e)})
+        status, meters = 'unknown', None
+    metrics.inc('ponto_geofence_checks_total', result=status)
+    return {'lat': coords[0], 'lon': coords[1], 'accuracy': accuracy, 'geofence': status, 'geofence_m': meters}
+
+metrics.describe('ponto_geofence_checks_total', 'counter', 'Punch geofence checks by result.')
+
+def save_site(conn, site_id, name, lat, lon, radius_m):
+    """Inserts or updates a site and its R-tree box (caller commits). Returns the id."""
+    if site_id is None:
+        site_id = conn.execute("INSERT INTO Sites (name, lat, lon, radius_m) VALUES (?, ?, ?, ?)",
+                               (name, lat, lon, radius_m)).lastrowid
+    else:
+        conn.execute("UPDATE Sites SET name = ?, lat = ?, lon = ?, radius_m = ? WHERE id = ?",
+                     (name, lat, lon, radius_m, site_id))
+    conn.execute("INSERT OR REPLACE INTO SitesIndex (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)",
+                 (site_id,) + site_box(lat, lon, radius_m))
+    return site_id
+
+_sites_publish_lock = threading.Lock()
+_publish_request_lock = threading.Lock()
+_sites_publish = {'running': False, 'again': False}
+
+def publish_sites():
+    """
+    Replaces the SQL Server copy of Sites/UserSites with the local ones (no-op
+    offline), in one transaction: readers see the old or the new replica, never
+    empty tables. Calls in this process are serialised by _sites_publish_lock;
+    the transaction's table locks serialise the other processes.
+    """
+    if not sql_online():
+        return False
+    with _sites_publish_lock:
+        lconn = connect_local()
+        try:
+            ensure_sqlite_schema(lconn)
+            sites = lconn.execute("SELECT id, name, lat, lon, radius_m FROM Sites").fetchall()
+            links = lconn.execute("SELECT matricula, site_id FROM UserSites").fetchall()
+        finally:
+            lconn.close()
+        conn = get_db_connection()
+        try:
+            if isinstance(conn, sqlite3.Connection):
+                return False
+            ph = get_ph(conn)
+            cur = conn.cursor()
+            cur.execute("BEGIN TRANSACTION")
+            try:
+                cur.execute("DELETE FROM UserSites")
+                cur.execute("DELETE FROM Sites")
+                for site in sites:
+                    cur.execute(f"""
+                        INSERT INTO Sites (id, name, lat, lon, radius_m, geo)
+                        VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, geography::Point({ph}, {ph}, 4326))
+                    """, tuple(site) + (site[2], site[3]))
+                for link in links:
+                    cur.execute(f"INSERT INTO UserSites (matricula, site_id) VALUES ({ph}, {ph})", tuple(link))
+                cur.execute("COMMIT TRANSACTION")
+            except Exception:
+                try:
+                    cur.execute("IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION")
+                except Exception:
+                    pass
+                raise
+            return True
+        except Exception as e:
+            log.warning("could not publish geofence sites", extra={'error': str(e)})
+            return False
+        finally:
+            try: conn.close()
+            except: pass
+
+def request_publish_sites():
+    """
+    Runs publish_sites in the background (off the admin request). Requests made
+    while one is running coalesce into a single re-run, which reads the latest sites.
+    """
+    with _publish_request_lock:
+        if _sites_publish['running']:
+            _sites_publish['again'] = True
+            return
+        _sites_publish['running'] = True
+
+    def run():
+        while True:
+            try:
+                publish_sites()
+            except Exception as e:
+                log.warning("could not publish geofence sites", extra={'error': str(e)})
+            with _publish_request_lock:
+                if not _sites_publish['again']:
+                    _sites_publish['running'] = False
+                    return
+                _sites_publish['again'] = False
+
+    threading.Thread(target=run, daemon=True).start()
+
+def _site_payload(data):
+    """(name, lat, lon, radius_m) from a request body, or an error message."""
+    coords = parse_coords(data)
+    name = (data.get('name') or '').strip()
+    if not name or not coords:
+        return None, 'name, lat e lon são obrigatórios'
+    try:
+        radius = float(data.get('radius_m') or GEOFENCE_DEFAULT_RADIUS)
+    except (TypeError, ValueError):
+        return None, 'radius_m inválido'
+    if radius <= 0:
+        return None, 'radius_m inválido'
+    return (name, coords[0], coords[1], radius), None
+
+def _list_sites(conn, site_id=None):
+    where = "WHERE s.id = ?" if site_id is not None else ""
+    rows = conn.execute(f"""
+        SELECT s.id, s.name, s.lat, s.lon, s.radius_m, u.matricula
+        FROM Sites s LEFT JOIN UserSites u ON u.site_id = s.id
+        {where} ORDER BY s.name, s.id, u.matricula
+    """, (site_id,) if site_id is not None else ()).fetchall()
+    sites = {}
+    for r in rows:
+        site = sites.setdefault(r['id'], {'id': r['id'], 'name': r['name'], 'lat': r['lat'], 'lon': r['lon'],
+                                          'radius_m': r['radius_m'], 'matriculas': []})
+        if r['matricula']:
+            site['matriculas'].append(r['matricula'])
+    return list(sites.values())
+
+@app.route('/api/admin/sites', methods=['GET', 'POST'])
+@token_required
+def admin_sites(curr_user_mat, role):
+    """Lists the geofence sites, or creates one ({name, lat, lon, radius_m, matriculas?})."""
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    conn = connect_local()
+    conn.row_factory = sqlite3.Row
+    try:
+        ensure_sqlite_schema(conn)
+        if request.method == 'GET':
+            return jsonify(_list_sites(conn))
+        data = request.get_json(silent=True) or {}
+        fields, error = _site_payload(data)
+        if error:
+            return jsonify({'message': error}), 400
+        site_id = save_site(conn, None, *fields)
+        conn.executemany("INSERT OR IGNORE INTO UserSites (matricula, site_id) VALUES (?, ?)",
+                         [(str(m), site_id) for m in data.get('matriculas') or []])
+        conn.commit()
+        site = _list_sites(conn, site_id)[0]
+    finally:
+        conn.close()
+    request_publish_sites()
+    return jsonify(site), 201
+
+@app.route('/api/admin/sites/<int:site_id>', methods=['PUT', 'DELETE'])
+@token_required
+def admin_site(curr_user_mat, role, site_id):
+    """Updates a site (fields and/or the full `matriculas` list) or deletes it."""
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    conn = connect_local()
+    conn.row_factory = sqlite3.Row
+    try:
+        ensure_sqlite_schema(conn)
+        current = _list_sites(conn, site_id)
+        if not current:
+            return jsonify({'message': 'Local não encontrado'}), 404
+        if request.method == 'DELETE':
+            conn.execute("DELETE FROM UserSites WHERE site_id = ?", (site_id,))
+            conn.execute("DELETE FROM SitesIndex WHERE id = ?", (site_id,))
+            conn.execute("DELETE FROM Sites WHERE id = ?", (site_id,))
+            conn.commit()
+            site = None
+        else:
+            data = request.get_json(silent=True) or {}
+            fields, error = _site_payload(dict(current[0], **data))
+            if error:
+                return jsonify({'message': error}), 400
+            save_site(conn, site_id, *fields)
+            if 'matriculas' in data:
+                conn.execute("DELETE FROM UserSites WHERE site_id = ?", (site_id,))
+                conn.executemany("INSERT OR IGNORE INTO UserSites (matricula, site_id) VALUES (?, ?)",
+                                 [(str(m), site_id) for m in data.get('matriculas') or []])
+            conn.commit()
+            site = _list_sites(conn, site_id)[0]
+    finally:
+        conn.close()
+    request_publish_sites()
+    if site is None:
+        return jsonify({'message': 'Local excluído'}), 200
+    return jsonify(site)
+
+@app.route('/api/geocode')
+@token_required
+def geocode(curr_user_mat, role):
+    coords = parse_coords(request.args)
+    if not coords:
+        return jsonify({'message': 'lat e lon são obrigatórios'}), 400
+    neighborhood, city = gazetteer.lookup(*coords)
+    return jsonify({'neighborhood': neighborhood, 'city': city, 'resolved': bool(neighborhood or city)})
+
+# Attendance analytics: DailyRollup keeps per (day, location, record_type)
+# counts of the punches stored in TimeRecords, updated as each one is written
+# (online insert, or the sync of a queued punch), so /api/admin/analytics never
+# scans the punches. DailyFirstIn holds each person's first arrival of the day,
+# which decides `arrivals` and `late`. rebuild_rollup.py recomputes past days.
+# The live counts only see the punches written by this host (its processes
+# share local.db): with several hosts, or an offline sync writing to the same
+# SQL Server elsewhere, they undercount. When SQL Server is configured the
+# supervisor therefore rebuilds the last ROLLUP_REBUILD_DAYS closed days from
+# it every ROLLUP_REBUILD_HOURS (0 disables).
+ARRIVAL_RECORD_TYPE = 'Entrada'
+ROLLUP_REBUILD_HOURS = float(os.getenv('ROLLUP_REBUILD_HOURS', '24'))
+ROLLUP_REBUILD_DAYS = int(os.getenv('ROLLUP_REBUILD_DAYS', '7'))
+LATE_ARRIVAL_AFTER = os.getenv('LATE_ARRIVAL_AFTER', '08:00')  # HH:MM; first arrivals after this minute are late
+# group_by values accepted by /api/admin/analytics -> SQL expression
+ANALYTICS_GROUPS = {
+    'day': 'r.day',
+    'city': "NULLIF(loc.city, '')",
+    'neighborhood': "NULLIF(loc.neighborhood, '')",
+    'record_type': 'r.record_type',
+}
+
+def is_late(timestamp):
+    return format_ts(timestamp)[11:16] > LATE_ARRIVAL_AFTER
+
+def _rollup_add(conn, day, location_id, record_type, punches=0, arrivals=0, late=0):
+    conn.execute("INSERT OR IGNORE INTO DailyRollup (day, location_id, record_type) VALUES (?, ?, ?)",
+                 (day, location_id, record_type))
+    conn.execute("""
+        UPDATE DailyRollup SET punches = punches + ?, arrivals = arrivals + ?, late = late + ?
+        WHERE day = ? AND location_id = ? AND record_type = ?
+    """, (punches, arrivals, late, day, location_id, record_type))
+
+def rollup_punch(conn, matricula, record_type, timestamp, location_id):
+    """Counts a punch written to TimeRecords into DailyRollup (local connection; caller commits)."""
+    ts = format_ts(timestamp)
+    day, location_id = ts[:10], location_id or 0
+    _rollup_add(conn, day, location_id, record_type, punches=1)
+    if record_type != ARRIVAL_RECORD_TYPE or not matricula:
+        return
+    prev = conn.execute("SELECT timestamp, location_id FROM DailyFirstIn WHERE day = ? AND matricula = ?",
+                        (day, matricula)).fetchone()
+    if prev and prev[0] <= ts:
+        return
+    if prev:  # an earlier arrival synced late replaces the one already counted
+        _rollup_add(conn, day, prev[1], record_type, arrivals=-1, late=-int(is_late(prev[0])))
+    conn.execute("INSERT OR REPLACE INTO DailyFirstIn (day, matricula, timestamp, location_id) VALUES (?, ?, ?, ?)",
+                 (day, matricula, ts, location_id))
+    _rollup_add(conn, day, location_id, record_type, arrivals=1, late=int(is_late(ts)))
+
+_rollup_schema_ready = set()  # local.db paths whose schema count_punch has ensured in this process
+
+def count_punch(matricula, record_type, timestamp, neighborhood, city):
+    """rollup_punch on its own local connection, for punches stored on SQL Server."""
+    try:
+        lconn = connect_local()
+        try:
+            if sqlite_path not in _rollup_schema_ready:
+                ensure_sqlite_schema(lconn)
+                _rollup_schema_ready.add(sqlite_path)
+            rollup_punch(lconn, matricula, record_type, timestamp, locations.id_for(lconn, neighborhood, city))
+            lconn.commit()
+        finally:
+            lconn.close()
+    except Exception as e:
+        log.warning("rollup update failed", extra={'matricula': matricula, 'error': str(e)})
+
+def rebuild_rollups(start_date=None, end_date=None, allow_local=False):
+    """
+    Recomputes DailyRollup/DailyFirstIn for [start_date, end_date] ('YYYY-MM-DD';
+    default: from the oldest record until yesterday, as today keeps being counted
+    live) from TimeRecords and its archive, reading the active backend. Each
+    month is read and replaced under one local.db write lock, so punches counted
+    meanwhile wait for it instead of being wiped. When SQL Server is configured
+    but unreachable, the local.db copy is only used with allow_local (it may be
+    missing punches, and the rebuild would replace the counts with its own).
+    Returns (backend, {'YYYYMM': punches}).
+    """
+    conn = get_db_connection()
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    if is_sqlite and server and not allow_local:
+        conn.close()
+        raise RuntimeError("SQL Server configurado (DB_SERVER) mas indisponível; use --local para recalcular a partir do local.db")
+    ph = get_ph(conn)
+    done = {}
+    try:
+        cur = conn.cursor()
+        if not start_date:
+            cur.execute(f"SELECT MIN(t.timestamp) AS first_ts FROM {time_records_from(conn)}")
+            first_ts = rf(cur.fetchone(), 'first_ts')
+            if first_ts is None:
+                return ('sqlite' if is_sqlite else 'sqlserver'), done
+            start_date = format_ts(first_ts)[:10]
+        first = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+        if end_date:
+            stop = datetime.datetime.strptime(end_date, '%Y-%m-%d') + datetime.timedelta(days=1)
+        else:
+            stop = datetime.datetime.combine(now_local().date(), datetime.time())
+        text_cols, joins = punch_text_columns(conn)
+        lconn = connect_local()
+        try:
+            ensure_sqlite_schema(lconn)
+            month = datetime.datetime(first.year, first.month, 1)
+            while month < stop:
+                lo, hi = max(month, first), min(_add_months(month, 1), stop)
+                last_day = (hi - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+                lconn.execute("BEGIN IMMEDIATE")
+                cur.execute(f"""
+                    SELECT t.matricula, t.record_type, t.timestamp, {text_cols}
+                    FROM {time_records_from(conn, lo.strftime('%Y-%m-%d'), last_day)} {joins}
+                    WHERE t.timestamp >= {ph} AND t.timestamp < {ph}
+                """, (format_ts(lo), format_ts(hi)) if is_sqlite else (lo, hi))
+                rows = sorted(cur.fetchall(), key=lambda r: format_ts(rf(r, 'timestamp')))
+                for table in ('DailyRollup', 'DailyFirstIn'):
+                    lconn.execute(f"DELETE FROM {table} WHERE day >= ? AND day <= ?", (lo.strftime('%Y-%m-%d'), last_day))
+                for r in rows:
+                    rollup_punch(lconn, rf(r, 'matricula'), rf(r, 'record_type'), rf(r, 'timestamp'),
+                                 locations.id_for(lconn, rf(r, 'neighborhood'), rf(r, 'city')))
+                lconn.commit()
+                done[month.strftime('%Y%m')] = len(rows)
+                month = _add_months(month, 1)
+        finally:
+            lconn.close()
+    finally:
+        try: conn.close()
+        except: pass
+    log.info("rollups rebuilt", extra={'months': len(done), 'punches': sum(done.values())})
+    return ('sqlite' if is_sqlite else 'sqlserver'), done
+
+def rebuild_recent_rollups():
+    """
+    Rebuilds the last ROLLUP_REBUILD_DAYS days before today from SQL Server.
+    Skipped (None) without SQL Server or while it is offline.
+    """
+    if not server or not sql_online():
+        return None
+    start = (now_local().date() - datetime.timedelta(days=ROLLUP_REBUILD_DAYS)).isoformat()
+    return rebuild_rollups(start)
+
+def start_rollup_rebuilder():
+    """Runs rebuild_recent_rollups periodically (ROLLUP_REBUILD_HOURS=0 disables)."""
+    if ROLLUP_REBUILD_HOURS <= 0 or not server:
+        return
+    def loop():
+        time.sleep(120)  # after the health check and the archiver
+        while True:
+            try:
+                rebuild_recent_rollups()
+            except Exception as e:
+                log.warning("scheduled rollup rebuild failed", extra={'error': str(e)})
+            time.sleep(ROLLUP_REBUILD_HOURS * 3600)
+    threading.Thread(target=loop, daemon=True).start()
+
+def _analytics_day(value, default):
+    if not value:
+        return default
+    datetime.datetime.strptime(value, '%Y-%m-%d')  # ValueError on bad input
+    return value
+
+@app.route('/api/admin/analytics', methods=['GET'])
+@token_required
+def admin_analytics(curr_user_mat, role):
+    """
+    Punches, first arrivals and late arrivals from DailyRollup between
+    start_date and end_date (default: the last 30 days), grouped by
+    ?group_by= (comma-separated: day, city, neighborhood, record_type) and
+    optionally filtered by city, neighborhood and record_type.
+    The counts are kept by this host: punches other hosts stored on SQL Server
+    are missing until start_rollup_rebuilder rebuilds those days from it (today
+    is never rebuilt).
+    """
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    t0 = time.perf_counter()
+    today = now_local().date()
+    try:
+        start_date = _analytics_day(request.args.get('start_date'), (today - datetime.timedelta(days=29)).isoformat())
+        end_date = _analytics_day(request.args.get('end_date'), today.isoformat())
+    except ValueError:
+        return jsonify({'message': 'Datas devem estar no formato AAAA-MM-DD'}), 400
+    group_by = [g.strip() for g in (request.args.get('group_by') or '').split(',') if g.strip()] or ['day']
+    unknown = [g for g in group_by if g not in ANALYTICS_GROUPS]
+    if unknown:
+        return jsonify({'message': f"group_by deve usar: {', '.join(ANALYTICS_GROUPS)}"}), 400
+    if 'neighborhood' in group_by and 'city' not in group_by:
+        group_by.insert(group_by.index('neighborhood'), 'city')  # the same neighborhood name exists in several cities
+    where, params = ["r.day >= ?", "r.day <= ?"], [start_date, end_date]
+    for key in ('city', 'neighborhood', 'record_type'):
+        if request.args.get(key):
+            where.append(f"{'r' if key == 'record_type' else 'loc'}.{key} = ?")
+            params.append(request.args[key])
+    select = ''.join(f"{ANALYTICS_GROUPS[g]} AS {g}, " for g in group_by)
+    group = f"GROUP BY {', '.join(ANALYTICS_GROUPS[g] for g in group_by)} ORDER BY {', '.join(str(i + 1) for i in range(len(group_by)))}"
+    conn = connect_local()
+    conn.row_factory = sqlite3.Row
+    try:
+        ensure_sqlite_schema(conn)
+        rows = [dict(r) for r in conn.execute(f"""
+            SELECT {select}SUM(r.punches) AS punches, SUM(r.arrivals) AS arrivals, SUM(r.late) AS late
+            FROM DailyRollup r LEFT JOIN Locations loc ON loc.id = r.location_id
+            WHERE {' AND '.join(where)}
+            {group}
+        """, params)]
+        # queued punches are counted when they sync
+        pending = conn.execute("SELECT COUNT(*) FROM OfflineQueue WHERE ts_epoch >= ? AND ts_epoch < ?",
+                               (day_start_epoch(start_date), day_start_epoch(end_date, 1))).fetchone()[0]
+    finally:
+        conn.close()
+    totals = {k: sum(r[k] or 0 for r in rows) for k in ('punches', 'arrivals', 'late')}
+    metrics.observe('ponto_report_build_seconds', time.perf_counter() - t0, report='analytics')
+    return jsonify({'start_date': start_date, 'end_date': end_date, 'group_by': group_by,
+                    'late_after': LATE_ARRIVAL_AFTER, 'rows': rows, 'totals': totals, 'pending': pending})
+
 @app.route('/api/punch', methods=['POST'])
 @token_required
+@admission(lambda curr_user_mat, role: curr_user_mat)
 def punch(curr_user_mat, role):
-    data = request.get_json()
-    # Expecting: type, neighborhood, city, timestamp (optional)
-    
+    body, status = record_punch(curr_user_mat, request.get_json())
+    return jsonify(body), status
+
+def record_punch(curr_user_mat, data):
+    """Stores a punch (SQL Server, or the OfflineQueue as fallback). Returns (body, status)."""
+    # Expecting: type, neighborhood, city, lat/lon, timestamp (optional)
+    record_type = data.get('type') if isinstance(data, dict) else None
+    if record_type not in RECORD_TYPES:
+        return {'message': 'Tipo de batida inválido'}, 400
+
     conn = get_db_connection()
     # Determine basic status
     is_sqlite = isinstance(conn, sqlite3.Connection)
@@ -526,21 +3230,23 @@ def punch(curr_user_mat, role):
     if provided_ts:
         try:
             # Expected format from JS: YYYY-MM-DD HH:MM:SS
-            current_time = datetime.datetime.strptime(provided_ts, '%Y-%m-%d %H:%M:%S')
+            current_time = datetime.datetime.strptime(provided_ts, TS_FORMAT)
         except Exception as e:
-            print(f"Error parsing provided timestamp '{provided_ts}': {e}")
-            current_time = datetime.datetime.now(pytz.timezone('America/Sao_Paulo')).replace(tzinfo=None)
+            log.warning("invalid punch timestamp", extra={'timestamp': provided_ts, 'error': str(e)})
+            current_time = now_local()
     else:
-        current_time = datetime.datetime.now(pytz.timezone('America/Sao_Paulo')).replace(tzinfo=None)
+        current_time = now_local()
+    neighborhood, city = punch_location(data)
     
     # fetch denormalized user fields if available
     user_matricula = curr_user_mat
     sql_user_id, user_name = get_user_info_by_matricula(user_matricula, conn) # Use 'conn' for potential SQL Server
     
     # Also find local user_id to catch orphaned local records
-    lconn = sqlite3.connect(sqlite_path)
+    lconn = connect_local()
     lconn.row_factory = sqlite3.Row
     local_user_id, l_user_name = get_user_info_by_matricula(user_matricula, lconn)
+    geo = punch_geofence(lconn, user_matricula, data)
     lconn.close()
 
     if not user_name:
@@ -556,19 +3262,23 @@ def punch(curr_user_mat, role):
         try:
             cursor = conn.cursor()
             # Insert into Online TimeRecords
-            query = f"INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, timestamp) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})"
-            cursor.execute(query, (sync_user_id, user_matricula, user_name, data['type'], data.get('neighborhood'), data.get('city'), current_time))
+            query = f"""
+                INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, timestamp, {GEO_INSERT_COLUMNS})
+                VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {', '.join([ph] * len(GEO_COLUMN_NAMES))})
+            """
+            cursor.execute(query, (sync_user_id, user_matricula, user_name, record_type, neighborhood, city, current_time)
+                           + geo_values(geo))
             if ph == '?': # likely pyodbc
                 conn.commit()
             inserted_online = True
         except Exception as e:
-            print(f"Error inserting online: {e}")
+            log.warning("online punch insert failed, queueing locally", extra={'matricula': curr_user_mat, 'error': str(e)})
 
     # 2. Local fallback if needed
     if is_sqlite or not inserted_online:
         # We need a dedicated sqlite connection for the queue to ensure we don't mix with a broken pymssql conn
         try:
-            qconn = sqlite3.connect(sqlite_path)
+            qconn = connect_local()
             qconn.row_factory = sqlite3.Row
             ensure_sqlite_schema(qconn)
             # Ensure we have user info for the local sqlite
@@ -577,19 +3287,21 @@ def punch(curr_user_mat, role):
             
             qcur = qconn.cursor()
             try:
+                location_id = locations.id_for(qconn, neighborhood, city)
                 qcur.execute(
-                    """
-                    INSERT INTO OfflineQueue (user_id, matricula, user_name, record_type, neighborhood, city, timestamp)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    f"""
+                    INSERT INTO OfflineQueue (user_id, matricula, user_name, record_type, location_id, timestamp, ts_epoch, tz, {GEO_INSERT_COLUMNS})
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     """,
-                    (sync_user_id, user_matricula, user_name, data['type'], data.get('neighborhood'), data.get('city'), current_time)
+                    (sync_user_id, user_matricula, user_name, record_type, location_id,
+                     format_ts(current_time), to_epoch(current_time), LOCAL_TZ_NAME) + geo_values(geo)
                 )
                 qconn.commit()
             finally:
                 qconn.close()
         except Exception as e:
             # If even local save fails, then we return error
-            return jsonify({'message': f'Error saving punch: {str(e)}'}), 500
+            return {'message': f'Error saving punch: {str(e)}'}, 500
 
     # Commit main connection if it was used and no autocommit (though we set autocommit=True for pymssql)
     if inserted_online and is_sqlite: 
@@ -600,11 +3312,25 @@ def punch(curr_user_mat, role):
     except:
         pass
 
-    return jsonify({'message': 'Ponto recorded successfully!'}), 201
+    metrics.inc('ponto_punches_total', destination='sqlserver' if inserted_online else 'offline_queue')
+    if inserted_online:
+        count_punch(user_matricula, record_type, current_time, neighborhood, city)
+    else:
+        status_broadcaster.notify(queue_changed=True)
+    try:
+        presence.record(user_matricula, user_name, record_type, current_time, neighborhood, city)
+    except Exception as e:
+        log.warning("presence update failed", extra={'error': str(e)})
+    return {'message': 'Ponto recorded successfully!', 'geofence': geo['geofence'], 'geofence_m': geo['geofence_m']}, 201
 
 @app.route('/api/history', methods=['GET'])
 @token_required
+@admission()
 def history(curr_user_mat, role):
+    return jsonify(load_history(curr_user_mat))
+
+def load_history(curr_user_mat):
+    """Current month's records plus pending queue items for a user."""
     conn = get_db_connection()
     try:
         is_sqlite = isinstance(conn, sqlite3.Connection)
@@ -615,7 +3341,7 @@ def history(curr_user_mat, role):
         # Get user info for inclusive filtering
         sql_user_id, user_name = None, None
         local_user_id, l_user_name = None, None
-        if sql_online():
+        if sql_connect_allowed():
             try:
                 # Use a temp connection to avoid mixing with 'conn' if it's already used
                 tconn = get_db_connection()
@@ -624,7 +3350,7 @@ def history(curr_user_mat, role):
             except: pass
         
         try:
-            lconn = sqlite3.connect(sqlite_path)
+            lconn = connect_local()
             lconn.row_factory = sqlite3.Row
             local_user_id, l_user_name = get_user_info_by_matricula(user_matricula, lconn)
             lconn.close()
@@ -633,17 +3359,18 @@ def history(curr_user_mat, role):
         records = []
         seen = set()
         
-        if is_sqlite and sql_online():
+        pymssql = load_pymssql() if is_sqlite and sql_connect_allowed() else None
+        if pymssql:
             # Fallback detected but SQL is online - attempt forced SQL
             try:
-                import pymssql
-                fconn = pymssql.connect(server=server, user=username, password=password, database=database, as_dict=True, autocommit=True)
+                metrics.inc('ponto_history_forced_sql_total')
+                fconn = timed_connect('pymssql', pymssql.connect, server=server, user=username, password=password, database=database, as_dict=True, autocommit=True, login_timeout=SQL_CONNECT_TIMEOUT)
                 try:
                     fcur = fconn.cursor()
                     fcur.execute(f"""
                         SELECT record_type, timestamp, neighborhood, city 
                         FROM TimeRecords WITH (NOLOCK)
-                        WHERE matricula = {ph} 
+                        WHERE matricula = %s 
                           AND MONTH(timestamp) = MONTH(GETDATE()) 
                           AND YEAR(timestamp) = YEAR(GETDATE())
                         ORDER BY timestamp DESC
@@ -682,20 +3409,28 @@ def history(curr_user_mat, role):
                         ORDER BY timestamp DESC
                     """, (user_matricula,))
                 else:
-                     # Query local SQLite by matricula
+                     # Query local SQLite by matricula over the current month's epoch range
+                     m_start, m_end = month_bounds_epoch()
+                     t_start, t_end = format_ts(m_start), format_ts(m_end)
+                     # (second branch only matches rows not yet migrated to ts_epoch)
+                     text_cols, joins = punch_text_columns(conn)
                      cursor.execute(f"""
-                        SELECT record_type, timestamp, neighborhood, city 
-                        FROM TimeRecords 
-                        WHERE matricula = {ph} 
-                          AND strftime('%m', timestamp) = strftime('%m', 'now') 
-                          AND strftime('%Y', timestamp) = strftime('%Y', 'now')
-                        ORDER BY timestamp DESC
-                    """, (user_matricula,))
+                        SELECT t.record_type, t.timestamp, t.ts_epoch, {text_cols}
+                        FROM TimeRecords t {joins}
+                        WHERE t.matricula = {ph} AND t.ts_epoch >= {ph} AND t.ts_epoch < {ph}
+                        UNION ALL
+                        SELECT t.record_type, t.timestamp, t.ts_epoch, {text_cols}
+                        FROM TimeRecords t {joins}
+                        WHERE t.matricula = {ph} AND t.ts_epoch IS NULL AND t.timestamp >= {ph} AND t.timestamp < {ph}
+                        ORDER BY 3 DESC
+                    """, (user_matricula, m_start, m_end, user_matricula, t_start, t_end))
                 
                 rows = cursor.fetchall()
                 for row in rows:
                     ts = rf(row, 'timestamp')
-                    if isinstance(ts, datetime.datetime):
+                    if is_sqlite:
+                        ts = format_ts(row_epoch(row))
+                    elif isinstance(ts, datetime.datetime):
                         ts = ts.strftime('%Y-%m-%d %H:%M:%S')
                     key = (rf(row, 'record_type'), ts)
                     if key not in seen:
@@ -712,17 +3447,16 @@ def history(curr_user_mat, role):
 
         # Append offline queued items by matricula or user_id
         try:
-            sconn = sqlite3.connect(sqlite_path)
+            sconn = connect_local()
             try:
                 sconn.row_factory = sqlite3.Row
                 ensure_sqlite_schema(sconn)
                 scur = sconn.cursor()
-                scur.execute("SELECT record_type, timestamp, neighborhood, city FROM OfflineQueue WHERE matricula = ? OR (matricula IS NULL AND user_id = ?) OR (matricula IS NULL AND user_id = ?) ORDER BY timestamp DESC", (user_matricula, local_user_id, sql_user_id))
-                qrows = scur.fetchall()
+                text_cols, joins = punch_text_columns(sconn)
+                scur.execute(f"SELECT t.record_type, t.timestamp, t.ts_epoch, {text_cols} FROM OfflineQueue t {joins} WHERE t.matricula = ? OR (t.matricula IS NULL AND t.user_id = ?) OR (t.matricula IS NULL AND t.user_id = ?)", (user_matricula, local_user_id, sql_user_id))
+                qrows = sorted(scur.fetchall(), key=lambda r: row_epoch(r) or 0, reverse=True)
                 for row in qrows:
-                    ts = rf(row, 'timestamp')
-                    if isinstance(ts, datetime.datetime):
-                        ts = ts.strftime('%Y-%m-%d %H:%M:%S')
+                    ts = format_ts(row_epoch(row))
                     records.append({
                         'type': rf(row, 'record_type'),
                         'timestamp': ts,
@@ -735,34 +3469,39 @@ def history(curr_user_mat, role):
         except Exception:
             pass
         
-        return jsonify(records)
+        return records
     finally:
         try:
             conn.close()
         except:
             pass
 
+ONLINE_CACHE_CONTROL = 'public, max-age=5'  # polling fallback of /api/status/stream
+
 @app.route('/api/online')
 def online():
+    return jsonify(online_status()), 200, {'Cache-Control': ONLINE_CACHE_CONTROL}
+
+def online_status():
     # Se o endpoint foi chamado, o servidor está online.
     # Verificamos o banco apenas para informação.
-    db_ok = sql_online()
-    return jsonify({'online': True, 'db_online': db_ok}), 200
+    return {'online': True, 'db_online': sql_online()}
 
 @app.route('/api/user/report', methods=['GET'])
 @token_required
 def get_user_report(curr_user_mat, role):
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    t0 = time.perf_counter()
     conn = get_db_connection()
     ph = get_ph(conn)
     try:
         cursor = conn.cursor()
         user_matricula = curr_user_mat
+        text_cols, joins = punch_text_columns(conn, name_as='name')
         base = f"""
-            SELECT t.matricula, t.user_name AS name,
-                   t.record_type, t.timestamp, t.neighborhood, t.city
-            FROM TimeRecords t
+            SELECT t.matricula, t.record_type, t.timestamp, {text_cols}
+            FROM {time_records_from(conn, start_date, end_date)} {joins}
         """
         params = []
         
@@ -771,23 +3510,26 @@ def get_user_report(curr_user_mat, role):
         params.append(user_matricula)
 
         if start_date:
-            # Handle both SQL Server and SQLite for date filtering
+            # Handle both SQL Server and SQLite for date filtering (SQLite uses the indexed epoch)
             if isinstance(conn, sqlite3.Connection):
-                base += " AND date(t.timestamp) >= ?"
+                base += " AND t.ts_epoch >= ?"
+                params.append(day_start_epoch(start_date))
             else:
                 base += f" AND CAST(t.timestamp AS DATE) >= {ph}"
-            params.append(start_date)
+                params.append(start_date)
         if end_date:
             if isinstance(conn, sqlite3.Connection):
-                base += " AND date(t.timestamp) <= ?"
+                base += " AND t.ts_epoch < ?"
+                params.append(day_start_epoch(end_date, 1))
             else:
                 base += f" AND CAST(t.timestamp AS DATE) <= {ph}"
-            params.append(end_date)
+                params.append(end_date)
             
         base += " ORDER BY t.timestamp DESC"
         cursor.execute(base, params)
         rows = cursor.fetchall()
         
+        import openpyxl
         wb = openpyxl.Workbook()
         ws = wb.active
         ws.title = "Meus Registros"
@@ -805,6 +3547,7 @@ def get_user_report(curr_user_mat, role):
         output = BytesIO()
         wb.save(output)
         output.seek(0)
+        metrics.observe('ponto_report_build_seconds', time.perf_counter() - t0, report='user')
         return send_file(output, download_name="meus_registros.xlsx", as_attachment=True)
     finally:
         try:
@@ -812,17 +3555,59 @@ def get_user_report(curr_user_mat, role):
         except:
             pass
 
+USERS_PAGE_DEFAULT = 50
+USERS_PAGE_MAX = 500
+
+def _like_prefix(q):
+    """Escapes LIKE wildcards so user input is matched literally as a prefix."""
+    return q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace('[', '\\[') + '%'
+
 @app.route('/api/admin/users', methods=['GET'])
 @token_required
 def get_users(curr_user_mat, role):
+    """
+    Lists users. Without query parameters the full list is returned (legacy
+    behaviour). With any of q, role, limit or cursor a page is returned as
+    {'users': [...], 'next_cursor': id | None}, ordered by id (keyset pagination).
+    """
     if role != 'admin':
         return jsonify({'message': 'Unauthorized'}), 401
+    args = request.args
+    paginated = any(k in args for k in ('q', 'role', 'limit', 'cursor'))
+    q = (args.get('q') or '').strip()
+    role_filter = (args.get('role') or '').strip()
+    try:
+        limit = int(args.get('limit', USERS_PAGE_DEFAULT))
+        cursor_id = int(args['cursor']) if args.get('cursor') else None
+    except ValueError:
+        return jsonify({'message': 'Parâmetros inválidos'}), 400
+    limit = max(1, min(limit, USERS_PAGE_MAX))
+
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
         is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = get_ph(conn)
         nolock = "" if is_sqlite else "WITH (NOLOCK)"
-        cursor.execute(f"SELECT id, matricula, name, role FROM Users {nolock}")
+        where = []
+        params = []
+        if q:
+            pattern = _like_prefix(q)
+            where.append(f"(matricula LIKE {ph} ESCAPE '\\' OR name LIKE {ph} ESCAPE '\\')")
+            params += [pattern, pattern]
+        if role_filter:
+            where.append(f"role = {ph}")
+            params.append(role_filter)
+        if cursor_id is not None:
+            where.append(f"id > {ph}")
+            params.append(cursor_id)
+        where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+        if not paginated:
+            cursor.execute(f"SELECT id, matricula, name, role FROM Users {nolock}")
+        elif is_sqlite:
+            cursor.execute(f"SELECT id, matricula, name, role FROM Users{where_sql} ORDER BY id LIMIT {limit + 1}", tuple(params))
+        else:
+            cursor.execute(f"SELECT TOP ({limit + 1}) id, matricula, name, role FROM Users {nolock}{where_sql} ORDER BY id", tuple(params))
         rows = cursor.fetchall()
         users = []
         for r in rows:
@@ -832,13 +3617,31 @@ def get_users(curr_user_mat, role):
                 'name': rf(r, 'name'),
                 'role': rf(r, 'role')
             })
-        return jsonify(users)
+        if not paginated:
+            return jsonify(users)
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = users[-1]['id']
+        return jsonify({'users': users, 'next_cursor': next_cursor})
     finally:
         try:
             conn.close()
         except:
             pass
 
+@app.route('/api/admin/users/suggest', methods=['GET'])
+@token_required
+def suggest_users(curr_user_mat, role):
+    """Autocomplete served from the in-memory prefix index."""
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 50))
+    except ValueError:
+        limit = 10
+    return jsonify(user_index.search(request.args.get('q', ''), limit, request.args.get('role') or None))
+
 @app.route('/api/admin/users', methods=['POST'])
 @token_required
 def create_user_admin(curr_user_mat, role):
@@ -865,13 +3668,14 @@ def create_user_admin(curr_user_mat, role):
             conn.commit()
         # mirror locally
         try:
-            sconn = sqlite3.connect(sqlite_path)
+            sconn = connect_local()
             scur = sconn.cursor()
             ensure_sqlite_schema(sconn)
             scur.execute("INSERT OR REPLACE INTO Users (matricula, password, name, role) VALUES (?, ?, ?, ?)", (matricula, hashed, name, new_role))
             sconn.commit()
             sconn.close()
         except: pass
+        user_index.invalidate()
         return jsonify({'message': 'Usuário criado'}), 201
     except Exception as e:
         msg = str(e)
@@ -883,6 +3687,190 @@ def create_user_admin(curr_user_mat, role):
             conn.close()
         except: pass
 
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', '20000'))
+IMPORT_HASH_WORKERS = int(os.getenv('IMPORT_HASH_WORKERS', str(os.cpu_count() or 2)))
+# SQL Server caps a statement at 2100 parameters and a VALUES list at 1000 rows
+IMPORT_BATCH_ROWS = 500
+# SQLite builds before 3.32 cap a statement at 999 parameters
+SQLITE_MAX_PARAMS = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+_import_pool = {'pid': None, 'pool': None}
+_import_pool_lock = threading.Lock()
+
+def import_hash_pool():
+    """The process pool hashing import passwords, started once per (worker) process."""
+    with _import_pool_lock:
+        if _import_pool['pid'] != os.getpid():
+            pool = ProcessPoolExecutor(max_workers=IMPORT_HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _import_pool.update(pid=os.getpid(), pool=pool)
+            atexit.register(pool.shutdown, wait=False)
+        return _import_pool['pool']
+
+def import_batch_rows(conn, columns):
+    """Rows per multi-row INSERT that stay under the backend's parameter limit."""
+    limit = SQLITE_MAX_PARAMS if isinstance(conn, sqlite3.Connection) else 2100
+    return max(1, min(IMPORT_BATCH_ROWS, limit // columns))
+
+IMPORT_COLUMNS = {
+    'matricula': 'matricula',
+    'nome': 'name', 'name': 'name',
+    'senha': 'password', 'password': 'password',
+    'perfil': 'role', 'role': 'role',
+}
+
+def _hash_password(raw):
+    """Top-level so it can be pickled into the import process pool."""
+    return bcrypt.hashpw(raw.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def _read_import_rows(filename, payload):
+    """Returns a list of dicts keyed by matricula/name/password/role from a CSV or XLSX upload."""
+    if filename.lower().endswith('.xlsx'):
+        import openpyxl
+        wb = openpyxl.load_workbook(BytesIO(payload), read_only=True, data_only=True)
+        try:
+            rows = [[("" if v is None else str(v)).strip() for v in r] for r in wb.active.iter_rows(values_only=True)]
+        finally:
+            wb.close()
+    else:
+        text = payload.decode('utf-8-sig', errors='replace')
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=';,\t')
+        except csv.Error:
+            dialect = csv.excel
+        rows = [[v.strip() for v in r] for r in csv.reader(io.StringIO(text), dialect)]
+    if not rows:
+        return []
+    header = [IMPORT_COLUMNS.get(h.lower()) for h in rows[0]]
+    out = []
+    for r in rows[1:]:
+        if not any(r):
+            continue
+        out.append({k: v for k, v in zip(header, r) if k})
+    return out
+
+def _existing_matriculas(conn, matriculas):
+    """Returns the subset of matriculas already present in Users, queried in chunks."""
+    ph = get_ph(conn)
+    nolock = "" if isinstance(conn, sqlite3.Connection) else "WITH (NOLOCK)"
+    found = set()
+    cur = conn.cursor()
+    for i in range(0, len(matriculas), IMPORT_BATCH_ROWS):
+        chunk = matriculas[i:i + IMPORT_BATCH_ROWS]
+        cur.execute(f"SELECT matricula FROM Users {nolock} WHERE matricula IN ({', '.join([ph] * len(chunk))})", tuple(chunk))
+        found.update(rf(r, 'matricula') for r in cur.fetchall())
+    return found
+
+@app.route('/api/admin/users/import', methods=['POST'])
+@token_required
+def import_users_admin(curr_user_mat, role):
+    """
+    Creates users from an uploaded CSV or XLSX file (columns: matricula, nome,
+    senha, perfil). Passwords are hashed on a process pool, the primary backend
+    receives batched multi-row INSERTs in a single transaction and the local
+    mirror is written with one executemany. Returns one result per data row.
+    """
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'message': 'Arquivo não enviado'}), 400
+    try:
+        rows = _read_import_rows(upload.filename, upload.read())
+    except Exception as e:
+        return jsonify({'message': f'Arquivo inválido: {e}'}), 400
+    if len(rows) > IMPORT_MAX_ROWS:
+        return jsonify({'message': f'Máximo de {IMPORT_MAX_ROWS} linhas por importação'}), 413
+
+    # Row numbers are 1-based and account for the header line
+    results = []
+    pending = []
+    seen = set()
+    for n, r in enumerate(rows, start=2):
+        mat, name, pw = r.get('matricula'), r.get('name'), r.get('password')
+        new_role = (r.get('role') or 'user').lower()
+        if new_role not in ('user', 'admin'):
+            new_role = 'user'
+        res = {'row': n, 'matricula': mat, 'status': 'created'}
+        results.append(res)
+        if not mat or not name or not pw:
+            res.update(status='error', message='Dados obrigatórios faltando')
+        elif mat in seen:
+            res.update(status='error', message='Matrícula duplicada no arquivo')
+        else:
+            seen.add(mat)
+            pending.append((res, mat, name, pw, new_role))
+
+    conn = get_db_connection()
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    ph = get_ph(conn)
+    try:
+        existing = _existing_matriculas(conn, [p[1] for p in pending]) if pending else set()
+        todo = []
+        for p in pending:
+            if p[1] in existing:
+                p[0].update(status='exists', message='Matrícula já existe')
+            else:
+                todo.append(p)
+
+        if todo:
+            t0 = time.time()
+            workers = max(1, min(IMPORT_HASH_WORKERS, len(todo)))
+            try:
+                hashes = list(import_hash_pool().map(_hash_password, [p[3] for p in todo],
+                                                     chunksize=max(1, len(todo) // (workers * 4))))
+            except BrokenProcessPool:
+                _import_pool['pid'] = None  # a child died: start a new pool on the next import
+                raise
+            log.info("import passwords hashed", extra={'rows': len(todo), 'seconds': round(time.time() - t0, 2), 'workers': workers})
+            values = [(p[1], h, p[2], p[4]) for p, h in zip(todo, hashes)]
+
+            cursor = conn.cursor()
+            try:
+                if not is_sqlite:
+                    cursor.execute("BEGIN TRANSACTION")
+                batch_rows = import_batch_rows(conn, 4)
+                for i in range(0, len(values), batch_rows):
+                    batch = values[i:i + batch_rows]
+                    row_ph = f"({ph}, {ph}, {ph}, {ph})"
+                    cursor.execute(
+                        f"INSERT INTO Users (matricula, password, name, role) VALUES {', '.join([row_ph] * len(batch))}",
+                        tuple(v for row in batch for v in row)
+                    )
+                if is_sqlite:
+                    conn.commit()
+                else:
+                    cursor.execute("COMMIT TRANSACTION")
+            except Exception as e:
+                try:
+                    if is_sqlite:
+                        conn.rollback()
+                    else:
+                        cursor.execute("IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION")
+                except Exception:
+                    pass
+                for p in todo:
+                    p[0].update(status='error', message=str(e))
+                return jsonify({'message': f'Erro na importação: {e}', 'results': results}), 500
+
+            # mirror locally in one statement
+            if not is_sqlite:
+                try:
+                    sconn = connect_local()
+                    ensure_sqlite_schema(sconn)
+                    sconn.executemany("INSERT OR REPLACE INTO Users (matricula, password, name, role) VALUES (?, ?, ?, ?)", values)
+                    sconn.commit()
+                    sconn.close()
+                except Exception:
+                    pass
+            user_index.invalidate()
+
+        summary = {}
+        for res in results:
+            summary[res['status']] = summary.get(res['status'], 0) + 1
+        return jsonify({'message': f"{summary.get('created', 0)} usuários importados", 'summary': summary, 'results': results}), 200
+    finally:
+        try: conn.close()
+        except: pass
+
 @app.route('/api/admin/users/<int:user_id>', methods=['PUT'])
 @token_required
 def update_user(curr_user_mat, role, user_id):
@@ -920,16 +3908,36 @@ def update_user(curr_user_mat, role, user_id):
         old_row = cursor.fetchone()
         old_mat = rf(old_row, 'matricula') if old_row else None
 
+        new_mat = data.get('matricula') or None
+        rekey = bool(old_mat and new_mat and new_mat != old_mat)
+
         query = f"UPDATE Users SET {', '.join(fields)} WHERE id = {ph}"
         values.append(user_id)
-        cursor.execute(query, tuple(values))
+        if rekey and not is_sqlite:
+            # punches are looked up by matricula: move them (and archived months)
+            # with the user, in the same transaction as the Users row
+            tables = ['TimeRecords'] + archive_tables(conn)
+            cursor.execute("BEGIN TRANSACTION")
+            try:
+                cursor.execute(query, tuple(values))
+                for table in tables:
+                    cursor.execute(f"UPDATE {table} SET matricula = {ph} WHERE matricula = {ph}", (new_mat, old_mat))
+                cursor.execute("COMMIT TRANSACTION")
+            except Exception:
+                try:
+                    cursor.execute("IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION")
+                except Exception:
+                    pass
+                raise
+        else:
+            cursor.execute(query, tuple(values))
         if isinstance(conn, sqlite3.Connection) or ph == '?':
             conn.commit()
             
         # Mirror update locally using old_mat
         if old_mat:
             try:
-                sconn = sqlite3.connect(sqlite_path)
+                sconn = connect_local()
                 ensure_sqlite_schema(sconn)
                 scur = sconn.cursor()
                 lfields = []
@@ -944,7 +3952,22 @@ def update_user(curr_user_mat, role, user_id):
                     sconn.commit()
                 sconn.close()
             except: pass
-            
+            if rekey:
+                try:
+                    sconn = connect_local()
+                    try:
+                        moved = rekey_local_punches(sconn, old_mat, new_mat)
+                        sconn.commit()
+                    finally:
+                        sconn.close()
+                    log.info("local punches re-keyed", extra={'matricula': new_mat, 'previous': old_mat, 'rows': moved})
+                except Exception as e:
+                    log.error("could not re-key local punches", extra={'matricula': new_mat, 'previous': old_mat,
+                                                                      'error': str(e)})
+                presence.invalidate()
+                request_publish_sites()
+
+        user_index.invalidate()
         return jsonify({'message': 'Usuário atualizado'}), 200
     except Exception as e:
         msg = str(e)
@@ -977,12 +4000,14 @@ def delete_user(curr_user_mat, role, user_id):
         
         if mat:
             try:
-                sconn = sqlite3.connect(sqlite_path)
+                sconn = connect_local()
                 scur = sconn.cursor()
                 scur.execute("DELETE FROM Users WHERE matricula = ?", (mat,))
                 sconn.commit()
                 sconn.close()
             except: pass
+        user_index.invalidate()
+        presence.invalidate()
         return jsonify({'message': 'Usuário excluído'}), 200
     except Exception as e:
         return jsonify({'message': str(e)}), 500
@@ -990,92 +4015,258 @@ def delete_user(curr_user_mat, role, user_id):
         try: conn.close()
         except: pass
 
-@app.route('/api/admin/users/bulk-delete', methods=['POST'])
+# Background jobs (bulk operations). The job dict lives in the process that
+# runs it and is saved to local.db (BackgroundJobs) while it runs, so
+# /api/admin/jobs/<id> answers from whichever serve.py worker gets the poll.
+BACKGROUND_JOBS = {}
+jobs_lock = threading.Lock()
+JOBS_KEEP = 50
+JOB_SAVE_INTERVAL = 1.0  # seconds between progress saves
+JOB_STALE_SECONDS = 30  # a running job not saved for this long died with its process
+
+def save_job(job):
+    try:
+        conn = connect_local()
+        try:
+            conn.execute("INSERT OR REPLACE INTO BackgroundJobs (id, data, finished_at, updated_at) VALUES (?, ?, ?, ?)",
+                         (job['id'], json.dumps(dict(job, progress=dict(job['progress'])), default=str),
+                          job['finished_at'], time.time()))
+            if job['finished_at']:
+                conn.execute("""
+                    DELETE FROM BackgroundJobs WHERE finished_at IS NOT NULL AND id NOT IN (
+                        SELECT id FROM BackgroundJobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?)
+                """, (JOBS_KEEP,))
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        log.warning("could not save job", extra={'job': job['id'], 'error': str(e)})
+
+def load_job(job_id):
+    """The job as last saved by the process running it, or None."""
+    conn = connect_local()
+    try:
+        ensure_sqlite_schema(conn)
+        row = conn.execute("SELECT data, updated_at FROM BackgroundJobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    job = json.loads(row[0])
+    if job['status'] in ('queued', 'running') and time.time() - row[1] > JOB_STALE_SECONDS:
+        job.update(status='error', error='Tarefa interrompida (o processo que a executava parou)')
+    return job
+
+def start_job(kind, target, *args):
+    """Runs target(job, *args) on a daemon thread and returns the job dict."""
+    job_id = f"{kind}-{uuid.uuid4().hex[:12]}"
+    job = {'id': job_id, 'kind': kind, 'status': 'queued', 'progress': {},
+           'started_at': None, 'finished_at': None, 'error': None}
+    with jobs_lock:
+        BACKGROUND_JOBS[job_id] = job
+        # Drop the oldest finished jobs
+        finished = [j for j in BACKGROUND_JOBS.values() if j['finished_at']]
+        for old in sorted(finished, key=lambda j: j['finished_at'])[:max(0, len(BACKGROUND_JOBS) - JOBS_KEEP)]:
+            BACKGROUND_JOBS.pop(old['id'], None)
+    save_job(job)
+    done = threading.Event()
+
+    def saver():
+        while not done.wait(JOB_SAVE_INTERVAL):
+            save_job(job)
+
+    def run():
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        threading.Thread(target=saver, daemon=True).start()
+        try:
+            target(job, *args)
+            job['status'] = 'done'
+        except Exception as e:
+            log.error("job failed", extra={'job': job_id, 'error': str(e)})
+            job['status'] = 'error'
+            job['error'] = str(e)
+        finally:
+            job['finished_at'] = time.time()
+            done.set()
+            save_job(job)
+
+    threading.Thread(target=run, daemon=True).start()
+    return job
+
+@app.route('/api/admin/jobs/<job_id>', methods=['GET'])
 @token_required
-def bulk_delete_users(curr_user_mat, role):
+def get_job(curr_user_mat, role, job_id):
     if role != 'admin':
         return jsonify({'message': 'Unauthorized'}), 401
-    data = request.json
-    ids = data.get('user_ids', [])
-    if not ids: return jsonify({'message': 'Nenhum selecionado'}), 400
-    
+    job = BACKGROUND_JOBS.get(job_id) or load_job(job_id)
+    if not job:
+        return jsonify({'message': 'Tarefa não encontrada'}), 404
+    return jsonify(job)
+
+DELETE_CHUNK_USERS = 500
+DELETE_CHUNK_ROWS = int(os.getenv('DELETE_CHUNK_ROWS', '1000'))
+# Pause between chunks so punch inserts can take the TimeRecords locks
+DELETE_CHUNK_PAUSE = float(os.getenv('DELETE_CHUNK_PAUSE', '0.05'))
+
+def _delete_in_chunks(conn, table, where, params):
+    """
+    Deletes matching rows of `table` at most DELETE_CHUNK_ROWS at a time, each
+    chunk committed on its own so locks stay short (and below SQL Server's lock
+    escalation threshold). Returns the number of rows deleted.
+    """
+    is_sqlite = isinstance(conn, sqlite3.Connection)
+    cur = conn.cursor()
+    total = 0
+    while True:
+        if is_sqlite:
+            cur.execute(f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE {where} LIMIT {DELETE_CHUNK_ROWS})", params)
+            conn.commit()
+        else:
+            cur.execute(f"DELETE TOP ({DELETE_CHUNK_ROWS}) FROM {table} WHERE {where}", params)
+            if get_ph(conn) == '?':
+                conn.commit()
+        n = cur.rowcount or 0
+        total += n
+        if n < DELETE_CHUNK_ROWS:
+            return total
+        time.sleep(DELETE_CHUNK_PAUSE)
+
+def _bulk_delete_job(job, ids):
+    progress = job['progress']
+    progress.update(total_users=len(ids), deleted_users=0, deleted_records=0, deleted_local_records=0)
     conn = get_db_connection()
-    ph = get_ph(conn)
-    cursor = conn.cursor()
     try:
         is_sqlite = isinstance(conn, sqlite3.Connection)
+        ph = get_ph(conn)
         nolock = "" if is_sqlite else "WITH (NOLOCK)"
-        placeholders = ', '.join([ph]*len(ids))
-        
-        # Get matriculas for local delete
-        cursor.execute(f"SELECT matricula FROM Users {nolock} WHERE id IN ({placeholders})", tuple(ids))
-        mats = [rf(r, 'matricula') for r in cursor.fetchall()]
-        
-        cursor.execute(f"DELETE FROM TimeRecords WHERE user_id IN ({placeholders})", tuple(ids))
-        cursor.execute(f"DELETE FROM Users WHERE id IN ({placeholders})", tuple(ids))
-        if is_sqlite or ph == '?': conn.commit()
-        
-        if mats:
-            try:
-                sconn = sqlite3.connect(sqlite_path)
-                scur = sconn.cursor()
-                m_ph = ', '.join(['?']*len(mats))
-                scur.execute(f"DELETE FROM Users WHERE matricula IN ({m_ph})", tuple(mats))
-                sconn.commit()
-                sconn.close()
-            except: pass
-        return jsonify({'message': f'{len(ids)} excluídos'}), 200
-    except Exception as e:
-        return jsonify({'message': str(e)}), 500
+        cursor = conn.cursor()
+        for i in range(0, len(ids), DELETE_CHUNK_USERS):
+            chunk = ids[i:i + DELETE_CHUNK_USERS]
+            id_ph = ', '.join([ph] * len(chunk))
+            cursor.execute(f"SELECT matricula FROM Users {nolock} WHERE id IN ({id_ph})", tuple(chunk))
+            mats = [rf(r, 'matricula') for r in cursor.fetchall() if rf(r, 'matricula')]
+
+            # Records may be keyed by user_id, by matricula or both. One loop
+            # per key, so each can seek an index on its column (an OR of the
+            # two scans the table).
+            keys = [(f"user_id IN ({id_ph})", tuple(chunk))]
+            if mats:
+                keys.append((f"matricula IN ({', '.join([ph] * len(mats))})", tuple(mats)))
+            for table in ['TimeRecords'] + archive_tables(conn):
+                for where, params in keys:
+                    progress['deleted_records'] += _delete_in_chunks(conn, table, where, params)
+            progress['deleted_users'] += _delete_in_chunks(conn, 'Users', f"id IN ({id_ph})", tuple(chunk))
+
+            # Mirror locally so queued punches are not re-synced for removed users
+            if mats and not is_sqlite:
+                sconn = connect_local()
+                try:
+                    ensure_sqlite_schema(sconn)
+                    m_ph = ', '.join(['?'] * len(mats))
+                    for table in ['TimeRecords', 'OfflineQueue'] + archive_tables(sconn):
+                        progress['deleted_local_records'] += _delete_in_chunks(sconn, table, f"matricula IN ({m_ph})", tuple(mats))
+                    sconn.execute(f"DELETE FROM Users WHERE matricula IN ({m_ph})", tuple(mats))
+                    sconn.commit()
+                finally:
+                    sconn.close()
+            elif mats:
+                progress['deleted_local_records'] += _delete_in_chunks(conn, 'OfflineQueue', f"matricula IN ({', '.join(['?'] * len(mats))})", tuple(mats))
+            user_index.invalidate()
+            presence.invalidate()
     finally:
         try: conn.close()
         except: pass
 
+@app.route('/api/admin/users/bulk-delete', methods=['POST'])
+@token_required
+def bulk_delete_users(curr_user_mat, role):
+    """Starts a chunked background delete; poll /api/admin/jobs/<job_id> for progress."""
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    data = request.json
+    try:
+        ids = sorted({int(i) for i in data.get('user_ids', [])})
+    except (TypeError, ValueError):
+        return jsonify({'message': 'IDs inválidos'}), 400
+    if not ids: return jsonify({'message': 'Nenhum selecionado'}), 400
+
+    job = start_job('bulk-delete', _bulk_delete_job, ids)
+    return jsonify({'message': f'Exclusão de {len(ids)} usuários iniciada', 'job_id': job['id']}), 202
+
 @app.route('/api/admin/report', methods=['GET'])
 @token_required
 def get_admin_report_excel(curr_user_mat, role):
     if role != 'admin':
         return jsonify({'message': 'Unauthorized'}), 401
     target_user_id = request.args.get('user_id')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    geofence = request.args.get('geofence')
+    if geofence and geofence not in GEOFENCE_STATUSES:
+        return jsonify({'message': f"geofence deve ser um de: {', '.join(GEOFENCE_STATUSES)}"}), 400
+    t0 = time.perf_counter()
     conn = get_db_connection()
     ph = get_ph(conn)
     try:
         cursor = conn.cursor()
-        query = """
-            SELECT t.matricula, t.user_name AS name,
-                   t.record_type, t.timestamp, t.neighborhood, t.city
-            FROM TimeRecords t
+        is_sqlite = isinstance(conn, sqlite3.Connection)
+        text_cols, joins = punch_text_columns(conn, name_as='name')
+        query = f"""
+            SELECT t.matricula, t.record_type, t.timestamp, {text_cols}, t.geofence, t.geofence_m
+            FROM {time_records_from(conn, start_date, end_date)} {joins}
         """
+        where = []
         params = []
         if target_user_id:
-            query += f" WHERE t.user_id = {ph}"
+            where.append(f"t.user_id = {ph}")
             params.append(target_user_id)
+        if start_date:
+            where.append("t.ts_epoch >= ?" if is_sqlite else f"CAST(t.timestamp AS DATE) >= {ph}")
+            params.append(day_start_epoch(start_date) if is_sqlite else start_date)
+        if end_date:
+            where.append("t.ts_epoch < ?" if is_sqlite else f"CAST(t.timestamp AS DATE) <= {ph}")
+            params.append(day_start_epoch(end_date, 1) if is_sqlite else end_date)
+        if geofence == 'unknown':
+            where.append(f"(t.geofence = {ph} OR t.geofence IS NULL)")  # records from before the geofence
+            params.append(geofence)
+        elif geofence:
+            where.append(f"t.geofence = {ph}")
+            params.append(geofence)
+        if where:
+            query += " WHERE " + " AND ".join(where)
         query += " ORDER BY t.timestamp DESC"
         
         cursor.execute(query, params)
         rows = cursor.fetchall()
+        import openpyxl
         wb = openpyxl.Workbook()
         if target_user_id:
             ws = wb.active
             ws.title = "Relatorio"
-            ws.append(["Matricula", "Nome", "Tipo", "Data/Hora", "Bairro", "Cidade"])
+            ws.append(["Matricula", "Nome", "Tipo", "Data/Hora", "Bairro", "Cidade", "Cerca", "Distância (m)"])
             for r in rows:
-                ws.append([rf(r,'matricula'), rf(r,'name'), rf(r,'record_type'), rf(r,'timestamp'), rf(r,'neighborhood'), rf(r,'city')])
+                ws.append([rf(r,'matricula'), rf(r,'name'), rf(r,'record_type'), rf(r,'timestamp'), rf(r,'neighborhood'), rf(r,'city'),
+                           GEOFENCE_LABELS.get(rf(r,'geofence'), ''), rf(r,'geofence_m')])
         else:
             wb.remove(wb.active)
             groups = {}
             for r in rows:
                 k = (rf(r,'matricula'), rf(r,'name'))
                 groups.setdefault(k, []).append(r)
+            if not groups:
+                wb.create_sheet(title="Relatorio").append(["Matricula", "Nome", "Tipo", "Data/Hora", "Bairro", "Cidade", "Cerca", "Distância (m)"])
             for (m, n), items in groups.items():
                 ws = wb.create_sheet(title=(n or m or "User")[:30])
-                ws.append(["Matricula", "Nome", "Tipo", "Data/Hora", "Bairro", "Cidade"])
+                ws.append(["Matricula", "Nome", "Tipo", "Data/Hora", "Bairro", "Cidade", "Cerca", "Distância (m)"])
                 for r in items:
-                    ws.append([rf(r,'matricula'), rf(r,'name'), rf(r,'record_type'), rf(r,'timestamp'), rf(r,'neighborhood'), rf(r,'city')])
+                    ws.append([rf(r,'matricula'), rf(r,'name'), rf(r,'record_type'), rf(r,'timestamp'), rf(r,'neighborhood'), rf(r,'city'),
+                               GEOFENCE_LABELS.get(rf(r,'geofence'), ''), rf(r,'geofence_m')])
         
         out = BytesIO()
         wb.save(out)
         out.seek(0)
+        metrics.observe('ponto_report_build_seconds', time.perf_counter() - t0, report='admin')
         return send_file(out, download_name="relatorio_admin.xlsx", as_attachment=True)
     finally:
         try: conn.close()
@@ -1086,6 +4277,27 @@ def get_admin_report_excel(curr_user_mat, role):
 def export_excel_legacy(curr_user_mat, role):
     return get_admin_report_excel(curr_user_mat, role)
 
+@app.route('/api/admin/archive', methods=['GET'])
+@token_required
+def list_archive(curr_user_mat, role):
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    conn = get_db_connection()
+    try:
+        return jsonify({'keep_months': ARCHIVE_KEEP_MONTHS, 'cutoff': archive_cutoff().strftime('%Y-%m-%d'),
+                        'months': list_archived_months(conn, refresh=True)})
+    finally:
+        try: conn.close()
+        except: pass
+
+@app.route('/api/admin/archive', methods=['POST'])
+@token_required
+def run_archive(curr_user_mat, role):
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    job = start_job('archive', archive_closed_months)
+    return jsonify({'message': 'Arquivamento iniciado', 'job_id': job['id']}), 202
+
 @app.route('/api/admin/sync_all', methods=['POST'])
 @token_required
 def sync_all_users_admin(curr_user_mat, role):
@@ -1104,7 +4316,7 @@ def refresh_local_users():
         cursor.execute("SELECT matricula, password, name, role FROM Users WITH (NOLOCK)")
         users = cursor.fetchall()
         
-        sconn = sqlite3.connect(sqlite_path)
+        sconn = connect_local()
         scur = sconn.cursor()
         ensure_sqlite_schema(sconn)
         for u in users:
@@ -1121,11 +4333,25 @@ def sync_now(curr_user_mat, role):
     migrated, errs = perform_sync_for_user(curr_user_mat)
     return jsonify({'message': f'Sincronização concluída. {migrated} registros enviados.', 'migrated': migrated, 'errors': errs}), 200
 
+SYNC_LAST_RATE = 0.0
+
 def perform_sync_for_user(user_matricula):
     """
     Core sync logic that can be called via API or background thread.
     Returns (migrated_count, errors_list)
     """
+    global SYNC_LAST_RATE
+    t0 = time.perf_counter()
+    migrated, errs = _sync_user(user_matricula)
+    elapsed = time.perf_counter() - t0
+    metrics.observe('ponto_sync_seconds', elapsed)
+    if migrated:
+        metrics.inc('ponto_sync_rows_total', migrated)
+        SYNC_LAST_RATE = migrated / elapsed if elapsed > 0 else 0.0
+        status_broadcaster.notify(queue_changed=True)
+    return migrated, errs
+
+def _sync_user(user_matricula):
     forced = os.getenv('FORCE_ONLINE', 'false').lower() == 'true'
     is_sql = sql_online() or forced
     
@@ -1148,7 +4374,7 @@ def perform_sync_for_user(user_matricula):
             except: pass
 
     # Get user info from local SQLite
-    lconn = sqlite3.connect(sqlite_path)
+    lconn = connect_local()
     lconn.row_factory = sqlite3.Row
     try:
         local_user_id, l_user_name = get_user_info_by_matricula(user_matricula, lconn)
@@ -1164,19 +4390,25 @@ def perform_sync_for_user(user_matricula):
     if not is_sql:
         # Local-only sync (SQL to SQLite Mirror)
         try:
-            sconn = sqlite3.connect(sqlite_path)
+            sconn = connect_local()
             sconn.row_factory = sqlite3.Row
             ensure_sqlite_schema(sconn)
             scur = sconn.cursor()
             # Catch matricula, null matricula, or empty string matricula
-            scur.execute("SELECT id, record_type, neighborhood, city, timestamp FROM OfflineQueue WHERE matricula = ? OR matricula IS NULL OR matricula = '' AND user_id = ? ORDER BY timestamp ASC", (user_matricula, local_user_id))
+            scur.execute(f"SELECT id, record_type, neighborhood, city, location_id, timestamp, ts_epoch, {GEO_INSERT_COLUMNS} FROM OfflineQueue WHERE matricula = ? OR matricula IS NULL OR matricula = '' AND user_id = ? ORDER BY ts_epoch ASC", (user_matricula, local_user_id))
             rows = scur.fetchall()
             migrated = 0
             for r in rows:
+                epoch = row_epoch(r)
+                # location_id is copied as is: both tables share the local Locations dictionary
                 scur.execute(
-                    "INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    (sync_user_id, user_matricula, user_name, rf(r, 'record_type'), rf(r, 'neighborhood'), rf(r, 'city'), rf(r, 'timestamp'))
+                    f"INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, location_id, timestamp, ts_epoch, tz, {GEO_INSERT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (sync_user_id, user_matricula, user_name, rf(r, 'record_type'),
+                     rf(r, 'neighborhood'), rf(r, 'city'), rf(r, 'location_id'),
+                     format_ts(epoch) if epoch is not None else rf(r, 'timestamp'), epoch, LOCAL_TZ_NAME) + geo_values(r)
                 )
+                rollup_punch(sconn, user_matricula, rf(r, 'record_type'), epoch if epoch is not None else rf(r, 'timestamp'),
+                             rf(r, 'location_id') or locations.id_for(sconn, rf(r, 'neighborhood'), rf(r, 'city')))
                 scur.execute("DELETE FROM OfflineQueue WHERE id = ?", (rf(r, 'id'),))
                 migrated += 1
             sconn.commit()
@@ -1197,17 +4429,15 @@ def perform_sync_for_user(user_matricula):
         existing_sigs = set()
         errs = []
         try:
-            import pymssql
-            sph = '%s' if isinstance(conn, pymssql.Connection) else '?'
-            cursor.execute(f"SELECT record_type, timestamp FROM TimeRecords WITH (NOLOCK) WHERE matricula = {sph}", (user_matricula,))
+            sph = get_ph(conn)
+            # Include archived months so old local rows are not re-inserted
+            cursor.execute(f"SELECT t.record_type, t.timestamp FROM {time_records_from(conn)} WHERE t.matricula = {sph}", (user_matricula,))
             for r in cursor.fetchall():
-                ts_str = str(rf(r, 1)) # Use index if not as_dict
-                if '.' in ts_str: ts_str = ts_str.split('.')[0]
-                existing_sigs.add((rf(r, 0), ts_str))
+                existing_sigs.add((rf(r, 'record_type'), to_epoch(rf(r, 'timestamp'))))
         except Exception as e:
             errs.append(f"Error fetching online records: {e}")
 
-        sconn = sqlite3.connect(sqlite_path)
+        sconn = connect_local()
         sconn.row_factory = sqlite3.Row
         ensure_sqlite_schema(sconn)
         scur = sconn.cursor()
@@ -1215,54 +4445,49 @@ def perform_sync_for_user(user_matricula):
         migrated = 0
         # 1. Sync local TimeRecords
         try:
-            scur.execute("SELECT record_type, timestamp, neighborhood, city, matricula FROM TimeRecords WHERE matricula = ? OR ((matricula IS NULL OR matricula = '') AND user_id = ?)", (user_matricula, local_user_id))
+            text_cols, joins = punch_text_columns(sconn)
+            scur.execute(f"SELECT t.id, t.record_type, t.timestamp, t.ts_epoch, {text_cols}, t.matricula, {', '.join('t.' + c for c in GEO_COLUMN_NAMES)} FROM {time_records_from(sconn)} {joins} WHERE t.matricula = ? OR ((t.matricula IS NULL OR t.matricula = '') AND t.user_id = ?)", (user_matricula, local_user_id))
             local_rows = scur.fetchall()
             for r in local_rows:
-                ts_val = rf(r, 'timestamp')
+                cmp_ts = row_epoch(r)
+                if cmp_ts is None:
+                    continue
                 # Standardize to datetime object for SQL Server
-                if isinstance(ts_val, str):
-                    try:
-                        if '.' in ts_val: ts_val = datetime.datetime.strptime(ts_val, "%Y-%m-%d %H:%M:%S.%f")
-                        else: ts_val = datetime.datetime.strptime(ts_val, "%Y-%m-%d %H:%M:%S")
-                    except: pass
-
-                cmp_ts = str(ts_val).split('.')[0]
+                ts_val = from_epoch(cmp_ts)
                 if (rf(r, 'record_type'), cmp_ts) not in existing_sigs:
                     try:
-                        import pymssql
-                        sph = '%s' if isinstance(conn, pymssql.Connection) else '?'
-                        query_ins = f"INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, timestamp) VALUES ({sph}, {sph}, {sph}, {sph}, {sph}, {sph}, {sph})"
-                        cursor.execute(query_ins, (sync_user_id, user_matricula, user_name, rf(r, 'record_type'), rf(r, 'neighborhood'), rf(r, 'city'), ts_val))
+                        sph = get_ph(conn)
+                        query_ins = f"INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, timestamp, {GEO_INSERT_COLUMNS}) VALUES ({', '.join([sph] * (7 + len(GEO_COLUMN_NAMES)))})"
+                        cursor.execute(query_ins, (sync_user_id, user_matricula, user_name, rf(r, 'record_type'), rf(r, 'neighborhood'), rf(r, 'city'), ts_val) + geo_values(r))
                         migrated += 1
                         existing_sigs.add((rf(r, 'record_type'), cmp_ts))
                         # Heal local
                         if not rf(r, 'matricula'):
-                             scur.execute("UPDATE TimeRecords SET matricula = ?, user_name = ? WHERE timestamp = ? AND record_type = ?", (user_matricula, user_name, rf(r, 'timestamp'), rf(r, 'record_type')))
+                             scur.execute("UPDATE TimeRecords SET matricula = ?, user_name = ? WHERE id = ?", (user_matricula, user_name, rf(r, 'id')))
                     except Exception as e:
                         errs.append(str(e))
         except: pass
 
         # 2. Process OfflineQueue
-        scur.execute("SELECT id, record_type, neighborhood, city, timestamp, user_id, matricula FROM OfflineQueue WHERE matricula = ? OR ((matricula IS NULL OR matricula = '') AND (user_id = ? OR user_id = ?)) ORDER BY timestamp ASC", (user_matricula, local_user_id, sql_user_id))
+        text_cols, joins = punch_text_columns(sconn)
+        scur.execute(f"SELECT t.id, t.record_type, {text_cols}, t.location_id, t.timestamp, t.ts_epoch, t.user_id, t.matricula, {', '.join('t.' + c for c in GEO_COLUMN_NAMES)} FROM OfflineQueue t {joins} WHERE t.matricula = ? OR ((t.matricula IS NULL OR t.matricula = '') AND (t.user_id = ? OR t.user_id = ?)) ORDER BY t.ts_epoch ASC", (user_matricula, local_user_id, sql_user_id))
         rows = scur.fetchall()
         for r in rows:
-            ts_val = rf(r, 'timestamp')
+            cmp_ts = row_epoch(r)
+            if cmp_ts is None:
+                errs.append(f"Invalid timestamp in OfflineQueue id {rf(r, 'id')}")
+                continue
             # Standardize for SQL Server
-            ts_dt = ts_val
-            if isinstance(ts_val, str):
-                try:
-                    if '.' in ts_val: ts_dt = datetime.datetime.strptime(ts_val, "%Y-%m-%d %H:%M:%S.%f")
-                    else: ts_dt = datetime.datetime.strptime(ts_val, "%Y-%m-%d %H:%M:%S")
-                except: pass
-
-            cmp_ts = str(ts_dt).split('.')[0]
+            ts_dt = from_epoch(cmp_ts)
             if (rf(r, 'record_type'), cmp_ts) not in existing_sigs:
                 try:
-                    import pymssql
-                    sph = '%s' if isinstance(conn, pymssql.Connection) else '?'
-                    cursor.execute(f"INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, timestamp) VALUES ({sph},{sph},{sph},{sph},{sph},{sph},{sph})",
-                                   (sync_user_id, user_matricula, user_name, rf(r, 'record_type'), rf(r, 'neighborhood'), rf(r, 'city'), ts_dt))
+                    sph = get_ph(conn)
+                    cursor.execute(f"INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, neighborhood, city, timestamp, {GEO_INSERT_COLUMNS}) VALUES ({','.join([sph] * (7 + len(GEO_COLUMN_NAMES)))})",
+                                   (sync_user_id, user_matricula, user_name, rf(r, 'record_type'), rf(r, 'neighborhood'), rf(r, 'city'), ts_dt) + geo_values(r))
                     migrated += 1
+                    existing_sigs.add((rf(r, 'record_type'), cmp_ts))
+                    rollup_punch(sconn, user_matricula, rf(r, 'record_type'), cmp_ts,
+                                 rf(r, 'location_id') or locations.id_for(sconn, rf(r, 'neighborhood'), rf(r, 'city')))
                     scur.execute("DELETE FROM OfflineQueue WHERE id = ?", (rf(r, 'id'),))
                 except Exception as e:
                     errs.append(str(e))
@@ -1279,9 +4504,9 @@ def perform_sync_for_user(user_matricula):
 
 def auto_sync_all():
     """Finds all users with pending items and syncs them."""
-    print("DEBUG: Starting automatic background synchronization...")
+    log.info("starting automatic background synchronization")
     try:
-        sconn = sqlite3.connect(sqlite_path)
+        sconn = connect_local()
         sconn.row_factory = sqlite3.Row
         scur = sconn.cursor()
         # Find all distinct matriculas and user_ids in the queue
@@ -1302,20 +4527,321 @@ def auto_sync_all():
                 m = rf(u_row, 'matricula') if u_row else None
             
             if m and m not in synced_users:
-                print(f"DEBUG: Auto-syncing for matricula: {m}")
+                log.debug("auto-syncing user", extra={'matricula': m})
                 migrated, errs = perform_sync_for_user(m)
                 total_migrated += migrated
                 synced_users.add(m)
         
         sconn.close()
         if total_migrated > 0:
-            print(f"DEBUG: Automatic sync complete. {total_migrated} records synchronized.")
+            log.info("automatic sync complete", extra={'rows': total_migrated})
+    except Exception as e:
+        log.error("auto-sync error", extra={'error': str(e)})
+
+# On-demand statistical profiler: samples every thread's Python stack at a
+# fixed rate and returns collapsed stacks ("thread;file:func;... count"), the
+# input format of flamegraph.pl and speedscope. Only the worker process that
+# receives the request is profiled.
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_HZ = 100
+PROFILE_IDLE_FRAMES = {
+    'threading.py:wait', 'threading.py:_wait_for_tstate_lock', 'queue.py:get',
+    'selectors.py:select', 'socketserver.py:serve_forever', 'socket.py:accept',
+    'connection.py:wait', 'base_events.py:_run_once',
+}
+_profile_lock = threading.Lock()
+
+def sample_stacks(seconds, hz=PROFILE_DEFAULT_HZ, include_idle=False):
+    """Samples all other threads for `seconds`. Returns ({collapsed_stack: count}, samples)."""
+    me = threading.get_ident()
+    interval = 1.0 / hz
+    counts = {}
+    samples = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if not stack or (not include_idle and stack[0] in PROFILE_IDLE_FRAMES):
+                continue
+            stack.append(names.get(ident, str(ident)).replace(' ', '_').replace(';', '_'))
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+@app.route('/api/admin/profile', methods=['GET', 'POST'])
+@token_required
+def profile_server(curr_user_mat, role):
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    try:
+        seconds = min(float(request.args.get('seconds', '10')), PROFILE_MAX_SECONDS)
+        hz = min(max(float(request.args.get('hz', str(PROFILE_DEFAULT_HZ))), 1), 1000)
+    except ValueError:
+        return jsonify({'message': 'Parâmetros inválidos'}), 400
+    if seconds <= 0:
+        return jsonify({'message': 'Parâmetros inválidos'}), 400
+    include_idle = request.args.get('idle', '0') in ('1', 'true')
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({'message': 'Já existe uma coleta de perfil em andamento'}), 409
+    try:
+        log.info("profiling started", extra={'seconds': seconds, 'hz': hz, 'by': curr_user_mat})
+        counts, samples = sample_stacks(seconds, hz, include_idle)
+    finally:
+        _profile_lock.release()
+    body = ''.join(f"{stack} {n}\n" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]))
+    out = BytesIO(body.encode('utf-8'))
+    name = f"profile-{os.getpid()}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.folded"
+    response = send_file(out, download_name=name, as_attachment=True, mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples)
+    response.headers['X-Profile-Pid'] = str(os.getpid())
+    return response
+
+OFFLINE_QUEUE_DEPTH_TTL = 5.0
+_queue_depth_cache = [0.0, 0]
+
+def offline_queue_depth():
+    """Row count of the local OfflineQueue, cached briefly so scrapes stay cheap."""
+    now = time.monotonic()
+    if now - _queue_depth_cache[0] > OFFLINE_QUEUE_DEPTH_TTL:
+        conn = connect_local()
+        try:
+            ensure_sqlite_schema(conn)
+            _queue_depth_cache[1] = conn.execute("SELECT COUNT(*) FROM OfflineQueue").fetchone()[0]
+            _queue_depth_cache[0] = now
+        finally:
+            conn.close()
+    return _queue_depth_cache[1]
+
+# Status push: one StatusBroadcaster per process watches sql_online() and the
+# OfflineQueue depth while someone is subscribed, and wakes the subscribers
+# (SSE streams) when either changes. check_db_status, punches that land in the
+# queue and syncs call notify() so changes go out at once; changes made by other
+# processes are picked up within SSE_POLL_INTERVAL (queue depth: its cache TTL).
+SSE_HEARTBEAT = float(os.getenv('SSE_HEARTBEAT', '15'))  # seconds between keep-alive comments
+SSE_POLL_INTERVAL = 1.0
+# Per process for streams served by Flask (WSGI, and the Flask routes under asgi.py):
+# each open stream holds a thread (idle between events, but one thread and its stack). serve.py
+# lowers it to half of --threads under gunicorn, whose thread pool is fixed.
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', '32'))
+
+def status_snapshot():
+    return {'online': True, 'db_online': sql_online(), 'queue_depth': offline_queue_depth()}
+
+class StatusBroadcaster:
+    def __init__(self):
+        self.state = None
+        self.version = 0
+        self._listeners = set()
+        self._lock = threading.Lock()
+        self._kick = threading.Event()
+        self._watching = False
+
+    def subscribe(self, callback):
+        """Registers callback() (called from the watcher thread on every change). Returns (version, state)."""
+        with self._lock:
+            self._listeners.add(callback)
+            if not self._watching:
+                self._watching = True
+                self.state = status_snapshot()
+                self.version += 1
+                threading.Thread(target=self._watch, daemon=True).start()
+            return self.version, self.state
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._listeners.discard(callback)
+
+    def subscribers(self):
+        return len(self._listeners)
+
+    def notify(self, queue_changed=False):
+        """Something changed in this process: recompute now instead of at the next poll."""
+        if queue_changed:
+            _queue_depth_cache[0] = 0.0
+        self._kick.set()
+
+    def _watch(self):
+        while True:
+            self._kick.wait(SSE_POLL_INTERVAL)
+            self._kick.clear()
+            with self._lock:
+                if not self._listeners:
+                    self._watching = False
+                    return
+            try:
+                state = status_snapshot()
+            except Exception as e:
+                log.warning("status snapshot failed", extra={'error': str(e)})
+                continue
+            with self._lock:
+                if state == self.state:
+                    continue
+                self.state = state
+                self.version += 1
+                listeners = list(self._listeners)
+            for callback in listeners:
+                try:
+                    callback()
+                except Exception:
+                    pass
+
+status_broadcaster = StatusBroadcaster()
+
+def sse_frame(version, state, event='status'):
+    return f"id: {version}\nevent: {event}\ndata: {json.dumps(state, separators=(',', ':'))}\n\n"
+
+@app.route('/api/status/stream')
+def status_stream():
+    """Server-Sent Events: the current status, then one `status` event per change, with heartbeats."""
+    if status_broadcaster.subscribers() >= SSE_MAX_STREAMS:
+        return jsonify({'message': 'Muitas conexões de status; use /api/online'}), 503, {'Retry-After': '30'}
+    wake = threading.Event()
+    version, state = status_broadcaster.subscribe(wake.set)
+
+    def events():
+        seen = version
+        try:
+            yield f"retry: 5000\n\n{sse_frame(seen, state)}"
+            while True:
+                wake.wait(SSE_HEARTBEAT)
+                wake.clear()
+                current, latest = status_broadcaster.version, status_broadcaster.state
+                if current != seen:
+                    seen = current
+                    yield sse_frame(seen, latest)
+                else:
+                    yield ": ping\n\n"
+        finally:
+            status_broadcaster.unsubscribe(wake.set)
+
+    metrics.inc('ponto_sse_streams_total')
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/admin/presence')
+@token_required
+def get_presence(curr_user_mat, role):
+    """Who is in now (last punch of the day per user). ?status=in|break|out filters the list."""
+    if role != 'admin':
+        return jsonify({'message': 'Unauthorized'}), 401
+    snap = presence.snapshot(request.args.get('status') or None)
+    snap['stream_token'] = jwt.encode({
+        'matricula': curr_user_mat,
+        'scope': 'presence_stream',  # no role claim: not accepted by token_required
+        'jti': uuid.uuid4().hex,  # single use, see redeem_stream_ticket
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=PRESENCE_STREAM_TOKEN_TTL)
+    }, app.config['SECRET_KEY'], algorithm="HS256")
+    return jsonify(snap)
+
+@app.route('/api/admin/presence/stream')
+def presence_stream():
+    """
+    SSE feed of new punches (`punch` events, id = seq). Authenticated by the
+    single-use stream_token of /api/admin/presence. Resumes after ?since=<seq> or
+    Last-Event-ID; without it, or when that point is no longer buffered, a
+    `reset` event carries a full snapshot first.
+    """
+    try:
+        claims = jwt.decode(request.args.get('token', ''), app.config['SECRET_KEY'], algorithms=["HS256"])
+        if claims.get('scope') != 'presence_stream' or not claims.get('jti'):
+            raise ValueError('scope')
+        if not redeem_stream_ticket(claims['jti'], claims['exp']):
+            raise ValueError('ticket already used')
+    except Exception:
+        return jsonify({'message': 'Token is invalid!'}), 401
+    if presence.subscribers() >= SSE_MAX_STREAMS:
+        return jsonify({'message': 'Muitas conexões abertas; tente novamente'}), 503, {'Retry-After': '30'}
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    except (TypeError, ValueError):
+        since = None
+    wake = threading.Event()
+    presence.subscribe(wake.set)
+
+    def events():
+        seen = since
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                batch, current = presence.events_since(seen) if seen is not None else (None, None)
+                if batch is None:
+                    snap = presence.snapshot()
+                    seen = snap['seq']
+                    yield sse_frame(seen, snap, 'reset')
+                else:
+                    for e in batch:
+                        yield sse_frame(e['seq'], e, 'punch')
+                    seen = current
+                if not wake.wait(SSE_HEARTBEAT):
+                    yield ": ping\n\n"
+                wake.clear()
+        finally:
+            presence.unsubscribe(wake.set)
+
+    metrics.inc('ponto_sse_streams_total')
+    return app.response_class(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+metrics.gauge('ponto_sse_subscribers', lambda: {(('stream', 'status'),): status_broadcaster.subscribers(),
+                                                (('stream', 'presence'),): presence.subscribers()},
+              'Open event streams in this process.')
+metrics.gauge('ponto_offline_queue_depth', offline_queue_depth, 'Punches waiting in the local OfflineQueue.')
+metrics.gauge('ponto_db_online', lambda: 1 if sql_online() else 0, 'Whether SQL Server is reachable (1) or not (0).')
+metrics.gauge('ponto_sync_last_rows_per_second', lambda: SYNC_LAST_RATE, 'Throughput of the last sync that moved rows.')
+metrics.gauge('ponto_log_dropped_total', lambda: DroppingQueueHandler.dropped,
+              'Log records dropped because the log queue was full.', kind='counter')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Prometheus scrape target for this process. Requires METRICS_TOKEN when set;
+    otherwise only direct loopback requests are answered (a tunnel such as ngrok
+    also connects from loopback, but adds X-Forwarded-For), unless METRICS_PUBLIC.
+    """
+    if METRICS_TOKEN:
+        auth = request.headers.get('Authorization', '')
+        if auth != f'Bearer {METRICS_TOKEN}' and request.args.get('token') != METRICS_TOKEN:
+            return jsonify({'message': 'Unauthorized'}), 401
+    elif not METRICS_PUBLIC:
+        proxied = request.headers.get('X-Forwarded-For') or request.headers.get('Forwarded')
+        if proxied or request.remote_addr not in ('127.0.0.1', '::1'):
+            return jsonify({'message': 'Unauthorized'}), 401
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+STARTUP_SECONDS = None
+
+def startup():
+    """Boot work before serving (default admin, local migrations); logs how long the app took to get ready."""
+    global STARTUP_SECONDS
+    t0 = time.perf_counter()
+    ensure_default_admin()
+    migrations = migrate_local_data()
+    try:
+        presence.snapshot()  # warm the presence board from today's records
     except Exception as e:
-        print(f"DEBUG: Auto-sync error: {e}")
+        log.warning("presence warm-up failed", extra={'error': str(e)})
+    t1 = time.perf_counter()
+    STARTUP_SECONDS = t1 - STARTUP_T0
+    log.info("startup complete", extra={'import_ms': round((t0 - STARTUP_T0) * 1000, 1),
+                                        'boot_ms': round((t1 - t0) * 1000, 1),
+                                        'total_ms': round(STARTUP_SECONDS * 1000, 1),
+                                        'migrations': migrations})
+
+metrics.gauge('ponto_startup_seconds', lambda: STARTUP_SECONDS if STARTUP_SECONDS is not None else {},
+              'Seconds from importing app.py until startup() finished.')
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', '5005'))
-    ensure_default_admin()
-    migrate_local_data()
-    start_health_check()
+    startup()
+    start_supervisor()
+    # Development server; use serve.py for multi-process production mode
     app.run(host='0.0.0.0', debug=False, port=port)
@@ -0,0 +1,396 @@
+"""
+ASGI entry point for the Ponto API.
+
+/api/punch, /api/history and /api/online are served natively on asyncio. Their
+blocking pymssql/sqlite3 work runs on a bounded thread pool, under a
+per-request deadline:
+
+- at most ASGI_DB_QUEUE requests may wait for or hold a DB thread; beyond that
+  the request is answered 503 with Retry-After instead of queueing forever;
+- punches and history reads go through the same per-IP/per-matricula token
+  buckets as the Flask routes (429 with Retry-After), and the time spent waiting for a DB
+  thread is exported as ponto_admission_wait_seconds;
+- each request gets ASGI_REQUEST_DEADLINE seconds. The deadline is handed to
+  the DB helpers in app.py, which skip SQL Server connects they can no longer
+  afford (punches then go to the OfflineQueue). Work still queued when it
+  expires is cancelled before it starts; work that has started is always
+  awaited, so a timed-out punch is never both stored and answered 504.
+
+/api/status/stream (Server-Sent Events) is also native, so open dashboards do
+not hold threads. Every other route (including CORS preflights) is delegated
+to the Flask app through a small WSGI bridge that runs it on its own bounded
+pool of ASGI_WSGI_WORKERS threads (default: SSE_MAX_STREAMS + 16). A Flask
+stream, such as the admin presence stream, keeps one of those threads for as
+long as it is open; SSE_MAX_STREAMS caps them, so the rest of the pool stays
+free for login, the admin routes and static files.
+
+    python serve.py --asgi --workers 4
+    uvicorn asgi:application --port 5005
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app as ponto
+
+ASGI_DB_WORKERS = int(os.getenv('ASGI_DB_WORKERS', '16'))
+ASGI_DB_QUEUE = int(os.getenv('ASGI_DB_QUEUE', str(ASGI_DB_WORKERS * 4)))
+ASGI_REQUEST_DEADLINE = float(os.getenv('ASGI_REQUEST_DEADLINE', '8'))
+ASGI_SSE_MAX_STREAMS = int(os.getenv('ASGI_SSE_MAX_STREAMS', '2000'))  # per process
+
+ASGI_WSGI_WORKERS = int(os.getenv('ASGI_WSGI_WORKERS', str(ponto.SSE_MAX_STREAMS + 16)))
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_DB_WORKERS, thread_name_prefix='ponto-db')
+_wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_WORKERS, thread_name_prefix='ponto-wsgi')
+_slots = {}
+
+
+def _slots_for_loop():
+    loop = asyncio.get_running_loop()
+    sem = _slots.get(loop)
+    if sem is None:
+        sem = _slots[loop] = asyncio.Semaphore(ASGI_DB_QUEUE)
+    return sem
+
+
+def _run_with_deadline(submitted, deadline, claim, scope, fn, *args):
+    # claim is taken by whichever side decides first: this thread (the work
+    # starts) or run_db (the request is shed). Work that never claimed it never runs.
+    if not claim.acquire(blocking=False):
+        raise ponto.DeadlineExceeded()
+    ponto.metrics.observe('ponto_admission_wait_seconds', time.monotonic() - submitted, endpoint=scope['path'])
+    if time.monotonic() >= deadline:
+        raise ponto.DeadlineExceeded()
+    ponto.set_request_deadline(deadline)
+    ponto.start_trace()
+    try:
+        return fn(*args)
+    finally:
+        ponto.set_request_deadline(None)
+        scope['ponto.trace'] = ponto.finish_trace()
+
+
+async def run_db(scope, fn, *args):
+    """
+    Runs fn(*args) on the DB pool under the request deadline. Returns
+    (result, None) or (None, (body, status)) when the request was shed.
+    Requests are only shed before fn starts: once a punch is being written it
+    is allowed to finish and its result is returned, so a 504 never hides a
+    stored punch that the client would then retry.
+    The phase trace of the work is left in scope['ponto.trace'].
+    """
+    sem = _slots_for_loop()
+    if sem.locked():
+        return None, ({'message': 'Servidor ocupado, tente novamente'}, 503)
+    submitted = time.monotonic()
+    deadline = submitted + ASGI_REQUEST_DEADLINE
+    claim = threading.Lock()
+    async with sem:
+        fut = asyncio.get_running_loop().run_in_executor(_executor, _run_with_deadline, submitted, deadline,
+                                                         claim, scope, fn, *args)
+        try:
+            try:
+                return await asyncio.wait_for(asyncio.shield(fut), timeout=ASGI_REQUEST_DEADLINE), None
+            except asyncio.TimeoutError:
+                if claim.acquire(blocking=False):
+                    fut.cancel()
+                    return None, ({'message': 'Tempo limite excedido'}, 504)
+                return await fut, None  # already running: wait for its result
+        except ponto.DeadlineExceeded:
+            return None, ({'message': 'Tempo limite excedido'}, 504)
+
+
+def _cors_headers(scope):
+    origin = None
+    for k, v in scope.get('headers', []):
+        if k == b'origin':
+            origin = v
+    return [
+        (b'access-control-allow-origin', origin or b'*'),
+        (b'access-control-allow-credentials', b'true'),
+        (b'vary', b'Origin'),
+    ]
+
+
+async def _send_json(send, scope, body, status, extra_headers=()):
+    payload = ponto.app.json.dumps(body).encode('utf-8')
+    headers = [(b'content-type', b'application/json')] + list(extra_headers)
+    if len(payload) >= ponto.COMPRESS_MIN_BYTES:
+        payload, encoding = ponto.compress_payload(payload, _header(scope, b'accept-encoding'))
+        headers.append((b'vary', b'Accept-Encoding'))
+        if encoding:
+            headers.append((b'content-encoding', encoding.encode()))
+    headers.append((b'content-length', str(len(payload)).encode()))
+    if status == 503:
+        headers.append((b'retry-after', b'2'))
+    timing = ponto.report_trace(scope.pop('ponto.trace', None), scope['method'], scope['path'], status)
+    if timing:
+        headers += [(b'server-timing', timing.encode()), (b'timing-allow-origin', b'*')]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + _cors_headers(scope)})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def _header(scope, name):
+    for k, v in scope.get('headers', []):
+        if k == name:
+            return v.decode('latin-1')
+    return ''
+
+
+async def _authorized(scope, send):
+    mat, role, error = ponto.decode_token(_header(scope, b'authorization'))
+    if error:
+        await _send_json(send, scope, {'message': error}, 401)
+        return None
+    return mat
+
+
+async def _rate_limited(scope, send, mat):
+    """Answers 429 when the request is over its rate; same buckets as the Flask routes."""
+    ip = ponto.client_ip((scope.get('client') or (None,))[0], _header(scope, b'x-forwarded-for'))
+    wait = ponto.rate_limited(scope['path'], mat, ip)
+    if wait:
+        await _send_json(send, scope, {'message': ponto.RATE_LIMITED_MESSAGE}, 429,
+                         [(b'retry-after', str(ponto.retry_after_seconds(wait)).encode())])
+    return bool(wait)
+
+
+async def handle_punch(scope, receive, send):
+    mat = await _authorized(scope, send)
+    if mat is None:
+        return
+    # per-IP/per-matricula buckets; the DB pool above is the concurrency limit
+    if await _rate_limited(scope, send, mat):
+        return
+    raw = await _read_body(receive)
+    if raw is None:
+        return
+    try:
+        data = json.loads(raw or b'{}')
+    except ValueError:
+        await _send_json(send, scope, {'message': 'JSON inválido'}, 400)
+        return
+    result, shed = await run_db(scope, ponto.record_punch, mat, data)
+    body, status = shed or result
+    await _send_json(send, scope, body, status)
+
+
+async def handle_history(scope, receive, send):
+    mat = await _authorized(scope, send)
+    if mat is None:
+        return
+    if await _rate_limited(scope, send, None):  # per IP, like the Flask route
+        return
+    result, shed = await run_db(scope, ponto.load_history, mat)
+    if shed:
+        await _send_json(send, scope, *shed)
+    else:
+        await _send_json(send, scope, result, 200)
+
+
+async def handle_online(scope, receive, send):
+    await _send_json(send, scope, ponto.online_status(), 200,
+                     [(b'cache-control', ponto.ONLINE_CACHE_CONTROL.encode())])
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def handle_status_stream(scope, receive, send):
+    """SSE on the event loop: unlike the WSGI route, an open stream costs no thread."""
+    if ponto.status_broadcaster.subscribers() >= ASGI_SSE_MAX_STREAMS:
+        await _send_json(send, scope, {'message': 'Muitas conexões de status; use /api/online'}, 503,
+                         [(b'retry-after', b'30')])
+        return
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    def notify():
+        loop.call_soon_threadsafe(wake.set)
+
+    # the first subscriber computes a snapshot (SQLite COUNT): keep it off the loop
+    version, state = await loop.run_in_executor(_executor, ponto.status_broadcaster.subscribe, notify)
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')] + _cors_headers(scope)})
+        ponto.metrics.inc('ponto_sse_streams_total')
+        seen = version
+        frame = f"retry: 5000\n\n{ponto.sse_frame(seen, state)}"
+        while True:
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+            woke = asyncio.ensure_future(wake.wait())
+            done, _ = await asyncio.wait({woke, disconnected}, timeout=ponto.SSE_HEARTBEAT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                woke.cancel()
+                return
+            woke.cancel()
+            wake.clear()
+            current, latest = ponto.status_broadcaster.version, ponto.status_broadcaster.state
+            if current != seen:
+                seen = current
+                frame = ponto.sse_frame(seen, latest)
+            else:
+                frame = ": ping\n\n"
+    except OSError:
+        pass
+    finally:
+        ponto.status_broadcaster.unsubscribe(notify)
+        disconnected.cancel()
+
+
+async def _timed(handler, scope, receive, send):
+    """Runs a native handler, recording the same request metrics as the Flask hooks."""
+    start = time.perf_counter()
+    status = [500]
+
+    async def send_status(message):
+        if message['type'] == 'http.response.start':
+            status[0] = message['status']
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_status)
+    finally:
+        ponto.record_request(scope['path'], scope['method'], status[0], time.perf_counter() - start)
+
+
+ROUTES = {
+    ('POST', '/api/punch'): handle_punch,
+    ('GET', '/api/history'): handle_history,
+    ('GET', '/api/online'): handle_online,
+}
+# long-lived: served without _timed so the stream length does not count as latency
+STREAM_ROUTES = {
+    ('GET', '/api/status/stream'): handle_status_stream,
+}
+
+
+def _wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('',))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for k, v in scope.get('headers', []):
+        name = k.decode('latin-1').upper().replace('-', '_')
+        value = v.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+def _start_wsgi(environ):
+    """Calls the Flask app; returns (status, headers, chunks written, response iterable)."""
+    started = {}
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        started['status'], started['headers'] = int(status.split(' ', 1)[0]), headers
+        return written.append
+
+    iterable = ponto.app(environ, start_response)
+    return started['status'], started['headers'], written, iterable
+
+
+def _next_chunk(chunks):
+    return next(chunks, None)
+
+
+async def handle_wsgi(scope, receive, send):
+    """
+    Serves the request with the Flask app on _wsgi_executor. Each step that
+    may block (the view, then every chunk of a streamed body) runs on that
+    pool, never on the event loop or a single shared thread; a client that
+    disconnects stops the stream at its next chunk.
+    """
+    body = await _read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    status, headers, written, iterable = await loop.run_in_executor(_wsgi_executor, _start_wsgi,
+                                                                    _wsgi_environ(scope, body))
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]})
+        for chunk in written:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        chunks = iter(iterable)
+        while not disconnected.done():
+            chunk = await loop.run_in_executor(_wsgi_executor, _next_chunk, chunks)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        pass
+    finally:
+        disconnected.cancel()
+        if hasattr(iterable, 'close'):
+            # runs the view's cleanup (stream unsubscribe, teardown hooks)
+            await loop.run_in_executor(_wsgi_executor, iterable.close)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _wsgi_executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        handler = ROUTES.get((scope['method'], scope['path']))
+        if handler:
+            await _timed(handler, scope, receive, send)
+            return
+        handler = STREAM_ROUTES.get((scope['method'], scope['path']))
+        if handler:
+            await handler(scope, receive, send)
+            return
+        await handle_wsgi(scope, receive, send)
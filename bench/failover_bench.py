@@ -0,0 +1,206 @@
+"""
+Failover benchmark: SQL Server goes away in the middle of a punch stream and
+comes back.
+
+Runs the app in-process against the fault-injecting stand-in (fake_pymssql.py)
+with the real health check and auto-sync threads, sends punches at a fixed
+rate through the Flask test client, and measures:
+
+- punch latency (p50/p95/p99) before, during and after the outage;
+- how long check_db_status takes to notice the outage and the recovery;
+- OfflineQueue peak, the time auto_sync_all takes to drain it and its rows/s;
+- punches lost (sent with 2xx but neither on the stand-in nor in the queue).
+
+    python bench/failover_bench.py --online 10 --outage 20 --recovery 30 --rate 20
+    python bench/failover_bench.py --outage-mode refuse --latency 5-30 --error-rate 0.01
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de failover do SQL Server")
+    parser.add_argument('--online', type=float, default=10, help="seconds before the outage")
+    parser.add_argument('--outage', type=float, default=20, help="outage length in seconds")
+    parser.add_argument('--recovery', type=float, default=30, help="seconds observed after the outage")
+    parser.add_argument('--rate', type=float, default=20, help="punches per second")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--outage-mode', choices=['timeout', 'refuse'], default='timeout')
+    parser.add_argument('--latency', default='0', help="ms per statement, e.g. 5-30")
+    parser.add_argument('--connect-latency', default='0')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--health-interval', type=float, default=2.0, help="DB_HEALTH_INTERVAL for the run")
+    parser.add_argument('--max-inflight', type=int, default=64)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    return parser.parse_args(argv)
+
+
+def stats_ms(values):
+    from run_bench import percentile
+    if not values:
+        return {'count': 0}
+    v = sorted(values)
+    return {'count': len(v), 'p50_ms': round(percentile(v, 50) * 1000, 2),
+            'p95_ms': round(percentile(v, 95) * 1000, 2), 'p99_ms': round(percentile(v, 99) * 1000, 2),
+            'max_ms': round(v[-1] * 1000, 2)}
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='ponto-failover-')
+    os.environ.update({
+        'SQLITE_PATH': os.path.join(workdir, 'local.db'),
+        'INIT_DB_ON_START': 'false',
+        'LOG_LEVEL': 'WARNING',
+        'LOG_FILE': os.path.join(workdir, 'app.log'),
+        'SECRET_KEY': 'bench-secret',
+        'DB_HEALTH_INTERVAL': str(args.health_interval),
+        'ARCHIVE_INTERVAL_HOURS': '0',
+        'RATE_LIMIT_ENABLED': 'false',  # synthetic clients all come from one address
+    })
+    os.environ.pop('DB_STATE_FILE', None)
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    os.chdir(ROOT)
+    import fake_pymssql
+    fake = fake_pymssql.install(os.path.join(workdir, 'standin.db'))
+    fake.configure(latency=args.latency, connect_latency=args.connect_latency, error_rate=args.error_rate,
+                   outage_mode=args.outage_mode)
+    import app as ponto
+    from run_bench import seed_data, make_token
+
+    try:
+        rng = random.Random(1)
+        matriculas, _ = seed_data(ponto, 'standin', args.users, 0, 4, rng)
+        tokens = [make_token(ponto, m) for m in matriculas]
+        ponto.start_health_check()
+        deadline = time.time() + 30
+        while not ponto.DB_ONLINE and time.time() < deadline:
+            time.sleep(0.05)
+        if not ponto.DB_ONLINE:
+            raise RuntimeError("stand-in never came online")
+
+        # Outage window relative to the start of the punch stream
+        fake.restart_clock()
+        t_down = args.online
+        t_up = args.online + args.outage
+        fake.configure(outages=[(t_down, t_up)])
+        t_end = t_up + args.recovery
+        start = time.time()
+
+        samples = []
+        timeline = []
+        stop = threading.Event()
+
+        def queue_depth():
+            conn = ponto.connect_local()
+            try:
+                return conn.execute("SELECT COUNT(*) FROM OfflineQueue").fetchone()[0]
+            finally:
+                conn.close()
+
+        def watch():
+            while not stop.is_set():
+                timeline.append((time.time() - start, ponto.DB_ONLINE, queue_depth()))
+                time.sleep(0.1)
+
+        local = threading.local()
+
+        def punch(i, sent_at):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = ponto.app.test_client()
+            k = i % len(tokens)
+            kind = 'entrada' if (i // len(tokens)) % 2 == 0 else 'saida'
+            t0 = time.perf_counter()
+            resp = client.post('/api/punch', json={'type': kind, 'neighborhood': 'Carapina', 'city': 'Serra'},
+                               headers={'Authorization': f'Bearer {tokens[k]}'})
+            samples.append((sent_at, time.perf_counter() - t0, resp.status_code))
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        interval = 1.0 / args.rate
+        sent = 0
+        dropped = 0
+        inflight = threading.Semaphore(args.max_inflight)
+        print(f"Enviando {args.rate}/s por {t_end:.0f}s (queda de {t_down:.0f}s a {t_up:.0f}s, modo {args.outage_mode})...",
+              file=sys.stderr)
+        with ThreadPoolExecutor(max_workers=args.max_inflight) as pool:
+            while True:
+                now = time.time() - start
+                if now >= t_end:
+                    break
+                if inflight.acquire(blocking=False):
+                    fut = pool.submit(punch, sent, now)
+                    fut.add_done_callback(lambda _: inflight.release())
+                    sent += 1
+                else:
+                    dropped += 1  # open-loop: the client gave up, as a phone would
+                next_at = start + (sent + dropped) * interval
+                time.sleep(max(0.0, next_at - time.time()))
+        # let auto-sync finish draining before the final count
+        drain_deadline = time.time() + 60
+        while queue_depth() and time.time() < drain_deadline:
+            time.sleep(0.2)
+        stop.set()
+        watcher.join()
+
+        phases = {'online': [], 'outage': [], 'recovery': []}
+        errors = {'online': 0, 'outage': 0, 'recovery': 0}
+        for sent_at, elapsed, status in samples:
+            phase = 'online' if sent_at < t_down else ('outage' if sent_at < t_up else 'recovery')
+            phases[phase].append(elapsed)
+            if not (200 <= status < 300):
+                errors[phase] += 1
+
+        detect_down = next((t - t_down for t, online, _ in timeline if t >= t_down and not online), None)
+        detect_up = next((t - t_up for t, online, _ in timeline if t >= t_up and online), None)
+        peak = max((q for _, _, q in timeline), default=0)
+        drained_at = next((t for t, _, q in timeline if t >= t_up and q == 0), None)
+        drain_s = drained_at - (t_up + detect_up) if drained_at is not None and detect_up is not None else None
+
+        conn = fake.connect()
+        try:
+            on_server = conn.cursor().execute("SELECT COUNT(*) FROM TimeRecords").fetchone()[0]
+        finally:
+            conn.close()
+        ok = sum(1 for _, _, s in samples if 200 <= s < 300)
+        result = {
+            'args': vars(args),
+            'sent': sent,
+            'client_dropped': dropped,
+            'accepted': ok,
+            'latency': {p: dict(stats_ms(v), errors=errors[p]) for p, v in phases.items()},
+            'detect_outage_s': round(detect_down, 2) if detect_down is not None else None,
+            'detect_recovery_s': round(detect_up, 2) if detect_up is not None else None,
+            'queue_peak': peak,
+            'drain_s': round(drain_s, 2) if drain_s is not None else None,
+            'drain_rows_per_s': round(peak / drain_s, 1) if drain_s else None,
+            'on_server': on_server,
+            'still_queued': queue_depth(),
+            'lost': ok - on_server - queue_depth(),
+            'standin': fake.stats(),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
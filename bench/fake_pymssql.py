@@ -0,0 +1,430 @@
+"""
+SQL Server stand-in for benchmarks: a module with the pymssql API, backed by a
+SQLite file, that is registered as `pymssql` before app.py is imported.
+
+The T-SQL that app.py sends (WITH (NOLOCK), TOP, GETDATE(), MONTH()/YEAR(),
+CAST(... AS DATE), %s placeholders, BEGIN/COMMIT TRANSACTION, the conditional
+IF OBJECT_ID/COL_LENGTH schema statements, geography::Point) is rewritten to
+SQLite. Archive statements (OUTPUT INTO, SELECT ... INTO) are not supported and
+raise OperationalError, as a server without permissions would.
+
+    import fake_pymssql
+    fake_pymssql.install('/tmp/standin.db')
+    import app
+
+Or, to run a server script with the stand-in in place:
+
+    python bench/fake_pymssql.py --db /tmp/standin.db -- serve.py --workers 2
+
+Faults are injected from the environment (so serve.py workers inherit them) or
+at runtime with configure():
+
+    FAKE_MSSQL_LATENCY=5-40              ms added to every statement ("5" or "min-max")
+    FAKE_MSSQL_CONNECT_LATENCY=20        ms added to every successful connect
+    FAKE_MSSQL_CONNECT_TIMEOUT_RATE=0.1  fraction of connects that hang for login_timeout, then fail
+    FAKE_MSSQL_ERROR_RATE=0.01           fraction of statements that fail with a transient error
+    FAKE_MSSQL_OUTAGES=10-30,60-75       outage windows, in seconds since FAKE_MSSQL_START
+    FAKE_MSSQL_OUTAGE_MODE=timeout       during outages connects hang (timeout) or fail at once (refuse)
+    FAKE_MSSQL_OUTAGE_FILE=/tmp/down     the server is also down while this file exists
+"""
+import datetime
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+DB_PATH = os.getenv('FAKE_MSSQL_PATH', 'standin.db')
+
+# pymssql exception hierarchy
+class Error(Exception):
+    pass
+
+class InterfaceError(Error):
+    pass
+
+class DatabaseError(Error):
+    pass
+
+class OperationalError(DatabaseError):
+    pass
+
+class IntegrityError(DatabaseError):
+    pass
+
+class ProgrammingError(DatabaseError):
+    pass
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS Users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        matricula TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        name TEXT,
+        role TEXT DEFAULT 'user'
+    )""",
+    """CREATE TABLE IF NOT EXISTS TimeRecords (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        matricula TEXT,
+        user_name TEXT,
+        record_type TEXT,
+        timestamp DATETIME,
+        neighborhood TEXT,
+        city TEXT,
+        lat FLOAT,
+        lon FLOAT,
+        accuracy FLOAT,
+        geofence TEXT,
+        geofence_m INT
+    )""",
+    "CREATE INDEX IF NOT EXISTS IX_TimeRecords_matricula_timestamp ON TimeRecords (matricula, timestamp)",
+    "CREATE INDEX IF NOT EXISTS IX_TimeRecords_timestamp ON TimeRecords (timestamp)",
+]
+
+def _range(value):
+    lo, _, hi = str(value).partition('-')
+    return (float(lo or 0), float(hi or lo or 0))
+
+def _windows(value):
+    if not isinstance(value, str):
+        return [tuple(map(float, w)) for w in value]
+    return [_range(w.strip()) for w in value.split(',') if w.strip()]
+
+FAULTS = {
+    'latency': _range(os.getenv('FAKE_MSSQL_LATENCY', '0')),
+    'connect_latency': _range(os.getenv('FAKE_MSSQL_CONNECT_LATENCY', '0')),
+    'connect_timeout_rate': float(os.getenv('FAKE_MSSQL_CONNECT_TIMEOUT_RATE', '0')),
+    'error_rate': float(os.getenv('FAKE_MSSQL_ERROR_RATE', '0')),
+    'outages': _windows(os.getenv('FAKE_MSSQL_OUTAGES', '')),
+    'outage_mode': os.getenv('FAKE_MSSQL_OUTAGE_MODE', 'timeout'),
+    'outage_file': os.getenv('FAKE_MSSQL_OUTAGE_FILE'),
+}
+START = float(os.getenv('FAKE_MSSQL_START') or time.time())
+STATS = {'connects': 0, 'connect_failures': 0, 'statements': 0, 'statement_errors': 0}
+_stats_lock = threading.Lock()
+
+def configure(**faults):
+    """Changes fault settings at runtime (same keys as FAULTS; latencies accept "5-40")."""
+    for key, value in faults.items():
+        if key not in FAULTS:
+            raise KeyError(key)
+        if key in ('latency', 'connect_latency'):
+            value = _range(value) if not isinstance(value, tuple) else value
+        elif key == 'outages':
+            value = _windows(value)
+        FAULTS[key] = value
+
+def restart_clock():
+    """Makes outage windows relative to now."""
+    global START
+    START = time.time()
+    os.environ['FAKE_MSSQL_START'] = str(START)
+
+def is_down():
+    elapsed = time.time() - START
+    if any(lo <= elapsed < hi for lo, hi in FAULTS['outages']):
+        return True
+    return bool(FAULTS['outage_file']) and os.path.exists(FAULTS['outage_file'])
+
+def stats():
+    with _stats_lock:
+        return dict(STATS)
+
+def _count(key):
+    with _stats_lock:
+        STATS[key] += 1
+
+def _delay(bounds):
+    lo, hi = bounds
+    if hi > 0:
+        time.sleep(random.uniform(lo, hi) / 1000.0)
+
+def _statement_faults():
+    if is_down():
+        _count('statement_errors')
+        raise OperationalError("(20047, b'DB-Lib error message 20047, severity 9:\\nDBPROCESS is dead or not enabled\\n')")
+    _delay(FAULTS['latency'])
+    if FAULTS['error_rate'] and random.random() < FAULTS['error_rate']:
+        _count('statement_errors')
+        raise OperationalError("(1205, b'Transaction was deadlocked on lock resources with another process and has been chosen as the deadlock victim.')")
+
+_schema_ready = set()
+_schema_lock = threading.Lock()
+
+def _adapt_params(params):
+    """Parameters for sqlite3, with datetimes as text. Done here rather than with
+    sqlite3.register_adapter, which would change every sqlite3 connection in the
+    process (including app.py's local.db)."""
+    if params is None:
+        return ()
+    if isinstance(params, dict):
+        return {k: _adapt_value(v) for k, v in params.items()}
+    if not isinstance(params, (tuple, list)):
+        params = (params,)
+    return tuple(_adapt_value(v) for v in params)
+
+def _adapt_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+def _convert_datetime(raw):
+    text = raw.decode()
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return text
+
+# Converters only apply to connections opened with detect_types, i.e. the stand-in's own
+sqlite3.register_converter('DATETIME', _convert_datetime)
+
+_NOOP = re.compile(r"^\s*(SET\s+TRANSACTION\s+ISOLATION\s+LEVEL\b.*|IF\s+NOT\s+EXISTS\s*\(\s*SELECT\s+1\s+FROM\s+sys\.indexes.*)$", re.I | re.S)
+_IF_TABLE = re.compile(r"^\s*IF\s+OBJECT_ID\('(\w+)'\)\s+IS\s+NOT\s+NULL\s+(SELECT\b.*)$", re.I | re.S)
+_IF_NO_TABLE = re.compile(r"^\s*IF\s+OBJECT_ID\('(\w+)'\)\s+IS\s+NULL\s+(CREATE\s+TABLE\b.*)$", re.I | re.S)
+_IF_NO_COLUMN = re.compile(r"^\s*IF\s+COL_LENGTH\('(\w+)',\s*'(\w+)'\)\s+IS\s+NULL\s+ALTER\s+TABLE\s+\w+\s+ADD\s+\w+\s+(\w+)", re.I | re.S)
+_SELECT_TOP = re.compile(r"^(\s*SELECT\s+)TOP\s*\(?\s*(\d+)\s*\)?\s+", re.I)
+_DELETE_TOP = re.compile(r"^\s*DELETE\s+TOP\s*\(\s*(\d+)\s*\)\s+FROM\s+(\w+)\s+WHERE\s+(.*)$", re.I | re.S)
+
+def translate(sql):
+    """Rewrites one T-SQL statement to SQLite. Returns None for statements to skip."""
+    if _NOOP.match(sql):
+        return None
+    sql = re.sub(r"\bWITH\s*\(\s*NOLOCK\s*\)", "", sql, flags=re.I)
+    sql = re.sub(r"^\s*BEGIN\s+TRAN(SACTION)?\s*$", "BEGIN", sql, flags=re.I)
+    sql = re.sub(r"^\s*COMMIT\s+TRAN(SACTION)?\s*$", "COMMIT", sql, flags=re.I)
+    sql = re.sub(r"^\s*ROLLBACK\s+TRAN(SACTION)?\s*$", "ROLLBACK", sql, flags=re.I)
+    sql = re.sub(r"\b(MONTH|YEAR)\s*\(\s*GETDATE\(\)\s*\)",
+                 lambda m: "CAST(strftime('%s', 'now', 'localtime') AS INTEGER)" % ('%m' if m.group(1).upper() == 'MONTH' else '%Y'),
+                 sql, flags=re.I)
+    sql = re.sub(r"\b(MONTH|YEAR)\s*\(\s*([\w.]+)\s*\)",
+                 lambda m: "CAST(strftime('%s', %s) AS INTEGER)" % ('%m' if m.group(1).upper() == 'MONTH' else '%Y', m.group(2)),
+                 sql, flags=re.I)
+    sql = re.sub(r"\bGETDATE\(\)", "datetime('now', 'localtime')", sql, flags=re.I)
+    sql = re.sub(r"\bCAST\(\s*([\w.]+)\s+AS\s+DATE\s*\)", r"date(\1)", sql, flags=re.I)
+    # geography values are kept as "lat,lon" text
+    sql = re.sub(r"\bgeography::Point\(\s*(%s|\?)\s*,\s*(%s|\?)\s*,\s*4326\s*\)", r"(\1 || ',' || \2)", sql, flags=re.I)
+    m = _DELETE_TOP.match(sql)
+    if m:
+        n, table, where = m.groups()
+        sql = f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT {n})"
+    m = _SELECT_TOP.match(sql)
+    if m:
+        sql = m.group(1) + sql[m.end():].rstrip().rstrip(';') + f" LIMIT {m.group(2)}"
+    if re.search(r"\bOUTPUT\b|\bINTO\s+\w+\s+FROM\b|\bOBJECT_ID\(", sql, re.I):
+        raise OperationalError(f"statement not supported by the stand-in: {sql.strip()[:80]}")
+    return sql.replace('%s', '?')
+
+
+class Cursor:
+    def __init__(self, conn, as_dict):
+        self._conn = conn
+        self._cur = conn._db.cursor()
+        self._as_dict = as_dict
+        self._empty = False
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def _row(self, row):
+        if row is None or not self._as_dict:
+            return row
+        return {d[0]: v for d, v in zip(self._cur.description, row)}
+
+    def execute(self, sql, params=None):
+        self._conn._check()
+        _count('statements')
+        _statement_faults()
+        self._empty = False
+        m = _IF_NO_COLUMN.match(sql)
+        if m:
+            table, column, typ = m.groups()
+            columns = {r[1] for r in self._conn._db.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                self._cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {typ}")
+            self._empty = True
+            return self
+        m = _IF_NO_TABLE.match(sql)
+        if m:
+            sql = m.group(2).replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1)
+        m = _IF_TABLE.match(sql)
+        if m:
+            exists = self._conn._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (m.group(1),)).fetchone()
+            if not exists:
+                self._empty = True
+                return self
+            sql = m.group(2)
+        stmt = translate(sql)
+        if stmt is None:
+            self._empty = True
+            return self
+        try:
+            self._cur.execute(stmt, _adapt_params(params))
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e))
+        except sqlite3.Error as e:
+            raise OperationalError(str(e))
+        return self
+
+    def executemany(self, sql, seq):
+        self._conn._check()
+        _count('statements')
+        _statement_faults()
+        stmt = translate(sql)
+        if stmt is None:
+            return self
+        try:
+            self._cur.executemany(stmt, [_adapt_params(p) for p in seq])
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e))
+        except sqlite3.Error as e:
+            raise OperationalError(str(e))
+        return self
+
+    def fetchone(self):
+        if self._empty:
+            return None
+        return self._row(self._cur.fetchone())
+
+    def fetchmany(self, size=1):
+        if self._empty:
+            return []
+        return [self._row(r) for r in self._cur.fetchmany(size)]
+
+    def fetchall(self):
+        if self._empty:
+            return []
+        return [self._row(r) for r in self._cur.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        try:
+            self._cur.close()
+        except sqlite3.Error:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class Connection:
+    def __init__(self, path, as_dict, autocommit):
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   detect_types=sqlite3.PARSE_DECLTYPES,
+                                   isolation_level=None if autocommit else '')
+        self._as_dict = as_dict
+        self._closed = False
+
+    def _check(self):
+        if self._closed:
+            raise InterfaceError("Connection is closed.")
+
+    def cursor(self, as_dict=None):
+        self._check()
+        return Cursor(self, self._as_dict if as_dict is None else as_dict)
+
+    def commit(self):
+        self._check()
+        if self._db.in_transaction:
+            self._db.commit()
+
+    def rollback(self):
+        if self._db.in_transaction:
+            self._db.rollback()
+
+    def autocommit(self, status):
+        self._db.isolation_level = None if status else ''
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _ensure_schema(path):
+    if path in _schema_ready:
+        return
+    with _schema_lock:
+        if path in _schema_ready:
+            return
+        db = sqlite3.connect(path, timeout=30)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            for stmt in SCHEMA:
+                db.execute(stmt)
+            db.commit()
+        finally:
+            db.close()
+        _schema_ready.add(path)
+
+
+def connect(server=None, user=None, password=None, database=None, timeout=0, login_timeout=60,
+            as_dict=False, autocommit=False, **kwargs):
+    hang = is_down() and FAULTS['outage_mode'] != 'refuse'
+    if not hang and FAULTS['connect_timeout_rate'] and random.random() < FAULTS['connect_timeout_rate']:
+        hang = True
+    if hang or is_down():
+        if hang:
+            time.sleep(login_timeout)
+        _count('connect_failures')
+        raise OperationalError("(20009, b'DB-Lib error message 20009, severity 9:\\nUnable to connect: Adaptive Server is unavailable or does not exist\\n')")
+    _delay(FAULTS['connect_latency'])
+    _count('connects')
+    path = DB_PATH
+    _ensure_schema(path)
+    return Connection(path, as_dict, autocommit)
+
+
+def install(path=None):
+    """Registers this module as `pymssql` (and points it at `path`). Call before importing app."""
+    global DB_PATH
+    if path:
+        DB_PATH = os.path.abspath(path)
+    os.environ['FAKE_MSSQL_PATH'] = DB_PATH
+    os.environ['FAKE_MSSQL_START'] = str(START)
+    os.environ.setdefault('DB_SERVER', 'standin')
+    sys.modules['pymssql'] = sys.modules[__name__]
+    return sys.modules[__name__]
+
+
+def main():
+    import argparse
+    import runpy
+    parser = argparse.ArgumentParser(description="Runs a script with the SQL Server stand-in registered as pymssql")
+    parser.add_argument('--db', default=DB_PATH, help="SQLite file that plays the SQL Server database")
+    parser.add_argument('script', help="script to run (e.g. serve.py or app.py)")
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    install(args.db)
+    script = os.path.abspath(args.script)
+    sys.path.insert(0, os.path.dirname(script))
+    sys.argv = [script] + [a for a in args.args if a != '--']
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
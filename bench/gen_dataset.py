@@ -0,0 +1,259 @@
+"""
+Synthetic dataset generator: realistic Users, TimeRecords and OfflineQueue rows
+for benchmarks and capacity tests.
+
+Each user gets a shift (commercial day with lunch punches, morning, afternoon or
+12x36 night duty), a home location in Greater Vitória with occasional punches
+elsewhere, jittered times and a few forgotten punches. TimeRecords cover the
+days up to yesterday; the OfflineQueue holds today's punches still waiting for
+sync.
+
+    python bench/gen_dataset.py --users 5000 --punches 10000000 --local /tmp/big.db
+    python bench/gen_dataset.py --users 500 --days 60 --queue 2000 --local local.db --standin /tmp/standin.db
+
+The local database gets the app schema (Users are always written there, as the
+login mirror). TimeRecords go to the stand-in when --standin is given, to the
+local database otherwise (or to both with --records-to both).
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+PASSWORD = 'ponto123'
+FIRST_NAMES = ['Ana', 'Bruno', 'Carla', 'Daniel', 'Eduarda', 'Felipe', 'Gabriela', 'Hugo', 'Isabela', 'João',
+               'Karina', 'Lucas', 'Mariana', 'Nicolas', 'Olívia', 'Paulo', 'Rafaela', 'Sérgio', 'Tatiane', 'Vinícius']
+LAST_NAMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira', 'Lima', 'Gomes',
+              'Costa', 'Ribeiro', 'Martins', 'Carvalho', 'Almeida', 'Lopes', 'Soares', 'Vieira', 'Barbosa', 'Rocha']
+LOCATIONS = [
+    ('Carapina', 'Serra'), ('Laranjeiras', 'Serra'), ('Jacaraípe', 'Serra'), ('Serra Sede', 'Serra'),
+    ('Jardim Camburi', 'Vitória'), ('Praia do Canto', 'Vitória'), ('Centro', 'Vitória'), ('Goiabeiras', 'Vitória'),
+    ('Praia da Costa', 'Vila Velha'), ('Itapuã', 'Vila Velha'), ('Glória', 'Vila Velha'),
+    ('Campo Grande', 'Cariacica'), ('Jardim América', 'Cariacica'),
+]
+# (name, share of users, [(record_type, minutes after shift start)], works weekends)
+SHIFTS = [
+    ('comercial', 0.6, [('Entrada', 0), ('Saída Almoço', 240), ('Volta Almoço', 300), ('Saída', 540)], False),
+    ('manha', 0.15, [('Entrada', 0), ('Saída', 360)], False),
+    ('tarde', 0.15, [('Entrada', 0), ('Saída', 360)], False),
+    ('plantao', 0.10, [('Entrada', 0), ('Saída', 720)], True),
+]
+SHIFT_START = {'comercial': (8, 0), 'manha': (7, 0), 'tarde': (13, 0), 'plantao': (19, 0)}
+MISSING_RATE = 0.02   # forgotten punches
+AWAY_RATE = 0.10      # punches away from the home location
+JITTER_MIN = 15
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Gera dados sintéticos para o Ponto")
+    parser.add_argument('--users', type=int, default=1000)
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--days', type=int, default=30, help="days of history up to yesterday")
+    size.add_argument('--punches', type=int, help="approximate number of TimeRecords (sets --days)")
+    parser.add_argument('--queue', type=int, default=0, help="OfflineQueue rows (today's punches)")
+    parser.add_argument('--local', default=os.getenv('SQLITE_PATH', 'local.db'), help="local SQLite database")
+    parser.add_argument('--standin', help="SQL Server stand-in database (bench/fake_pymssql.py)")
+    parser.add_argument('--records-to', choices=['local', 'standin', 'both'])
+    parser.add_argument('--append', action='store_true', help="allow writing into a database that already has data")
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    parser.add_argument('--batch', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=7)
+    return parser.parse_args(argv)
+
+
+def make_users(n, rng, hashed):
+    """[(matricula, password, name, role, shift, home)]; matriculas are unique and stable per seed."""
+    users = []
+    for i in range(n):
+        shift = rng.choices([s[0] for s in SHIFTS], weights=[s[1] for s in SHIFTS])[0]
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+        users.append((str(100000 + i), hashed, name, 'user', shift, rng.choice(LOCATIONS)))
+    return users
+
+
+def punches_per_day(users):
+    per_shift = {s[0]: (len(s[2]), 7 if s[3] else 5) for s in SHIFTS}
+    total = 0.0
+    for u in users:
+        n, days_per_week = per_shift[u[4]]
+        if u[4] == 'plantao':
+            days_per_week = 3.5  # 12x36: every other day
+        total += n * days_per_week / 7 * (1 - MISSING_RATE)
+    return total
+
+
+def day_punches(user, uid, day, rng):
+    """Punches of one user on one day: [(user_id, matricula, name, type, datetime, neighborhood, city)]."""
+    matricula, _, name, _, shift, home = user
+    spec = next(s for s in SHIFTS if s[0] == shift)
+    if shift == 'plantao':
+        if (day.toordinal() + uid) % 2:
+            return []
+    elif day.weekday() >= 5:
+        return []
+    hour, minute = SHIFT_START[shift]
+    start = day.replace(hour=hour, minute=minute) + datetime.timedelta(minutes=rng.randint(-JITTER_MIN, JITTER_MIN))
+    out = []
+    for record_type, offset in spec[2]:
+        if rng.random() < MISSING_RATE:
+            continue
+        ts = start + datetime.timedelta(minutes=offset + rng.randint(-JITTER_MIN // 3, JITTER_MIN),
+                                        seconds=rng.randint(0, 59))
+        neighborhood, city = home if rng.random() >= AWAY_RATE else rng.choice(LOCATIONS)
+        out.append((uid, matricula, name, record_type, ts, neighborhood, city))
+    return out
+
+
+def iter_records(users, user_ids, days, today, rng):
+    for d in range(days, 0, -1):
+        day = today - datetime.timedelta(days=d)
+        for user in users:
+            yield from day_punches(user, user_ids[user[0]], day, rng)
+
+
+def queue_rows(users, user_ids, count, now, rng):
+    """Today's punches (up to now) that have not reached SQL Server yet; at most `count`."""
+    rows = []
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    for user in rng.sample(users, len(users)):
+        if len(rows) >= count:
+            break
+        for row in day_punches(user, user_ids[user[0]], today, rng):
+            if row[4] <= now and len(rows) < count:
+                rows.append(row)
+    return rows
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def generate(ponto, users=1000, days=30, queue=0, local=None, standin=None, records_to=None,
+             bcrypt_rounds=12, batch=20000, seed=7, progress=None):
+    """
+    Writes the dataset. `ponto` is the imported app module (for the schema and
+    timestamp helpers). Returns counts: {'users', 'records', 'queue'}.
+    """
+    import bcrypt
+    rng = random.Random(seed)
+    hashed = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds=bcrypt_rounds)).decode('utf-8')
+    people = make_users(users, rng, hashed)
+    records_to = records_to or ('standin' if standin else 'local')
+
+    lconn = ponto.connect_local(local)
+    ponto.ensure_sqlite_schema(lconn)
+    lconn.execute("PRAGMA synchronous=OFF")
+    lconn.executemany("INSERT INTO Users (matricula, password, name, role) VALUES (?, ?, ?, ?)",
+                      [p[:4] for p in people])
+    lconn.commit()
+    local_ids = {r[0]: r[1] for r in lconn.execute("SELECT matricula, id FROM Users")}
+
+    sconn = None
+    user_ids = local_ids
+    if standin:
+        import fake_pymssql
+        fake_pymssql.install(standin)
+        sconn = fake_pymssql.connect(autocommit=False)
+        scur = sconn.cursor()
+        scur.executemany("INSERT INTO Users (matricula, password, name, role) VALUES (%s, %s, %s, %s)",
+                         [p[:4] for p in people])
+        sconn.commit()
+        scur.execute("SELECT matricula, id FROM Users")
+        server_ids = {r[0]: r[1] for r in scur.fetchall()}
+        if records_to == 'standin':
+            user_ids = server_ids
+
+    now = ponto.now_local()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    total = 0
+    t0 = time.time()
+    for chunk in _batched(iter_records(people, user_ids, days, today, rng), batch):
+        if records_to in ('local', 'both'):
+            lconn.executemany(
+                "INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, timestamp, ts_epoch, tz, neighborhood, city) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(u, m, n, t, ponto.format_ts(ts), ponto.to_epoch(ts), ponto.LOCAL_TZ_NAME, nb, c)
+                 for u, m, n, t, ts, nb, c in chunk])
+            lconn.commit()
+        if sconn and records_to in ('standin', 'both'):
+            scur.executemany(
+                "INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, timestamp, neighborhood, city) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)", chunk)
+            sconn.commit()
+        total += len(chunk)
+        if progress:
+            progress(total, time.time() - t0)
+
+    pending = queue_rows(people, local_ids, queue, now, rng) if queue else []
+    if pending:
+        lconn.executemany(
+            "INSERT INTO OfflineQueue (user_id, matricula, user_name, record_type, timestamp, ts_epoch, tz, neighborhood, city) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(u, m, n, t, ponto.format_ts(ts), ponto.to_epoch(ts), ponto.LOCAL_TZ_NAME, nb, c)
+             for u, m, n, t, ts, nb, c in pending])
+        lconn.commit()
+    lconn.execute("ANALYZE")
+    lconn.close()
+    if sconn:
+        sconn.close()
+    return {'users': len(people), 'records': total, 'queue': len(pending)}
+
+
+def load_app(local, standin=None):
+    """Imports app.py on `local`, with the stand-in registered as pymssql when given."""
+    os.environ['SQLITE_PATH'] = os.path.abspath(local)
+    os.environ.setdefault('INIT_DB_ON_START', 'false')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    if standin:
+        import fake_pymssql
+        fake_pymssql.install(standin)
+    import app as ponto
+    return ponto
+
+
+def main():
+    args = parse_args()
+    ponto = load_app(args.local, args.standin)
+    conn = ponto.connect_local(args.local)
+    try:
+        ponto.ensure_sqlite_schema(conn)
+        existing = conn.execute("SELECT (SELECT COUNT(*) FROM Users) + (SELECT COUNT(*) FROM TimeRecords)").fetchone()[0]
+    finally:
+        conn.close()
+    if existing > 1 and not args.append:  # the default admin alone is fine
+        print(f"{args.local} já contém dados; use --append para acrescentar ou escolha outro arquivo.", file=sys.stderr)
+        return 2
+
+    days = args.days
+    if args.punches:
+        probe = make_users(min(args.users, 2000), random.Random(args.seed), '')
+        per_day = punches_per_day(probe) * args.users / len(probe)
+        days = max(1, round(args.punches / per_day))
+
+    def progress(n, elapsed):
+        if n % (args.batch * 10) < args.batch:
+            print(f"  {n:,} registros ({n / elapsed:,.0f}/s)", file=sys.stderr)
+
+    print(f"Gerando {args.users} usuários, {days} dias, {args.queue} pendentes...", file=sys.stderr)
+    counts = generate(ponto, args.users, days, args.queue, args.local, args.standin, args.records_to,
+                      args.bcrypt_rounds, args.batch, args.seed, progress)
+    print(f"Pronto: {counts['users']} usuários, {counts['records']:,} registros, {counts['queue']} na fila.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,400 @@
+"""
+Replays production traffic from the server logs against a local instance.
+
+Reads werkzeug/gunicorn access lines (server_log.txt:
+`127.0.0.1 - - [05/Jan/2026 21:04:59] "GET /api/online HTTP/1.1" 200 -`) and
+the structured JSON logs ("request" lines written with LOG_LEVEL=DEBUG, and
+"slow request" lines), then sends the same requests with the original arrival
+pattern, at 1x or accelerated.
+
+Logs carry no identities or bodies, so requests are replayed with synthetic
+users and tokens: authenticated calls are spread over --users synthetic users
+(admin routes use an admin), logins use their password, punches get
+plausible bodies. Admin writes (user edits, deletes, imports, archive runs)
+are skipped unless --admin-writes is given.
+
+    python bench/replay.py server_log.txt --spawn --speed 10
+    python bench/replay.py app.log --target http://localhost:5005 --secret "$SECRET_KEY" --speed 1
+    python bench/replay.py server_log.txt --spawn --speed 0 --save replay.json
+    python bench/replay.py server_log.txt --spawn --speed 10 --compare replay.json
+
+--spawn starts serve.py on a temporary database seeded with the synthetic
+users (bench/run_bench.py); with --target the users must already exist there
+(e.g. a database seeded by run_bench or gen_dataset with --user-prefix).
+Results use the run_bench JSON format, so --compare shows latency and error
+deltas against an earlier replay.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import run_bench  # noqa: E402
+
+ACCESS_RE = re.compile(
+    r'\[(?P<ts>[^\]]+)\]\s+"(?P<method>[A-Z]+) (?P<path>\S+) HTTP/[\d.]+"\s+(?P<status>\d{3})')
+ACCESS_TS_FORMATS = ['%d/%b/%Y %H:%M:%S', '%d/%b/%Y:%H:%M:%S %z']
+PUBLIC_PATHS = {'/api/login', '/api/online', '/api/register', '/health'}
+ADMIN_WRITES = re.compile(r'^/api/admin/(users(/\d+|/import|/bulk-delete)?|archive|sync_all)$')
+PUNCH_TYPES = ['Entrada', 'Saída Almoço', 'Volta Almoço', 'Saída']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reproduz o tráfego dos logs contra uma instância local")
+    parser.add_argument('logs', nargs='+', help="server_log.txt, access logs or JSON logs")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--target', help="base URL of a running instance")
+    target.add_argument('--spawn', action='store_true', help="start serve.py on a temporary seeded database")
+    parser.add_argument('--backend', choices=['sqlite', 'standin'], default='sqlite', help="with --spawn")
+    parser.add_argument('--workers', type=int, default=2, help="serve.py processes with --spawn")
+    parser.add_argument('--speed', type=float, default=1.0, help="time compression (10 = 10x faster; 0 = no waits)")
+    parser.add_argument('--max-gap', type=float, default=60.0, help="idle gaps longer than this (s) are shortened to it")
+    parser.add_argument('--concurrency', type=int, default=32, help="max in-flight requests")
+    parser.add_argument('--users', type=int, default=50, help="synthetic users")
+    parser.add_argument('--user-prefix', default='b', help="synthetic matriculas are <prefix>00000, <prefix>00001...")
+    parser.add_argument('--admin', default='benchadmin')
+    parser.add_argument('--password', default=run_bench.PASSWORD)
+    parser.add_argument('--secret', default=os.getenv('SECRET_KEY'), help="JWT secret of the target")
+    parser.add_argument('--admin-writes', action='store_true', help="also replay admin writes")
+    parser.add_argument('--api-only', action='store_true', help="skip static files")
+    parser.add_argument('--limit', type=int, help="replay at most this many requests")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="earlier replay JSON to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+# --- parsing ----------------------------------------------------------------
+
+def _parse_access_ts(raw):
+    for fmt in ACCESS_TS_FORMATS:
+        try:
+            ts = datetime.datetime.strptime(raw, fmt)
+            return ts.timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_line(line):
+    """Returns (epoch, method, path, status or None, kind) or None when the line is not a request.
+
+    kind is 'access' (werkzeug/gunicorn), 'request' (JSON DEBUG line, no status)
+    or 'slow' (JSON "slow request" line, logged when the request finished).
+    """
+    line = line.strip()
+    if line.startswith('{'):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        if entry.get('msg') not in ('request', 'slow request') or not entry.get('path'):
+            return None
+        try:
+            ts = datetime.datetime.fromisoformat(entry['ts']).timestamp()
+        except (KeyError, ValueError):
+            return None
+        if entry['msg'] == 'request':
+            return ts, entry.get('method', 'GET'), entry['path'], None, 'request'
+        ts -= (entry.get('duration_ms') or 0) / 1000.0
+        return ts, entry.get('method', 'GET'), entry['path'], entry.get('status'), 'slow'
+    m = ACCESS_RE.search(line)
+    if not m:
+        return None
+    ts = _parse_access_ts(m.group('ts'))
+    if ts is None:
+        return None
+    return ts, m.group('method'), m.group('path'), int(m.group('status')), 'access'
+
+
+def load_events(paths, api_only=False):
+    """Requests of all files as (epoch, method, path, status), sorted by arrival.
+
+    A JSON log written with LOG_LEVEL=DEBUG has a "request" line for every API
+    call; its "slow request" lines are then duplicates and only the former are
+    used. Without DEBUG only the slow requests are known.
+    """
+    events = []
+    for path in paths:
+        found = {'access': [], 'request': [], 'slow': []}
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                ev = parse_line(line)
+                if ev and not (api_only and not ev[2].startswith('/api/')):
+                    found[ev[4]].append(ev[:4])
+        events += found['access'] + (found['request'] or found['slow'])
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def schedule(events, speed, max_gap):
+    """Offsets (seconds from the start of the replay) for each event."""
+    offsets = []
+    t = 0.0
+    prev = None
+    for ev in events:
+        if prev is not None:
+            t += min(max(ev[0] - prev, 0.0), max_gap)
+        prev = ev[0]
+        offsets.append(t / speed if speed > 0 else 0.0)
+    return offsets
+
+
+def endpoint_label(method, path):
+    bare = path.split('?', 1)[0]
+    bare = re.sub(r'/\d+(?=/|$)', '/<id>', bare)
+    if not bare.startswith('/api/'):
+        bare = '<static>'
+    return f"{method} {bare}"
+
+
+# --- request synthesis --------------------------------------------------------
+
+class Synth:
+    """Turns a logged (method, path) into a concrete request with a synthetic identity."""
+    def __init__(self, args, secret):
+        import jwt
+        self.rng = random.Random(11)
+        self.users = [f"{args.user_prefix}{i:05d}" for i in range(args.users)]
+        exp = datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+        self.tokens = [jwt.encode({'matricula': m, 'role': 'user', 'exp': exp}, secret, algorithm='HS256')
+                       for m in self.users]
+        self.admin_token = jwt.encode({'matricula': args.admin, 'role': 'admin', 'exp': exp}, secret, algorithm='HS256')
+        self.password = args.password
+        self.admin_writes = args.admin_writes
+        self.next_user = 0
+        self.punches = {}
+        self.lock = threading.Lock()
+
+    def _user(self):
+        with self.lock:
+            i = self.next_user % len(self.users)
+            self.next_user += 1
+        return i
+
+    def build(self, method, path):
+        """(method, path, body, headers) or None to skip."""
+        bare = path.split('?', 1)[0]
+        if method == 'OPTIONS':
+            return method, path, None, {'Origin': 'http://localhost:8000',
+                                        'Access-Control-Request-Method': 'POST',
+                                        'Access-Control-Request-Headers': 'authorization,content-type'}
+        if bare.startswith('/api/admin/'):
+            if method != 'GET' and ADMIN_WRITES.match(bare) and not self.admin_writes:
+                return None
+            body = {} if method in ('POST', 'PUT') else None
+            if bare == '/api/admin/users' and method == 'POST':
+                body = {'matricula': f"r{self.rng.randrange(10**8)}", 'password': self.password,
+                        'name': 'Replay', 'role': 'user'}
+            return method, path, body, {'Authorization': f'Bearer {self.admin_token}'}
+        i = self._user()
+        if bare == '/api/login':
+            return method, path, {'matricula': self.users[i], 'password': self.password}, {}
+        if bare == '/api/register':
+            return method, path, {'matricula': f"r{self.rng.randrange(10**8)}", 'password': self.password,
+                                  'name': 'Replay'}, {}
+        if bare in PUBLIC_PATHS or not bare.startswith('/api/'):
+            return method, path, None, {}
+        headers = {'Authorization': f'Bearer {self.tokens[i]}'}
+        if bare == '/api/punch':
+            with self.lock:
+                n = self.punches.get(i, 0)
+                self.punches[i] = n + 1
+            return method, path, {'type': PUNCH_TYPES[n % len(PUNCH_TYPES)], 'neighborhood': 'Carapina',
+                                  'city': 'Serra'}, headers
+        return method, path, {} if method in ('POST', 'PUT') else None, headers
+
+
+def send(base_url, method, path, body, headers):
+    import urllib.error
+    import urllib.request
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method, headers=headers)
+    if data is not None:
+        req.add_header('Content-Type', 'application/json')
+    try:
+        with urllib.request.urlopen(req, timeout=120) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+    except (urllib.error.URLError, OSError):
+        return 599
+
+
+# --- replay -----------------------------------------------------------------
+
+def replay(base_url, events, offsets, synth, concurrency):
+    samples = []
+    lags = []
+    skipped = {}
+    original = {}
+    sem = threading.Semaphore(concurrency)
+
+    def one(label, req):
+        try:
+            t0 = time.perf_counter()
+            status = send(base_url, *req)
+            samples.append((label, time.perf_counter() - t0, status))
+        finally:
+            sem.release()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for (ts, method, path, status), offset in zip(events, offsets):
+            label = endpoint_label(method, path)
+            req = synth.build(method, path)
+            if req is None:
+                skipped[label] = skipped.get(label, 0) + 1
+                continue
+            orig = original.setdefault(label, [0, 0])
+            if status is not None:
+                orig[0] += 1
+                orig[1] += 1 if status >= 400 else 0
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sem.acquire()
+            lags.append(max(0.0, time.perf_counter() - (start + offset)))
+            pool.submit(one, label, req)
+    wall = time.perf_counter() - start
+    return samples, wall, lags, skipped, original
+
+
+def spawn_server(args, workdir):
+    """Seeds a temporary database with the synthetic users and starts serve.py on it."""
+    secret = 'replay-secret-for-local-benchmarks-only'
+    os.environ.update({
+        'SQLITE_PATH': os.path.join(workdir, 'local.db'),
+        'INIT_DB_ON_START': 'false',
+        'LOG_LEVEL': 'WARNING',
+        'LOG_FILE': os.path.join(workdir, 'app-{pid}.log'),
+        'SECRET_KEY': secret,
+        'DB_SERVER': '' if args.backend == 'sqlite' else 'standin',
+        'DB_STATE_FILE': os.path.join(workdir, 'db_state.json'),
+        'ARCHIVE_INTERVAL_HOURS': '0',
+        'RATE_LIMIT_ENABLED': 'false',  # synthetic clients all come from one address
+    })
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    standin = os.path.join(workdir, 'standin.db')
+    if args.backend == 'standin':
+        import fake_pymssql
+        fake_pymssql.install(standin)
+    else:
+        sys.modules['pymssql'] = None
+    import app as ponto
+    run_bench.seed_data(ponto, args.backend, args.users, 10, 12, random.Random(5))
+    port = run_bench.free_port()
+    cmd = [sys.executable]
+    if args.backend == 'standin':
+        cmd += [os.path.join(BENCH_DIR, 'fake_pymssql.py'), '--db', standin]
+    cmd += [os.path.join(ROOT, 'serve.py'), '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(args.workers), '--state-file', os.environ['DB_STATE_FILE']]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=os.environ.copy(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    if not run_bench.wait_ready(base_url, want_db=args.backend == 'standin'):
+        proc.kill()
+        raise RuntimeError(f"server did not become ready on {base_url}")
+    return proc, base_url, secret
+
+
+def main():
+    args = parse_args()
+    if args.spawn:
+        args.user_prefix, args.admin, args.password = 'b', 'benchadmin', run_bench.PASSWORD
+    events = load_events(args.logs, args.api_only)
+    if args.limit:
+        events = events[:args.limit]
+    if not events:
+        print("Nenhuma requisição encontrada nos logs.", file=sys.stderr)
+        return 2
+    offsets = schedule(events, args.speed, args.max_gap)
+    span = events[-1][0] - events[0][0]
+    print(f"{len(events)} requisições de {datetime.datetime.fromtimestamp(events[0][0]):%d/%m/%Y %H:%M} "
+          f"({span / 60:.0f} min nos logs, {offsets[-1]:.0f}s de reprodução)", file=sys.stderr)
+
+    workdir = tempfile.mkdtemp(prefix='ponto-replay-') if args.spawn else None
+    proc = None
+    try:
+        if args.spawn:
+            proc, base_url, secret = spawn_server(args, workdir)
+        else:
+            base_url, secret = args.target.rstrip('/'), args.secret
+            if not secret:
+                print("Informe --secret (SECRET_KEY do servidor) para gerar os tokens.", file=sys.stderr)
+                return 2
+        synth = Synth(args, secret)
+        samples, wall, lags, skipped, original = replay(base_url, events, offsets, synth, args.concurrency)
+    finally:
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    endpoints = run_bench.summarize(samples, wall)
+    for label, st in endpoints.items():
+        n, errs = original.get(label, (0, 0))
+        st['original_error_rate'] = round(errs / n, 3) if n else None
+        st['error_rate'] = round(st['errors'] / st['count'], 3)
+    lags.sort()
+    results = {
+        'meta': {
+            'commit': run_bench.git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'logs': args.logs,
+            'speed': args.speed,
+            'requests': len(samples),
+            'skipped': skipped,
+            'schedule_lag_p95_ms': round(run_bench.percentile(lags, 95) * 1000, 2) if lags else None,
+        },
+        'runs': {'replay': {'users': args.users, 'records': len(events),
+                            'scenarios': {'replay': {'wall_s': round(wall, 3), 'endpoints': endpoints}}}},
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    base_endpoints = baseline['runs']['replay']['scenarios']['replay']['endpoints'] if baseline else {}
+
+    def rate(value):
+        return f"{value:.1%}" if value is not None else '-'
+
+    run_bench.print_results(results)
+    print(f"\n  {'endpoint':<36} {'erros log':>10} {'erros base':>11} {'erros replay':>13}")
+    for label, st in endpoints.items():
+        base = base_endpoints.get(label, {}).get('error_rate')
+        print(f"  {label:<36} {rate(st['original_error_rate']):>10} {rate(base):>11} {rate(st['error_rate']):>13}")
+    if skipped:
+        print(f"\n  ignoradas (escritas administrativas): {sum(skipped.values())}")
+    if results['meta']['schedule_lag_p95_ms'] and results['meta']['schedule_lag_p95_ms'] > 100:
+        print(f"\n  atenção: envio atrasado (p95 {results['meta']['schedule_lag_p95_ms']} ms); aumente --concurrency")
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if baseline:
+        if run_bench.compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
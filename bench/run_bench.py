@@ -0,0 +1,449 @@
+"""
+Load-test benchmarks for the Ponto API.
+
+Drives the app with realistic request mixes and reports p50/p95/p99 latency
+and requests per second per endpoint:
+
+- login:   a login storm, every user logs in once (bcrypt cost included);
+- punch:   the 08:00 burst, every user punches once;
+- history: dashboard polling of /api/history and /api/online;
+- report:  admin and user Excel exports over the current month;
+- mixed:   a weighted mix of the above, as seen during the working day.
+
+Each run uses a fresh temporary database, against the local SQLite fallback
+(`sqlite`) or the SQL Server stand-in from fake_pymssql.py (`standin`), through
+the Flask test client (`client`) or a real `serve.py` process (`server`).
+
+    python bench/run_bench.py                                   # all backends and modes
+    python bench/run_bench.py --backend standin --mode server --users 200 --concurrency 16
+    python bench/run_bench.py --save bench/baseline.json        # record a baseline
+    python bench/run_bench.py --compare bench/baseline.json     # compare with it
+
+Results are JSON; --compare prints the p95 and req/s change per endpoint and
+exits with status 1 when one regressed by more than --tolerance.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+SCENARIOS = ['login', 'punch', 'history', 'report', 'mixed']
+PASSWORD = 'bench123'
+CITIES = [('Carapina', 'Serra'), ('Laranjeiras', 'Serra'), ('Jardim Camburi', 'Vitória'),
+          ('Praia da Costa', 'Vila Velha'), ('Campo Grande', 'Cariacica')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks da API do Ponto")
+    parser.add_argument('--backend', choices=['sqlite', 'standin', 'all'], default='all')
+    parser.add_argument('--mode', choices=['client', 'server', 'all'], default='all')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=15, help="days of existing punches per user")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=400, help="requests for the history and mixed scenarios")
+    parser.add_argument('--reports', type=int, default=10, help="exports per report endpoint")
+    parser.add_argument('--workers', type=int, default=2, help="serve.py processes in server mode")
+    parser.add_argument('--bcrypt-rounds', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression (0.2 = 20%%)")
+    parser.add_argument('--run-one', nargs=2, metavar=('BACKEND', 'MODE'), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+# --- statistics -------------------------------------------------------------
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def summarize(samples, wall):
+    """samples: list of (endpoint, seconds, status). Returns per-endpoint stats."""
+    by_endpoint = {}
+    for endpoint, elapsed, status in samples:
+        by_endpoint.setdefault(endpoint, []).append((elapsed, status))
+    out = {}
+    for endpoint, items in sorted(by_endpoint.items()):
+        lat = sorted(e for e, _ in items)
+        errors = sum(1 for _, s in items if not (200 <= s < 300))
+        out[endpoint] = {
+            'count': len(items),
+            'errors': errors,
+            'rps': round(len(items) / wall, 2) if wall > 0 else None,
+            'mean_ms': round(sum(lat) / len(lat) * 1000, 2),
+            'p50_ms': round(percentile(lat, 50) * 1000, 2),
+            'p95_ms': round(percentile(lat, 95) * 1000, 2),
+            'p99_ms': round(percentile(lat, 99) * 1000, 2),
+            'max_ms': round(lat[-1] * 1000, 2),
+        }
+    return out
+
+
+# --- data -------------------------------------------------------------------
+
+def seed_data(ponto, backend, users, days, rounds, rng):
+    """Creates users (shared password hash) and `days` of punches per user."""
+    import bcrypt
+    hashed = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+    people = [(f"b{i:05d}", hashed, f"Servidor {i}", 'user') for i in range(users)]
+    people.append(('benchadmin', hashed, 'Admin Benchmark', 'admin'))
+
+    today = ponto.now_local().replace(hour=0, minute=0, second=0)
+    records = []
+    for uid, (mat, _, name, _) in enumerate(people, start=1):
+        neighborhood, city = rng.choice(CITIES)
+        for d in range(days, 0, -1):
+            day = today - datetime.timedelta(days=d)
+            if day.weekday() >= 5:
+                continue
+            start = day + datetime.timedelta(hours=7, minutes=rng.randint(30, 80))
+            end = start + datetime.timedelta(hours=8, minutes=rng.randint(0, 60))
+            records.append((uid, mat, name, 'entrada', start, neighborhood, city))
+            if rng.random() > 0.05:  # some forgotten exits
+                records.append((uid, mat, name, 'saida', end, neighborhood, city))
+
+    local = ponto.connect_local()
+    ponto.ensure_sqlite_schema(local)
+    local.executemany("INSERT INTO Users (matricula, password, name, role) VALUES (?, ?, ?, ?)", people)
+    if backend == 'sqlite':
+        local.executemany(
+            "INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, timestamp, ts_epoch, tz, neighborhood, city) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(u, m, n, t, ponto.format_ts(ts), ponto.to_epoch(ts), ponto.LOCAL_TZ_NAME, nb, c)
+             for u, m, n, t, ts, nb, c in records])
+    local.commit()
+    local.close()
+
+    if backend == 'standin':
+        import pymssql
+        conn = pymssql.connect(server='standin', autocommit=False)
+        cur = conn.cursor()
+        cur.executemany("INSERT INTO Users (matricula, password, name, role) VALUES (%s, %s, %s, %s)", people)
+        cur.executemany(
+            "INSERT INTO TimeRecords (user_id, matricula, user_name, record_type, timestamp, neighborhood, city) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s)", records)
+        conn.commit()
+        conn.close()
+    return [p[0] for p in people if p[3] == 'user'], len(records)
+
+
+def make_token(ponto, matricula, role='user'):
+    import jwt
+    return jwt.encode({'matricula': matricula, 'role': role,
+                       'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=2)},
+                      ponto.app.config['SECRET_KEY'], algorithm='HS256')
+
+
+# --- transports ---------------------------------------------------------------
+
+class ClientTransport:
+    """Flask test client, one per thread."""
+    def __init__(self, ponto):
+        self.app = ponto.app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        resp = client.open(path, method=method, json=body, headers=headers)
+        resp.get_data()
+        return resp.status_code
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, path, body=None, token=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            req.add_header('Content-Type', 'application/json')
+        if token:
+            req.add_header('Authorization', f'Bearer {token}')
+        try:
+            with urllib.request.urlopen(req, timeout=120) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+        except (urllib.error.URLError, OSError):
+            return 599
+
+
+def drive(transport, jobs, concurrency):
+    """Runs (endpoint, method, path, body, token) jobs on a thread pool. Returns (samples, wall)."""
+    def one(job):
+        endpoint, method, path, body, token = job
+        t0 = time.perf_counter()
+        status = transport.request(method, path, body, token)
+        return endpoint, time.perf_counter() - t0, status
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(one, jobs))
+    return samples, time.perf_counter() - t0
+
+
+# --- scenarios --------------------------------------------------------------
+
+def build_jobs(scenario, ponto, matriculas, args, rng):
+    tokens = {m: make_token(ponto, m) for m in matriculas}
+    admin = make_token(ponto, 'benchadmin', 'admin')
+    today = ponto.now_local().date()
+    month_start = today.replace(day=1).isoformat()
+
+    def login(m):
+        return ('POST /api/login', 'POST', '/api/login', {'matricula': m, 'password': PASSWORD}, None)
+
+    def punch(m, kind='entrada'):
+        neighborhood, city = rng.choice(CITIES)
+        return ('POST /api/punch', 'POST', '/api/punch', {'type': kind, 'neighborhood': neighborhood, 'city': city}, tokens[m])
+
+    def history(m):
+        return ('GET /api/history', 'GET', '/api/history', None, tokens[m])
+
+    def online():
+        return ('GET /api/online', 'GET', '/api/online', None, None)
+
+    def admin_report():
+        return ('GET /api/admin/report', 'GET', f'/api/admin/report?start_date={month_start}&end_date={today.isoformat()}', None, admin)
+
+    def user_report(m):
+        return ('GET /api/user/report', 'GET', f'/api/user/report?start_date={month_start}', None, tokens[m])
+
+    if scenario == 'login':
+        return [login(m) for m in rng.sample(matriculas, len(matriculas))]
+    if scenario == 'punch':
+        return [punch(m) for m in rng.sample(matriculas, len(matriculas))]
+    if scenario == 'history':
+        jobs = []
+        for _ in range(args.requests):
+            jobs.append(history(rng.choice(matriculas)) if rng.random() < 0.5 else online())
+        return jobs
+    if scenario == 'report':
+        jobs = [admin_report() for _ in range(args.reports)]
+        jobs += [user_report(rng.choice(matriculas)) for _ in range(args.reports)]
+        rng.shuffle(jobs)
+        return jobs
+    # mixed: mostly polling, some punches and logins, rare exports
+    weights = [(online, 40), (history, 35), (punch, 15), (login, 8), (user_report, 1.5), (admin_report, 0.5)]
+    fns, w = zip(*weights)
+    jobs = []
+    for fn in rng.choices(fns, weights=w, k=args.requests):
+        jobs.append(fn() if fn in (online, admin_report) else fn(rng.choice(matriculas)))
+    return jobs
+
+
+# --- one run (child process) --------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(base_url, want_db, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + '/api/online', timeout=2) as resp:
+                if not want_db or json.loads(resp.read()).get('db_online'):
+                    return True
+        except (urllib.error.URLError, OSError, ValueError):
+            pass
+        time.sleep(0.3)
+    return False
+
+
+def run_one(backend, mode, args):
+    workdir = tempfile.mkdtemp(prefix='ponto-bench-')
+    env = {
+        'SQLITE_PATH': os.path.join(workdir, 'local.db'),
+        'INIT_DB_ON_START': 'false',
+        'LOG_LEVEL': 'WARNING',
+        'LOG_FILE': os.path.join(workdir, 'app-{pid}.log'),  # keep stdout for the JSON result
+        'SECRET_KEY': 'bench-secret',
+        'DB_SERVER': '' if backend == 'sqlite' else 'standin',
+        'DB_STATE_FILE': os.path.join(workdir, 'db_state.json'),
+        'ARCHIVE_INTERVAL_HOURS': '0',
+        'RATE_LIMIT_ENABLED': 'false',  # synthetic clients all come from one address
+    }
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    os.chdir(ROOT)
+    if backend == 'standin':
+        import fake_pymssql
+        fake_pymssql.install(os.path.join(workdir, 'standin.db'))
+    else:
+        sys.modules['pymssql'] = None  # never reach a real server from a benchmark
+    import app as ponto
+
+    rng = random.Random(args.seed)
+    matriculas, n_records = seed_data(ponto, backend, args.users, args.days, args.bcrypt_rounds, rng)
+
+    proc = None
+    try:
+        if mode == 'client':
+            # Single process: act as the supervisor without starting its threads
+            ponto.DB_STATE_FILE = None
+            ponto.DB_ONLINE = backend == 'standin'
+            transport = ClientTransport(ponto)
+        else:
+            port = free_port()
+            cmd = [sys.executable]
+            if backend == 'standin':
+                cmd += [os.path.join(BENCH_DIR, 'fake_pymssql.py'), '--db', os.path.join(workdir, 'standin.db')]
+            cmd += [os.path.join(ROOT, 'serve.py'), '--host', '127.0.0.1', '--port', str(port),
+                    '--workers', str(args.workers), '--state-file', env['DB_STATE_FILE']]
+            proc = subprocess.Popen(cmd, cwd=ROOT, env=os.environ.copy(),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            base_url = f'http://127.0.0.1:{port}'
+            if not wait_ready(base_url, want_db=backend == 'standin'):
+                raise RuntimeError(f"server did not become ready on {base_url}")
+            transport = HttpTransport(base_url)
+
+        results = {'users': len(matriculas), 'records': n_records, 'scenarios': {}}
+        for scenario in args.scenario or SCENARIOS:
+            jobs = build_jobs(scenario, ponto, matriculas, args, rng)
+            samples, wall = drive(transport, jobs, args.concurrency)
+            results['scenarios'][scenario] = {'wall_s': round(wall, 3), 'endpoints': summarize(samples, wall)}
+        return results
+    finally:
+        if proc:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# --- orchestration ------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def child_args(args, backend, mode):
+    argv = [sys.executable, os.path.abspath(__file__), '--run-one', backend, mode,
+            '--users', str(args.users), '--days', str(args.days), '--concurrency', str(args.concurrency),
+            '--requests', str(args.requests), '--reports', str(args.reports), '--workers', str(args.workers),
+            '--bcrypt-rounds', str(args.bcrypt_rounds), '--seed', str(args.seed)]
+    for s in args.scenario or []:
+        argv += ['--scenario', s]
+    return argv
+
+
+def print_results(results):
+    for run, data in results['runs'].items():
+        if 'error' in data:
+            print(f"\n[{run}] ERRO: {data['error']}")
+            continue
+        print(f"\n[{run}] {data['users']} usuários, {data['records']} registros")
+        print(f"  {'cenário':<8} {'endpoint':<24} {'n':>5} {'err':>4} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for scenario, sdata in data['scenarios'].items():
+            for endpoint, st in sdata['endpoints'].items():
+                print(f"  {scenario:<8} {endpoint:<24} {st['count']:>5} {st['errors']:>4} {st['rps']:>8} "
+                      f"{st['p50_ms']:>8} {st['p95_ms']:>8} {st['p99_ms']:>8}")
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change per endpoint; returns the list of regressions."""
+    regressions = []
+    print(f"\nComparação com {baseline['meta'].get('commit')} (tolerância {tolerance:.0%})")
+    for run, data in results['runs'].items():
+        base_run = baseline['runs'].get(run)
+        if not base_run or 'scenarios' not in data or 'scenarios' not in base_run:
+            continue
+        for scenario, sdata in data['scenarios'].items():
+            base_s = base_run['scenarios'].get(scenario, {}).get('endpoints', {})
+            for endpoint, st in sdata['endpoints'].items():
+                b = base_s.get(endpoint)
+                if not b:
+                    continue
+                p95 = st['p95_ms'] / b['p95_ms'] if b['p95_ms'] else 1.0
+                rps = st['rps'] / b['rps'] if b['rps'] else 1.0
+                bad = p95 > 1 + tolerance or rps < 1 / (1 + tolerance) or st['errors'] > b['errors']
+                flag = 'REGRESSÃO' if bad else ''
+                print(f"  {run:<16} {scenario:<8} {endpoint:<24} p95 {b['p95_ms']:>8} -> {st['p95_ms']:>8} ({p95 - 1:+.0%})"
+                      f"  req/s {b['rps']:>7} -> {st['rps']:>7} ({rps - 1:+.0%})  {flag}")
+                if bad:
+                    regressions.append((run, scenario, endpoint))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    if args.run_one:
+        backend, mode = args.run_one
+        json.dump(run_one(backend, mode, args), sys.stdout)
+        return 0
+
+    backends = ['sqlite', 'standin'] if args.backend == 'all' else [args.backend]
+    modes = ['client', 'server'] if args.mode == 'all' else [args.mode]
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('save', 'compare', 'run_one')},
+        },
+        'runs': {},
+    }
+    for backend in backends:
+        for mode in modes:
+            run = f"{backend}/{mode}"
+            print(f"Executando {run}...", file=sys.stderr)
+            # Each run gets its own process: app.py reads its configuration at import time
+            proc = subprocess.run(child_args(args, backend, mode), capture_output=True, text=True)
+            if proc.returncode != 0:
+                results['runs'][run] = {'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'falhou'}
+                continue
+            results['runs'][run] = json.loads(proc.stdout)
+
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados salvos em {args.save}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
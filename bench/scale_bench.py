@@ -0,0 +1,205 @@
+"""
+Scaling benchmarks: how sync, history and the report exports behave as the
+data grows.
+
+For every size (users x days of history) a dataset is generated with
+gen_dataset.py into a temporary directory and measured in a fresh process:
+
+- history:      GET /api/history for random users (p50/p95);
+- user export:  GET /api/user/report over the whole history of one user;
+- admin export: GET /api/admin/report for the last 30 days of every user;
+- sync:         perform_sync_for_user for users with pending OfflineQueue rows
+                (rows/s and p95 per user).
+
+With --backend standin (default) the history lives on the SQL Server stand-in,
+which is the production layout; --backend sqlite measures the offline fallback.
+
+    python bench/scale_bench.py --sizes 100x30,1000x60,5000x120
+    python bench/scale_bench.py --sizes 500x30,500x90,500x365 --csv curva.csv --plot curva.png
+
+The printed "slope" is the log-log growth of each metric against the number of
+records between the smallest and largest size (1.0 = linear).
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+METRICS = ['history_p50_ms', 'history_p95_ms', 'user_export_s', 'admin_export_s', 'sync_rows_per_s', 'sync_p95_ms']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de escala (sync, histórico e relatórios)")
+    parser.add_argument('--sizes', default='100x30,1000x60,5000x120', help="comma-separated USERSxDAYS")
+    parser.add_argument('--backend', choices=['standin', 'sqlite'], default='standin')
+    parser.add_argument('--samples', type=int, default=50, help="history requests per size")
+    parser.add_argument('--exports', type=int, default=3, help="exports per report per size")
+    parser.add_argument('--sync-users', type=int, default=20, help="users with pending punches to sync")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--csv', help="write the curve as CSV")
+    parser.add_argument('--plot', help="write a PNG chart (requires matplotlib)")
+    parser.add_argument('--run-one', nargs=2, metavar=('USERS', 'DAYS'), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run_one(users, days, args):
+    workdir = tempfile.mkdtemp(prefix='ponto-scale-')
+    local = os.path.join(workdir, 'local.db')
+    standin = os.path.join(workdir, 'standin.db') if args.backend == 'standin' else None
+    os.environ.update({
+        'LOG_FILE': os.path.join(workdir, 'app.log'),
+        'SECRET_KEY': 'bench-secret',
+        'ARCHIVE_INTERVAL_HOURS': '0',
+        'RATE_LIMIT_ENABLED': 'false',  # synthetic clients all come from one address
+    })
+    os.environ.pop('DB_STATE_FILE', None)
+    if not standin:
+        os.environ['DB_SERVER'] = ''
+        sys.modules['pymssql'] = None
+    os.chdir(ROOT)
+    import gen_dataset
+    ponto = gen_dataset.load_app(local, standin)
+    from run_bench import make_token, percentile
+    try:
+        t0 = time.time()
+        counts = gen_dataset.generate(ponto, users, days, queue=args.sync_users * 4, local=local, standin=standin,
+                                      bcrypt_rounds=4)
+        gen_s = time.time() - t0
+        ponto.DB_STATE_FILE = None
+        ponto.DB_ONLINE = bool(standin)
+        ponto.ensure_default_admin()
+        client = ponto.app.test_client()
+        rng = random.Random(3)
+        matriculas = [str(100000 + i) for i in range(users)]
+        admin = {'Authorization': f"Bearer {make_token(ponto, os.getenv('ADMIN_MATRICULA', 'admin'), 'admin')}"}
+
+        def timed(path, headers):
+            t = time.perf_counter()
+            resp = client.get(path, headers=headers)
+            body = resp.get_data()
+            if resp.status_code != 200:
+                raise RuntimeError(f"{path}: HTTP {resp.status_code}")
+            return time.perf_counter() - t, len(body)
+
+        history = sorted(timed('/api/history', {'Authorization': f"Bearer {make_token(ponto, rng.choice(matriculas))}"})[0]
+                         for _ in range(args.samples))
+        user_exports = [timed('/api/user/report', {'Authorization': f"Bearer {make_token(ponto, rng.choice(matriculas))}"})
+                        for _ in range(args.exports)]
+        today = ponto.now_local().date()
+        start = (today - ponto.datetime.timedelta(days=30)).isoformat()
+        admin_exports = [timed(f'/api/admin/report?start_date={start}&end_date={today.isoformat()}', admin)
+                         for _ in range(args.exports)]
+
+        conn = ponto.connect_local()
+        pending = [r[0] for r in conn.execute("SELECT DISTINCT matricula FROM OfflineQueue")]
+        conn.close()
+        sync_times = []
+        synced = 0
+        for m in pending:
+            t = time.perf_counter()
+            migrated, _ = ponto.perform_sync_for_user(m)
+            sync_times.append(time.perf_counter() - t)
+            synced += migrated
+        sync_times.sort()
+        return {
+            'users': counts['users'],
+            'days': days,
+            'records': counts['records'],
+            'generate_s': round(gen_s, 2),
+            'history_p50_ms': round(percentile(history, 50) * 1000, 2),
+            'history_p95_ms': round(percentile(history, 95) * 1000, 2),
+            'user_export_s': round(sum(t for t, _ in user_exports) / len(user_exports), 3),
+            'user_export_bytes': max(b for _, b in user_exports),
+            'admin_export_s': round(sum(t for t, _ in admin_exports) / len(admin_exports), 3),
+            'admin_export_bytes': max(b for _, b in admin_exports),
+            'sync_users': len(pending),
+            'sync_rows': synced,
+            'sync_rows_per_s': round(synced / sum(sync_times), 1) if sync_times and sum(sync_times) else None,
+            'sync_p95_ms': round(percentile(sync_times, 95) * 1000, 2) if sync_times else None,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def slope(points):
+    """log-log slope between the first and last (x, y) points."""
+    pts = [(x, y) for x, y in points if x and y]
+    if len(pts) < 2 or pts[0][0] == pts[-1][0]:
+        return None
+    (x0, y0), (x1, y1) = pts[0], pts[-1]
+    return round(math.log(y1 / y0) / math.log(x1 / x0), 2)
+
+
+def plot(rows, path):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib não instalado; gráfico não gerado.", file=sys.stderr)
+        return
+    x = [r['records'] for r in rows]
+    fig, axes = plt.subplots(2, 3, figsize=(14, 7))
+    for ax, metric in zip(axes.flat, METRICS):
+        ax.plot(x, [r[metric] for r in rows], marker='o')
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_title(metric)
+        ax.set_xlabel('registros')
+    fig.tight_layout()
+    fig.savefig(path)
+    print(f"Gráfico salvo em {path}")
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, BENCH_DIR)
+    if args.run_one:
+        json.dump(run_one(int(args.run_one[0]), int(args.run_one[1]), args), sys.stdout)
+        return 0
+
+    sizes = [tuple(int(v) for v in s.lower().split('x')) for s in args.sizes.split(',') if s.strip()]
+    rows = []
+    for users, days in sizes:
+        print(f"Medindo {users} usuários x {days} dias...", file=sys.stderr)
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-one', str(users), str(days),
+               '--backend', args.backend, '--samples', str(args.samples), '--exports', str(args.exports),
+               '--sync-users', str(args.sync_users)]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'falhou', file=sys.stderr)
+            continue
+        rows.append(json.loads(proc.stdout))
+
+    header = ['users', 'days', 'records'] + METRICS
+    print('  '.join(f"{h:>15}" for h in header))
+    for r in rows:
+        print('  '.join(f"{r[h] if r[h] is not None else '-':>15}" for h in header))
+    slopes = {m: slope([(r['records'], r[m]) for r in rows]) for m in METRICS}
+    print('  '.join(f"{v:>15}" for v in ['', '', 'slope'] + [slopes[m] if slopes[m] is not None else '-' for m in METRICS]))
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'backend': args.backend, 'sizes': rows, 'slopes': slopes}, f, indent=2)
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else header)
+            writer.writeheader()
+            writer.writerows(rows)
+    if args.plot and rows:
+        plot(rows, args.plot)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
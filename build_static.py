@@ -0,0 +1,182 @@
+"""
+Builds the frontend served by app.py into dist/:
+
+- assets (config.js, images...) get a content hash in the name
+  (assets/config.3f9a1c2b7e.js) and are served as immutable;
+- the HTML pages point at the fingerprinted names and are served with a
+  strong ETag (content hash) and `Cache-Control: no-cache`;
+- text files get gzip and, when the `brotli` package is installed, brotli
+  variants next to them (.gz/.br), picked by Accept-Encoding at serve time.
+
+    python build_static.py            # builds into dist/
+    python build_static.py --out /tmp/dist
+
+app.py also rebuilds on its own (STATIC_AUTOBUILD) when a source file changes,
+e.g. when start_ponto.py rewrites netlify/config.js with the ngrok URL: a
+background thread in the supervisor process rescans the sources every few
+seconds, and every process re-reads manifest.json when it changes.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# (source directory, URL prefix of its files)
+SOURCES = [('netlify', ''), ('static', 'static/')]
+COMPRESSIBLE = {'.html', '.js', '.css', '.json', '.svg', '.txt', '.map', '.ico'}
+MIN_SAVING = 0.1  # keep a compressed variant only if it is at least 10% smaller
+REF_RE = re.compile(r'''(\b(?:src|href)\s*=\s*["'])([^"'#?:]+)(["'])''')
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def scan_sources(root=ROOT):
+    """{logical path: (absolute path, mtime_ns, size)} for every source file."""
+    found = {}
+    for directory, prefix in SOURCES:
+        base = os.path.join(root, directory)
+        for dirpath, dirnames, filenames in os.walk(base):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for name in sorted(filenames):
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                logical = prefix + os.path.relpath(path, base).replace(os.sep, '/')
+                found[logical] = (path, st.st_mtime_ns, st.st_size)
+    return found
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _write_variants(out_dir, rel, data):
+    """Writes rel and its compressed variants; returns the encodings written."""
+    _write(os.path.join(out_dir, rel), data)
+    encodings = []
+    if os.path.splitext(rel)[1].lower() not in COMPRESSIBLE:
+        return encodings
+    variants = [('gzip', '.gz', lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli:
+        variants.insert(0, ('br', '.br', lambda d: brotli.compress(d, quality=11)))
+    for encoding, suffix, compress in variants:
+        packed = compress(data)
+        if len(packed) <= len(data) * (1 - MIN_SAVING):
+            _write(os.path.join(out_dir, rel + suffix), packed)
+            encodings.append(encoding)
+    return encodings
+
+
+def rewrite_refs(html, page, assets):
+    """Points src/href attributes of `page` at the fingerprinted asset names."""
+    page_dir = os.path.dirname(page)
+
+    def repl(m):
+        ref = m.group(2)
+        logical = os.path.normpath(os.path.join(page_dir, ref.lstrip('/') if ref.startswith('/') else ref))
+        logical = logical.replace(os.sep, '/')  # normpath already dropped any leading './'
+        url = assets.get(logical)
+        if not url:
+            return m.group(0)
+        target = '/' + url if ref.startswith('/') else os.path.relpath(url, page_dir or '.').replace(os.sep, '/')
+        return m.group(1) + target + m.group(3)
+
+    return REF_RE.sub(repl, html)
+
+
+def build(out_dir=None, root=ROOT):
+    """Builds dist/ and writes manifest.json last. Returns the manifest."""
+    out_dir = out_dir or os.path.join(root, 'dist')
+    t0 = time.perf_counter()
+    sources = scan_sources(root)
+    assets = {}
+    files = {}
+    pages = []
+    for logical, (path, _, _) in sources.items():
+        if logical.endswith('.html'):
+            pages.append(logical)
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        h = content_hash(data)
+        stem, ext = os.path.splitext(logical)
+        url = f"assets/{stem}.{h}{ext}"
+        assets[logical] = url
+        files[url] = {'file': url, 'etag': h, 'immutable': True, 'encodings': _write_variants(out_dir, url, data)}
+    for logical in pages:
+        with open(sources[logical][0], encoding='utf-8') as f:
+            html = rewrite_refs(f.read(), logical, assets).encode('utf-8')
+        rel = f"pages/{logical}"
+        files[logical] = {'file': rel, 'etag': content_hash(html), 'immutable': False,
+                          'encodings': _write_variants(out_dir, rel, html)}
+
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+    manifest = {
+        'built_at': time.time(),
+        'sources': {k: [mtime, size] for k, (_, mtime, size) in sources.items()},
+        'assets': assets,
+        'files': files,
+        # kept one build longer: pages already in browsers still reference them
+        'previous': {k: v for k, v in previous.get('files', {}).items() if v.get('immutable') and k not in files},
+    }
+    _write(manifest_path, json.dumps(manifest, indent=2).encode('utf-8'))
+    _prune(out_dir, manifest)
+    manifest['build_ms'] = round((time.perf_counter() - t0) * 1000, 1)
+    return manifest
+
+
+def _prune(out_dir, manifest):
+    """Removes fingerprinted files older than the previous build."""
+    keep = {e['file'] for e in list(manifest['files'].values()) + list(manifest['previous'].values())}
+    assets_dir = os.path.join(out_dir, 'assets')
+    for dirpath, _, filenames in os.walk(assets_dir):
+        for name in filenames:
+            rel = os.path.relpath(os.path.join(dirpath, name), out_dir).replace(os.sep, '/')
+            base = re.sub(r'\.(gz|br)$', '', rel)
+            if base not in keep and not name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera os arquivos estáticos com hash no nome e pré-comprimidos")
+    parser.add_argument('--out', default=os.path.join(ROOT, 'dist'))
+    args = parser.parse_args()
+    manifest = build(args.out)
+    for url, entry in sorted(manifest['files'].items()):
+        sizes = [os.path.getsize(os.path.join(args.out, entry['file']))]
+        sizes += [os.path.getsize(os.path.join(args.out, entry['file'] + ('.br' if e == 'br' else '.gz')))
+                  for e in entry['encodings']]
+        print(f"  {url:<48} {' / '.join(str(s) for s in sizes)} bytes ({', '.join(['identity'] + entry['encodings'])})")
+    if not brotli:
+        print("Pacote 'brotli' não instalado; apenas variantes gzip foram geradas.")
+    print(f"{len(manifest['files'])} arquivos em {args.out} ({manifest['build_ms']} ms)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
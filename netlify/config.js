@@ -66,12 +66,13 @@ async function offlineLogin(matricula, password) {
   if (hashed !== u.hash) return null;
   return { token: `offline:${matricula}`, role: u.role || "user", name: u.name || matricula };
 }
-function offlinePunchAdd(type, neighborhood, city) {
+function offlinePunchAdd(type, neighborhood, city, coords) {
   const q = getOfflineQueue();
   const ts = new Date();
   const pad = (n) => String(n).padStart(2, "0");
   const tsStr = `${ts.getFullYear()}-${pad(ts.getMonth() + 1)}-${pad(ts.getDate())} ${pad(ts.getHours())}:${pad(ts.getMinutes())}:${pad(ts.getSeconds())}`;
-  q.push({ type, timestamp: tsStr, neighborhood, city });
+  // coordinates go along so the server can resolve the address when it syncs
+  q.push({ type, timestamp: tsStr, neighborhood, city, ...(coords || {}) });
   setOfflineQueue(q);
   return { ok: true };
 }
@@ -111,6 +112,9 @@ async function offlineSync(token) {
           type: r.type,
           neighborhood: r.neighborhood,
           city: r.city,
+          lat: r.lat,
+          lon: r.lon,
+          accuracy: r.accuracy,
           timestamp: r.timestamp // Send original timestamp recorded offline
         }),
       });
@@ -134,22 +138,29 @@ async function isApiAvailable() {
   }
 }
 
+async function probeApiBase(base, timeoutMs) {
+  const res = await fetchWithTimeout(`${base}/api/online`, { method: "GET" }, timeoutMs);
+  if (!res.ok) throw new Error(`HTTP ${res.status}`);
+  return base;
+}
+
 async function detectApiBase() {
   const cached = readStore("api_base", null);
   const override = readStore("api_override", null);
-  const order = [];
-  if (override) order.push(override);
-  if (cached && cached !== override) order.push(cached);
-  order.push(...API_CANDIDATES.filter((b) => b !== cached));
-  for (const base of order) {
+  // The base that worked last time usually still does: check it alone first
+  for (const base of [...new Set([override, cached])]) {
+    if (!base) continue;
     try {
-      const res = await fetchWithTimeout(`${base}/api/online`, { method: "GET" }, 3000);
-      if (res.ok) {
-        writeStore("api_base", base);
-        return base;
-      }
+      return await probeApiBase(base, 3000);
     } catch (_) { }
   }
+  // Otherwise probe the other candidates at the same time and keep the first to answer
+  const others = [...new Set(API_CANDIDATES)].filter((b) => b !== cached && b !== override);
+  try {
+    const base = await Promise.any(others.map((b) => probeApiBase(b, 3000)));
+    writeStore("api_base", base);
+    return base;
+  } catch (_) { }
   const fallback = API_CANDIDATES[0];
   writeStore("api_base", fallback);
   return fallback;
@@ -0,0 +1,42 @@
+"""
+Recomputes the daily attendance rollups (DailyRollup in local.db) behind
+/api/admin/analytics from the stored punches. New punches are counted as they
+are written; run this once after upgrading, and again after importing or
+fixing records directly in the database.
+
+    python rebuild_rollup.py                                  # every stored day until yesterday
+    python rebuild_rollup.py --start 2025-01-01 --end 2025-03-31
+    python rebuild_rollup.py --local                          # SQL Server is down: use local.db
+
+Reads SQL Server. When DB_SERVER is set but the server is unreachable it stops,
+unless --local is given: local.db may be missing punches that only SQL Server
+has, and the rebuild replaces the stored counts.
+"""
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcula os totais diários usados em /api/admin/analytics")
+    parser.add_argument('--start', help="primeiro dia (AAAA-MM-DD); padrão: o registro mais antigo")
+    parser.add_argument('--end', help="último dia (AAAA-MM-DD); padrão: ontem (o dia atual já é contado a cada batida)")
+    parser.add_argument('--local', action='store_true',
+                        help="aceita recalcular a partir do local.db quando o SQL Server configurado está indisponível")
+    args = parser.parse_args()
+
+    import app as ponto
+    ponto.migrate_local_data()
+    ponto.DB_ONLINE = True  # try SQL Server first; get_db_connection falls back to local.db
+    try:
+        backend, months = ponto.rebuild_rollups(args.start, args.end, allow_local=args.local)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for month, punches in months.items():
+        print(f"  {month}: {punches} registros")
+    print(f"{sum(months.values())} registros em {len(months)} meses (origem: {backend})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Production entry point for the Ponto API.
+
+Preloads app.py once, then serves it from several worker processes:
+
+    python serve.py --workers 4 --port 5005
+
+The master process runs the per-host supervisor (DB health check, auto-sync,
+archiver) and publishes the DB status to a small state file that every worker
+reads, so the health probes do not multiply with the number of workers.
+
+Uses gunicorn when it is installed; otherwise falls back to a simple pre-fork
+server built on werkzeug (POSIX only). Every Server-Sent Events stream holds a
+thread there. With --asgi the app is served by uvicorn through asgi.py, where
+the hot endpoints and the status stream run on asyncio.
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ponto Eletrônico - servidor de produção")
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '5005')))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_WORKERS', str(os.cpu_count() or 2))))
+    parser.add_argument('--threads', type=int, default=int(os.getenv('WEB_THREADS', '8')),
+                        help="threads per worker (requests blocked on the DB)")
+    parser.add_argument('--timeout', type=int, default=120, help="worker timeout in seconds (report exports)")
+    parser.add_argument('--asgi', action='store_true', help="serve asgi.py with uvicorn (async hot endpoints)")
+    parser.add_argument('--state-file', default=os.getenv('DB_STATE_FILE', os.path.join(tempfile.gettempdir(), 'ponto_db_state.json')))
+    return parser.parse_args()
+
+
+def run_gunicorn(ponto, args):
+    from gunicorn.app.base import BaseApplication
+
+    class PontoApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{args.host}:{args.port}")
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('preload_app', True)
+            self.cfg.set('when_ready', lambda server: ponto.start_supervisor())
+
+        def load(self):
+            return ponto.app
+
+    PontoApplication().run()
+
+
+def run_asgi(ponto, args):
+    import uvicorn
+
+    # uvicorn workers are spawned fresh and read the DB state file
+    ponto.start_supervisor()
+    uvicorn.run('asgi:application', host=args.host, port=args.port, workers=args.workers,
+                timeout_keep_alive=5, log_level='info')
+
+
+def run_prefork(ponto, args):
+    from werkzeug.serving import make_server
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            srv = make_server(args.host, args.port, ponto.app, threaded=True, fd=sock.fileno())
+            srv.serve_forever()
+            os._exit(0)
+        return pid
+
+    # Fork before the supervisor threads exist so workers start clean
+    children = {spawn() for _ in range(args.workers)}
+    ponto.start_supervisor()
+    print(f"Servindo em http://{args.host}:{args.port} com {args.workers} processos (pid {os.getpid()})")
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Processo {pid} terminou; reiniciando.")
+            time.sleep(1)
+            children.add(spawn())
+
+
+def installed(*modules):
+    try:
+        for name in modules:
+            __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def main():
+    args = parse_args()
+    os.environ['DB_STATE_FILE'] = args.state_file
+    gunicorn = not args.asgi and installed('gunicorn')
+    if gunicorn:
+        # gthread has a fixed pool: keep half of it for regular requests
+        os.environ.setdefault('SSE_MAX_STREAMS', str(max(1, args.threads // 2)))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as ponto
+
+    ponto.startup()
+
+    if args.asgi:
+        run_asgi(ponto, args)
+        return
+    if gunicorn:
+        run_gunicorn(ponto, args)
+    elif hasattr(os, 'fork'):
+        run_prefork(ponto, args)
+    else:
+        print("gunicorn não instalado e fork indisponível; usando um único processo.")
+        ponto.start_supervisor()
+        from werkzeug.serving import run_simple
+        run_simple(args.host, args.port, ponto.app, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Shared fixtures: app.py is imported once with its SQLite files in a temporary
+directory and without SQL Server (DB_SERVER empty, which takes precedence
+over .env, so every request falls back to local.db). Each test starts from empty databases and cold caches.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix='ponto-tests-')
+os.environ.update(
+    SQLITE_PATH=os.path.join(DATA_DIR, 'local.db'),
+    SQLITE_ARCHIVE_PATH=os.path.join(DATA_DIR, 'local_archive.db'),
+    LOG_LEVEL='WARNING',
+    RATE_LIMIT_ENABLED='false',
+    GAZETTEER_PATH=os.path.join(DATA_DIR, 'missing.geojson'),
+    SECRET_KEY='tests-' + 'x' * 32,
+    DB_SERVER='',
+    INIT_DB_ON_START='false',
+)
+os.environ.pop('DB_STATE_FILE', None)
+sys.path.insert(0, ROOT)
+
+import app as ponto  # noqa: E402
+
+
+@pytest.fixture
+def app_module():
+    for path in (ponto.sqlite_path, ponto.sqlite_archive_path):
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    ponto._archive_months_cache.clear()
+    ponto._archive_columns_ready.clear()
+    ponto._rollup_schema_ready.clear()
+    ponto.DB_ONLINE = False
+    conn = ponto.connect_local()
+    ponto.ensure_sqlite_schema(conn)
+    conn.close()
+    return ponto
+
+
+@pytest.fixture
+def local_db(app_module):
+    conn = app_module.connect_local()
+    yield conn
+    conn.close()
@@ -0,0 +1,67 @@
+import datetime
+
+
+def _insert(conn, ponto, rows):
+    for i, ts in rows:
+        conn.execute("INSERT INTO TimeRecords (id, matricula, record_type, timestamp, ts_epoch) VALUES (?, 'm1', 'Entrada', ?, ?)",
+                     (i, ts, ponto.to_epoch(ts)))
+    conn.commit()
+
+
+def _archived_count(ponto, month):
+    conn = ponto.connect_local(ponto.sqlite_archive_path)
+    try:
+        return (conn.execute(f"SELECT COUNT(*) FROM {ponto.archive_table(month)}").fetchone()[0],
+                conn.execute("SELECT row_count FROM ArchivedMonths WHERE month = ?", (month,)).fetchone()[0])
+    finally:
+        conn.close()
+
+
+def test_archive_moves_every_chunk(app_module, local_db, monkeypatch):
+    ponto = app_module
+    monkeypatch.setattr(ponto, 'ARCHIVE_CHUNK_ROWS', 3)
+    monkeypatch.setattr(ponto, 'DELETE_CHUNK_PAUSE', 0)
+    _insert(local_db, ponto, [(i, f"2024-03-{i:02d} 08:00:00") for i in range(1, 11)])
+    _insert(local_db, ponto, [(20, "2024-04-01 08:00:00")])
+    ponto.attach_archive(local_db)
+
+    moved = ponto._archive_month_sqlite(local_db, '202403', '2024-03-01 00:00:00', '2024-04-01 00:00:00')
+
+    assert moved == 10
+    assert local_db.execute("SELECT id FROM TimeRecords").fetchall() == [(20,)]
+    assert _archived_count(ponto, '202403') == (10, 10)
+
+
+def test_rearchive_after_interrupted_copy_does_not_stop_early(app_module, local_db, monkeypatch):
+    ponto = app_module
+    monkeypatch.setattr(ponto, 'ARCHIVE_CHUNK_ROWS', 3)
+    monkeypatch.setattr(ponto, 'DELETE_CHUNK_PAUSE', 0)
+    _insert(local_db, ponto, [(i, f"2024-03-{i:02d} 08:00:00") for i in range(1, 11)])
+    ponto.attach_archive(local_db)
+    # a previous run copied the first chunks but died before deleting them
+    ponto._archive_month_sqlite(local_db, '202403', '2024-03-01 00:00:00', '2024-03-07 00:00:00')
+    _insert(local_db, ponto, [(i, f"2024-03-{i:02d} 08:00:00") for i in range(1, 7)])
+
+    moved = ponto._archive_month_sqlite(local_db, '202403', '2024-03-01 00:00:00', '2024-04-01 00:00:00')
+
+    assert moved == 10
+    assert local_db.execute("SELECT COUNT(*) FROM TimeRecords").fetchone()[0] == 0
+    assert _archived_count(ponto, '202403') == (10, 10)
+
+
+def test_archived_rows_stay_readable_through_time_records_from(app_module, local_db, monkeypatch):
+    ponto = app_module
+    now = ponto.now_local()
+    old = datetime.datetime(now.year - 1, 1, 15, 8, 0, 0)
+    _insert(local_db, ponto, [(1, ponto.format_ts(old)), (2, ponto.format_ts(now))])
+
+    ponto.archive_closed_months()
+
+    conn = ponto.connect_local()
+    ponto.attach_archive(conn)
+    try:
+        rows = conn.execute(f"SELECT t.id FROM {ponto.time_records_from(conn, old.strftime('%Y-%m-%d'))} ORDER BY t.id").fetchall()
+    finally:
+        conn.close()
+    assert rows == [(1,), (2,)]
+    assert local_db.execute("SELECT id FROM TimeRecords").fetchall() == [(2,)]
@@ -0,0 +1,80 @@
+import asyncio
+import datetime
+import threading
+
+import jwt
+import pytest
+
+
+@pytest.fixture
+def asgi(app_module, monkeypatch):
+    import asgi
+    monkeypatch.setattr(app_module, 'SSE_HEARTBEAT', 0.1)
+    return asgi
+
+
+async def call(asgi, path, query=b'', headers=(), disconnect=None):
+    """Runs one request through the ASGI app; returns (status, body)."""
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': list(headers),
+             'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+    messages = [{'type': 'http.request', 'body': b''}]
+    started, chunks = asyncio.get_running_loop().create_future(), []
+    disconnect = disconnect or asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start' and not started.done():
+            started.set_result(message['status'])
+        else:
+            chunks.append(message.get('body', b''))
+
+    await asgi.application(scope, receive, send)
+    return await started, b''.join(chunks)
+
+
+def test_slow_flask_view_does_not_block_other_delegated_routes(asgi, app_module, monkeypatch):
+    release, entered = threading.Event(), threading.Event()
+
+    def slow_view():
+        entered.set()
+        release.wait(5)
+        return 'done'
+
+    monkeypatch.setitem(app_module.app.view_functions, 'dashboard', slow_view)
+
+    async def scenario():
+        slow = asyncio.ensure_future(call(asgi, '/dashboard'))
+        while not entered.is_set():
+            await asyncio.sleep(0.01)
+        health = await asyncio.wait_for(call(asgi, '/health'), timeout=2)
+        release.set()
+        return health[0], await asyncio.wait_for(slow, timeout=2)
+
+    assert asyncio.run(scenario()) == (200, (200, b'done'))
+
+
+def test_open_flask_stream_does_not_block_other_delegated_routes(asgi, app_module):
+    admin = jwt.encode({'matricula': 'admin', 'role': 'admin',
+                        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=5)},
+                       app_module.app.config['SECRET_KEY'], algorithm="HS256")
+
+    async def scenario():
+        status, body = await call(asgi, '/api/admin/presence', headers=[(b'authorization', f'Bearer {admin}'.encode())])
+        ticket = app_module.app.json.loads(body)['stream_token']
+        gone = asyncio.Event()
+        stream = asyncio.ensure_future(call(asgi, '/api/admin/presence/stream', f'token={ticket}'.encode(),
+                                            disconnect=gone))
+        while app_module.presence.subscribers() == 0:
+            await asyncio.sleep(0.01)
+        health = await asyncio.wait_for(call(asgi, '/health'), timeout=2)
+        gone.set()
+        stream_status, _ = await asyncio.wait_for(stream, timeout=2)
+        return status, health[0], stream_status
+
+    assert asyncio.run(scenario()) == (200, 200, 200)
+    assert app_module.presence.subscribers() == 0
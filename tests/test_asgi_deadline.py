@@ -0,0 +1,42 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def asgi(app_module, monkeypatch):
+    import asgi
+    monkeypatch.setattr(asgi, 'ASGI_REQUEST_DEADLINE', 0.2)
+    return asgi
+
+
+def test_started_work_is_awaited_past_the_deadline(asgi):
+    def slow():
+        time.sleep(0.5)
+        return 'stored'
+
+    result, shed = asyncio.run(asgi.run_db({'path': '/api/punch'}, slow))
+
+    assert (result, shed) == ('stored', None)
+
+
+def test_queued_work_is_shed_without_running(asgi, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    monkeypatch.setattr(asgi, '_executor', ThreadPoolExecutor(max_workers=1))
+    release, ran = threading.Event(), []
+
+    async def scenario():
+        blocker = asyncio.ensure_future(asgi.run_db({'path': '/api/punch'}, release.wait))
+        await asyncio.sleep(0.05)
+        queued = await asgi.run_db({'path': '/api/punch'}, lambda: ran.append(1))
+        release.set()
+        await blocker
+        await asyncio.sleep(0.05)
+        return queued
+
+    result, shed = asyncio.run(scenario())
+
+    assert result is None and shed[1] == 504
+    assert ran == []
@@ -0,0 +1,27 @@
+import build_static
+
+
+def test_rewrite_refs_keeps_dot_directories():
+    assets = {'.well-known/security.txt': 'assets/.well-known/security.abc.txt', 'config.js': 'assets/config.def.js'}
+    html = '<a href="/.well-known/security.txt"></a><script src="./config.js"></script><img src="../up.png">'
+
+    out = build_static.rewrite_refs(html, 'index.html', assets)
+
+    assert 'href="/assets/.well-known/security.abc.txt"' in out
+    assert 'src="assets/config.def.js"' in out
+    assert 'src="../up.png"' in out
+
+
+def test_rebuild_only_when_sources_change(app_module, tmp_path, monkeypatch):
+    src = tmp_path / 'netlify'
+    src.mkdir()
+    (src / 'index.html').write_text('<script src="config.js"></script>')
+    (src / 'config.js').write_text('var API = 1;')
+    # point the default root of build_static at the temporary tree
+    monkeypatch.setattr(build_static.scan_sources, '__defaults__', (str(tmp_path),))
+    monkeypatch.setattr(build_static.build, '__defaults__', (None, str(tmp_path)))
+    assets = app_module.StaticAssets(str(tmp_path / 'dist'))
+
+    assert assets.rebuild_if_changed() is True
+    assert assets.rebuild_if_changed() is False
+    assert 'config.js' in assets.current()['assets']
@@ -0,0 +1,15 @@
+def test_bulk_delete_removes_records_keyed_by_either_column(app_module, local_db):
+    cur = local_db.execute("INSERT INTO Users (matricula, password, name) VALUES ('200', 'x', 'Ana')")
+    uid = cur.lastrowid
+    local_db.execute("INSERT INTO Users (matricula, password, name) VALUES ('201', 'x', 'Bia')")
+    for user_id, matricula in ((uid, None), (None, '200'), (uid, '200'), (None, '201')):
+        local_db.execute("INSERT INTO TimeRecords (user_id, matricula, record_type, timestamp) VALUES (?, ?, 'Entrada', '2026-01-05 08:00:00')",
+                         (user_id, matricula))
+    local_db.commit()
+    job = {'progress': {}}
+
+    app_module._bulk_delete_job(job, [uid])
+
+    assert job['progress']['deleted_records'] == 3
+    assert local_db.execute("SELECT matricula FROM TimeRecords").fetchall() == [('201',)]
+    assert local_db.execute("SELECT matricula FROM Users").fetchall() == [('201',)]
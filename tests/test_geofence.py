@@ -0,0 +1,51 @@
+import threading
+import time
+
+
+def _site(ponto, conn, name, lat, lon, radius, matriculas):
+    site_id = ponto.save_site(conn, None, name, lat, lon, radius)
+    conn.executemany("INSERT INTO UserSites (matricula, site_id) VALUES (?, ?)", [(m, site_id) for m in matriculas])
+    conn.commit()
+    return site_id
+
+
+def test_check_geofence(app_module, local_db):
+    ponto = app_module
+    _site(ponto, local_db, 'Escola A', -20.2500, -40.2700, 150, ['m1'])
+    _site(ponto, local_db, 'Escola B', -20.3000, -40.3000, 150, ['m2'])
+
+    assert ponto.check_geofence(local_db, 'm1', -20.2500, -40.2700, None) == ('inside', 0)
+    # ~200 m away: outside the 150 m fence, inside it once 60 m of GPS error is credited
+    lat = -20.2500 + 200 / 111320.0
+    assert ponto.check_geofence(local_db, 'm1', lat, -40.2700, 10)[0] == 'outside'
+    assert ponto.check_geofence(local_db, 'm1', lat, -40.2700, 60)[0] == 'inside'
+    # the reported accuracy is capped
+    assert ponto.check_geofence(local_db, 'm1', -20.2500 + 400 / 111320.0, -40.2700, 5000)[0] == 'outside'
+    # far from every box: distance to the nearest assigned site
+    status, meters = ponto.check_geofence(local_db, 'm1', -20.3000, -40.3000, None)
+    assert status == 'outside' and 6000 < meters < 7000
+    # another user's site does not count
+    assert ponto.check_geofence(local_db, 'm2', -20.2500, -40.2700, None)[0] == 'outside'
+    assert ponto.check_geofence(local_db, 'nobody', -20.2500, -40.2700, None) == ('unassigned', None)
+
+
+def test_publish_requests_coalesce(app_module, monkeypatch):
+    ponto = app_module
+    release, calls = threading.Event(), []
+
+    def publish():
+        calls.append(1)
+        release.wait(5)
+
+    monkeypatch.setattr(ponto, 'publish_sites', publish)
+    for _ in range(5):
+        ponto.request_publish_sites()
+    time.sleep(0.05)
+    release.set()
+    for _ in range(100):
+        if not ponto._sites_publish['running']:
+            break
+        time.sleep(0.01)
+
+    assert len(calls) == 2  # the running publish plus one re-run for the requests made meanwhile
+    assert not ponto._sites_publish['running']
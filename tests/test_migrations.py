@@ -0,0 +1,85 @@
+def _applied(conn):
+    return [r[0] for r in conn.execute("SELECT version FROM SchemaVersion ORDER BY version")]
+
+
+def test_epoch_backfill_runs_once_as_a_migration(app_module, local_db):
+    ponto = app_module
+    local_db.execute("INSERT INTO TimeRecords (id, matricula, record_type, timestamp) VALUES (1, 'm1', 'Entrada', '2024-03-05 08:00:00')")
+    local_db.execute("INSERT INTO OfflineQueue (id, matricula, record_type, timestamp) VALUES (1, 'm1', 'Saída', '2024-03-05 17:30:00')")
+    local_db.commit()
+    arch = ponto.connect_local(ponto.sqlite_archive_path)
+    arch.execute("CREATE TABLE TimeRecords_202301 (id INTEGER PRIMARY KEY, matricula TEXT, user_name TEXT, timestamp TEXT)")
+    arch.execute("INSERT INTO TimeRecords_202301 (id, matricula, timestamp) VALUES (7, 'm1', '2023-01-10 09:15:00')")
+    arch.execute("CREATE TABLE ArchivedMonths (month TEXT PRIMARY KEY, table_name TEXT NOT NULL, row_count INTEGER DEFAULT 0, archived_at DATETIME)")
+    arch.execute("INSERT INTO ArchivedMonths (month, table_name, row_count) VALUES ('202301', 'TimeRecords_202301', 1)")
+    arch.commit()
+    arch.close()
+
+    assert 2 in ponto.migrate_local_data()
+
+    assert local_db.execute("SELECT ts_epoch, tz FROM TimeRecords").fetchone() == (ponto.to_epoch('2024-03-05 08:00:00'), ponto.LOCAL_TZ_NAME)
+    assert local_db.execute("SELECT ts_epoch FROM OfflineQueue").fetchone() == (ponto.to_epoch('2024-03-05 17:30:00'),)
+    ponto.attach_archive(local_db)
+    assert local_db.execute("SELECT ts_epoch FROM arch.TimeRecords_202301").fetchone() == (ponto.to_epoch('2023-01-10 09:15:00'),)
+    assert _applied(local_db) == [v for v, _, _ in ponto.LOCAL_MIGRATIONS]
+    assert ponto.migrate_local_data() == []
+
+
+def test_day_start_epoch_covers_the_whole_end_day(app_module):
+    ponto = app_module
+    start, end = ponto.day_start_epoch('2024-03-05'), ponto.day_start_epoch('2024-03-05', 1)
+    assert start == ponto.to_epoch('2024-03-05 00:00:00')
+    assert start <= ponto.to_epoch('2024-03-05 23:59:59') < end
+    assert ponto.day_start_epoch('05/03/2024') is None
+
+
+def test_denormalize_encode_and_keep_user_names(app_module, local_db):
+    ponto = app_module
+    uid = local_db.execute("INSERT INTO Users (matricula, password, name) VALUES ('m1', 'x', 'Ana')").lastrowid
+    local_db.execute("""INSERT INTO TimeRecords (user_id, record_type, timestamp, neighborhood, city)
+                        VALUES (?, 'Entrada', '2024-03-05 08:00:00', 'Centro', 'Vitória')""", (uid,))
+    local_db.commit()
+
+    ponto.migrate_local_data()
+    local_db.execute("UPDATE Users SET name = 'Ana Souza' WHERE id = ?", (uid,))
+    local_db.commit()
+
+    row = local_db.execute("SELECT matricula, user_name, neighborhood, city, location_id FROM TimeRecords").fetchone()
+    assert row[:4] == ('m1', 'Ana', None, None) and row[4] is not None
+    text_cols, joins = ponto.punch_text_columns(local_db)
+    # a later rename does not rewrite the name stored on the punch
+    assert local_db.execute(f"SELECT {text_cols} FROM TimeRecords t {joins}").fetchone() == ('Ana', 'Centro', 'Vitória')
+
+
+def test_changing_a_matricula_moves_the_local_punches(app_module, local_db):
+    import datetime
+    import jwt
+    ponto = app_module
+    uid = local_db.execute("INSERT INTO Users (matricula, password, name) VALUES ('m1', 'x', 'Ana')").lastrowid
+    local_db.execute("INSERT INTO TimeRecords (matricula, user_name, record_type, timestamp, ts_epoch) VALUES ('m1', 'Ana', 'Entrada', '2024-03-05 08:00:00', 1)")
+    local_db.execute("INSERT INTO OfflineQueue (matricula, user_name, record_type, timestamp, ts_epoch) VALUES ('m1', 'Ana', 'Saída', '2024-03-05 17:00:00', 2)")
+    local_db.commit()
+    admin = jwt.encode({'matricula': 'admin', 'role': 'admin',
+                        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=5)},
+                       ponto.app.config['SECRET_KEY'], algorithm="HS256")
+
+    resp = ponto.app.test_client().put(f'/api/admin/users/{uid}', json={'matricula': 'm9'},
+                                       headers={'Authorization': f'Bearer {admin}'})
+
+    assert resp.status_code == 200
+    assert local_db.execute("SELECT matricula FROM TimeRecords").fetchall() == [('m9',)]
+    assert local_db.execute("SELECT matricula FROM OfflineQueue").fetchall() == [('m9',)]
+
+
+def test_rekey_merges_first_arrivals_and_sites_already_under_the_new_matricula(app_module, local_db):
+    ponto = app_module
+    for matricula, ts in (('m1', '2024-03-05 07:50:00'), ('m9', '2024-03-05 08:30:00')):
+        ponto.rollup_punch(local_db, matricula, 'Entrada', ts, None)
+    local_db.executemany("INSERT INTO UserSites (matricula, site_id) VALUES (?, ?)", [('m1', 1), ('m1', 2), ('m9', 1)])
+
+    ponto.rekey_local_punches(local_db, 'm1', 'm9')
+
+    assert local_db.execute("SELECT day, matricula, timestamp FROM DailyFirstIn").fetchall() == [
+        ('2024-03-05', 'm9', '2024-03-05 07:50:00')]
+    assert local_db.execute("SELECT punches, arrivals, late FROM DailyRollup").fetchall() == [(2, 1, 0)]
+    assert local_db.execute("SELECT matricula, site_id FROM UserSites ORDER BY site_id").fetchall() == [('m9', 1), ('m9', 2)]
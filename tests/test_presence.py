@@ -0,0 +1,58 @@
+import datetime
+
+import jwt
+
+
+def test_build_runs_outside_the_lock_and_keeps_punches_recorded_meanwhile(app_module, monkeypatch):
+    ponto = app_module
+    index = ponto.PresenceIndex()
+    now = ponto.format_ts(ponto.now_local())
+
+    def load(start):
+        assert not index.lock.locked()
+        index.record('m2', 'Bia', 'Entrada', now, None, None)  # a punch landing mid-build
+        return {'m1': index._entry('m1', 'Ana', 'Entrada', now, None, None)}, None
+
+    monkeypatch.setattr(index, '_load', load)
+    snap = index.snapshot()
+
+    assert sorted(p['matricula'] for p in snap['people']) == ['m1', 'm2']
+    assert not index.building and not index.dirty
+
+
+def test_invalidate_during_build_is_not_lost(app_module, monkeypatch):
+    index = app_module.PresenceIndex()
+
+    def load(start):
+        index.invalidate()
+        return {}, None
+
+    monkeypatch.setattr(index, '_load', load)
+    index.snapshot()
+
+    assert index.dirty
+
+
+def test_stream_ticket_is_single_use(app_module):
+    ponto = app_module
+    admin = jwt.encode({'matricula': 'admin', 'role': 'admin',
+                        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=5)},
+                       ponto.app.config['SECRET_KEY'], algorithm="HS256")
+    client = ponto.app.test_client()
+    ticket = client.get('/api/admin/presence', headers={'Authorization': f'Bearer {admin}'}).get_json()['stream_token']
+
+    first = client.get(f'/api/admin/presence/stream?token={ticket}', buffered=False)
+    second = client.get(f'/api/admin/presence/stream?token={ticket}', buffered=False)
+    first.close()
+
+    assert first.status_code == 200
+    assert second.status_code == 401
+    assert client.get(f'/api/admin/presence/stream?token={admin}').status_code == 401
+
+
+def test_punch_with_an_unknown_type_is_rejected(app_module, local_db):
+    body, status = app_module.record_punch('m1', {'type': '<img src=x onerror=alert(1)>'})
+
+    assert status == 400
+    assert local_db.execute("SELECT COUNT(*) FROM OfflineQueue").fetchone()[0] == 0
+    assert app_module.record_punch('m1', None)[1] == 400
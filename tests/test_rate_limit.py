@@ -0,0 +1,20 @@
+def test_client_ip_trusts_forwarded_for_only_from_trusted_proxies(app_module):
+    ponto = app_module
+    assert ponto.client_ip('127.0.0.1', '203.0.113.9') == '203.0.113.9'
+    # a client-supplied hop on the left cannot choose the bucket
+    assert ponto.client_ip('::1', '10.9.9.9, 203.0.113.9') == '203.0.113.9'
+    assert ponto.client_ip('198.51.100.7', '203.0.113.9') == '198.51.100.7'
+    assert ponto.client_ip('127.0.0.1', None) == '127.0.0.1'
+
+
+def test_login_limit_is_per_ip_and_matricula(app_module, monkeypatch):
+    ponto = app_module
+    monkeypatch.setattr(ponto, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(ponto, 'user_buckets', ponto.TokenBuckets(2, 0))
+    monkeypatch.setattr(ponto, 'ip_buckets', ponto.TokenBuckets(100, 0))
+
+    for _ in range(2):
+        assert not ponto.rate_limited('/api/login', 'victim', '203.0.113.9', per_ip_user=True)
+    assert ponto.rate_limited('/api/login', 'victim', '203.0.113.9', per_ip_user=True)
+    # the employee logging in from elsewhere is not locked out
+    assert not ponto.rate_limited('/api/login', 'victim', '198.51.100.7', per_ip_user=True)
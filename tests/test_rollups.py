@@ -0,0 +1,82 @@
+import datetime
+
+import pytest
+
+
+def _rollup(conn):
+    return conn.execute("""
+        SELECT day, record_type, SUM(punches), SUM(arrivals), SUM(late) FROM DailyRollup
+        GROUP BY day, record_type HAVING SUM(punches) > 0 ORDER BY day, record_type
+    """).fetchall()
+
+
+def test_rollup_counts_the_first_arrival_even_when_it_syncs_late(app_module, local_db, monkeypatch):
+    ponto = app_module
+    monkeypatch.setattr(ponto, 'LATE_ARRIVAL_AFTER', '08:00')
+    ponto.rollup_punch(local_db, 'm1', 'Entrada', '2024-03-05 08:20:00', 1)
+    ponto.rollup_punch(local_db, 'm1', 'Saída', '2024-03-05 17:00:00', 1)
+    assert _rollup(local_db) == [('2024-03-05', 'Entrada', 1, 1, 1), ('2024-03-05', 'Saída', 1, 0, 0)]
+
+    # an earlier arrival synced afterwards replaces the late one, at its own location
+    ponto.rollup_punch(local_db, 'm1', 'Entrada', '2024-03-05 07:55:00', 2)
+    local_db.commit()
+
+    assert _rollup(local_db) == [('2024-03-05', 'Entrada', 2, 1, 0), ('2024-03-05', 'Saída', 1, 0, 0)]
+    assert local_db.execute("SELECT location_id, arrivals FROM DailyRollup WHERE record_type = 'Entrada' ORDER BY location_id").fetchall() == [(1, 0), (2, 1)]
+    assert local_db.execute("SELECT timestamp, location_id FROM DailyFirstIn").fetchall() == [('2024-03-05 07:55:00', 2)]
+
+
+def test_rebuild_matches_live_counting_and_leaves_today_alone(app_module, local_db):
+    ponto = app_module
+    today = ponto.now_local().date()
+    yesterday = (today - datetime.timedelta(days=1)).isoformat()
+    punches = [('m1', 'Entrada', f'{yesterday} 07:50:00'), ('m2', 'Entrada', f'{yesterday} 08:30:00'),
+               ('m1', 'Saída', f'{yesterday} 17:00:00'), ('m1', 'Entrada', '2024-03-05 09:00:00')]
+    for mat, kind, ts in punches:
+        local_db.execute("INSERT INTO TimeRecords (matricula, record_type, timestamp, ts_epoch) VALUES (?, ?, ?, ?)",
+                         (mat, kind, ts, ponto.to_epoch(ts)))
+        ponto.rollup_punch(local_db, mat, kind, ts, None)
+    ponto.rollup_punch(local_db, 'm3', 'Entrada', f'{today} 08:00:00', None)  # counted live today
+    local_db.execute("DELETE FROM DailyRollup WHERE day < ?", (today.isoformat(),))  # lost counts
+    local_db.commit()
+
+    backend, months = ponto.rebuild_rollups()
+
+    assert backend == 'sqlite' and sum(months.values()) == 4
+    days = {r[0] for r in _rollup(local_db)}
+    assert days == {'2024-03-05', yesterday, today.isoformat()}
+    assert [r[2:] for r in _rollup(local_db) if r[0] == yesterday] == [(2, 2, 1), (1, 0, 0)]
+
+
+def test_rebuild_refuses_local_db_when_sql_server_is_configured(app_module, monkeypatch):
+    ponto = app_module
+    monkeypatch.setattr(ponto, 'server', 'sqlserver.example')
+    with pytest.raises(RuntimeError):
+        ponto.rebuild_rollups('2024-03-01', '2024-03-31')
+    assert ponto.rebuild_rollups('2024-03-01', '2024-03-31', allow_local=True) == ('sqlite', {'202403': 0})
+
+
+def test_count_punch_checks_the_schema_once_per_process(app_module, monkeypatch):
+    ponto = app_module
+    calls = []
+    real = ponto.ensure_sqlite_schema
+    monkeypatch.setattr(ponto, 'ensure_sqlite_schema', lambda conn: calls.append(1) or real(conn))
+    for ts in ('2024-03-05 08:00:00', '2024-03-05 08:01:00'):
+        ponto.count_punch('m1', 'Entrada', ts, 'Centro', 'Vitória')
+    assert len(calls) == 1
+
+
+def test_scheduled_rebuild_reads_recent_closed_days_from_sql_server_only(app_module, monkeypatch):
+    ponto = app_module
+    calls = []
+    monkeypatch.setattr(ponto, 'rebuild_rollups', lambda start=None, end=None: calls.append((start, end)))
+    monkeypatch.setattr(ponto, 'ROLLUP_REBUILD_DAYS', 7)
+
+    assert ponto.rebuild_recent_rollups() is None  # no SQL Server configured
+    monkeypatch.setattr(ponto, 'server', 'db.example')
+    monkeypatch.setattr(ponto, 'sql_online', lambda: False)
+    assert ponto.rebuild_recent_rollups() is None
+    monkeypatch.setattr(ponto, 'sql_online', lambda: True)
+    ponto.rebuild_recent_rollups()
+
+    assert calls == [((ponto.now_local().date() - datetime.timedelta(days=7)).isoformat(), None)]
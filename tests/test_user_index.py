@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+def add_user(conn, matricula, name):
+    conn.execute("INSERT INTO Users (matricula, password, name) VALUES (?, 'x', ?)", (matricula, name))
+    conn.commit()
+
+
+def test_stale_search_answers_from_memory_and_rebuilds_once_in_background(app_module, local_db, monkeypatch):
+    index = app_module.UserPrefixIndex()
+    add_user(local_db, '100', 'Ana')
+    assert [u['name'] for u in index.search('ana')] == ['Ana']
+
+    add_user(local_db, '101', 'Anita')
+    index.invalidate(shared=False)
+    release, builds, reads = threading.Event(), [], []
+    build = index._build
+
+    def slow_build():
+        builds.append(1)
+        release.wait(2)
+        build()
+
+    monkeypatch.setattr(index, '_build', slow_build)
+    monkeypatch.setattr(app_module, 'read_generation', lambda name: reads.append(threading.current_thread()))
+
+    started = time.monotonic()
+    first = index.search('ani')
+    second = index.search('ani')
+    assert time.monotonic() - started < 0.5
+    assert first == second == []
+    assert threading.current_thread() not in reads
+
+    release.set()
+    while index.refreshing:
+        time.sleep(0.01)
+    assert builds == [1]
+    assert [u['name'] for u in index.search('ani')] == ['Anita']